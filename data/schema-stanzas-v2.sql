@@ -0,0 +1,65 @@
+--
+-- Offline stanza storage schema v2 (set "schema": 2 in the database section
+-- of the c2s configuration). Use instead of the stanzas_* tables in schema.sql
+-- on new installations; existing ones are migrated with
+-- data/updates/stanzas-v2.sql.
+--
+
+--
+-- Table structure for table `stanzas_iq`
+--
+
+CREATE TABLE `stanzas_iq` (
+  `id` varchar(30) CHARACTER SET ascii COLLATE ascii_bin NOT NULL COMMENT 'Stanza ID',
+  `sender` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'From (user ID)',
+  `recipient` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'To (user ID)',
+  `type` varchar(15) CHARACTER SET ascii DEFAULT NULL COMMENT 'Stanza type',
+  `content` mediumblob NOT NULL COMMENT 'Stanza content',
+  `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
+  `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
+  PRIMARY KEY (`id`),
+  KEY `recipient` (`recipient`,`timestamp`),
+  KEY `expire_timestamp` (`expire_timestamp`),
+  KEY `timestamp` (`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (iq)';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `stanzas_message`
+--
+
+CREATE TABLE `stanzas_message` (
+  `id` varchar(30) CHARACTER SET ascii COLLATE ascii_bin NOT NULL COMMENT 'Stanza ID',
+  `sender` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'From (user ID)',
+  `recipient` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'To (user ID)',
+  `type` varchar(15) CHARACTER SET ascii DEFAULT NULL COMMENT 'Stanza type',
+  `content` mediumblob NOT NULL COMMENT 'Stanza content',
+  `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
+  `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
+  PRIMARY KEY (`id`),
+  KEY `recipient` (`recipient`,`timestamp`),
+  KEY `expire_timestamp` (`expire_timestamp`),
+  KEY `timestamp` (`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (message)';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `stanzas_presence`
+--
+
+CREATE TABLE `stanzas_presence` (
+  `id` varchar(30) CHARACTER SET ascii COLLATE ascii_bin NOT NULL COMMENT 'Stanza ID',
+  `sender` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'From (user ID)',
+  `recipient` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'To (user ID)',
+  `type` varchar(15) CHARACTER SET ascii DEFAULT NULL COMMENT 'Stanza type',
+  `content` mediumblob NOT NULL COMMENT 'Stanza content',
+  `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
+  `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `key` (`sender`,`recipient`,`type`),
+  KEY `recipient` (`recipient`,`timestamp`),
+  KEY `expire_timestamp` (`expire_timestamp`),
+  KEY `timestamp` (`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (presence)';
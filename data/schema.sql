@@ -33,7 +33,9 @@ CREATE TABLE `presence` (
   `show` varchar(30) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL COMMENT 'Availability',
   `priority` smallint(5) NOT NULL DEFAULT '0' COMMENT 'Priority',
   `fingerprint` char(40) DEFAULT NULL COMMENT 'Public key fingerprint',
-  PRIMARY KEY (`userid`)
+  `version` bigint(20) unsigned NOT NULL DEFAULT '1' COMMENT 'Change version',
+  PRIMARY KEY (`userid`),
+  KEY `version` (`version`,`userid`)
 ) ENGINE=MyISAM DEFAULT CHARSET=ascii COMMENT='User presence cache';
 
 -- --------------------------------------------------------
@@ -64,7 +66,8 @@ CREATE TABLE `stanzas_iq` (
   `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
   `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
   PRIMARY KEY (`id`),
-  UNIQUE KEY `key` (`sender`,`recipient`,`type`)
+  UNIQUE KEY `key` (`sender`,`recipient`,`type`),
+  KEY `timestamp` (`timestamp`)
 ) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (iq)';
 
 -- --------------------------------------------------------
@@ -81,7 +84,8 @@ CREATE TABLE `stanzas_message` (
   `content` mediumblob NOT NULL COMMENT 'Stanza content',
   `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
   `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `timestamp` (`timestamp`)
 ) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (message)';
 
 -- --------------------------------------------------------
@@ -99,7 +103,8 @@ CREATE TABLE `stanzas_presence` (
   `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
   `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
   PRIMARY KEY (`id`),
-  UNIQUE KEY `key` (`sender`,`recipient`,`type`)
+  UNIQUE KEY `key` (`sender`,`recipient`,`type`),
+  KEY `timestamp` (`timestamp`)
 ) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (presence)';
 
 -- --------------------------------------------------------
@@ -113,7 +118,8 @@ CREATE TABLE `validations` (
   `code` char(6) NOT NULL COMMENT 'Verification code',
   `timestamp` datetime DEFAULT NULL COMMENT 'Validation code timestamp',
   PRIMARY KEY (`userid`),
-  UNIQUE KEY `code` (`code`)
+  UNIQUE KEY `code` (`code`),
+  KEY `timestamp` (`timestamp`)
 ) ENGINE=MyISAM DEFAULT CHARSET=ascii COMMENT='Verification codes';
 
 /*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
@@ -0,0 +1,4 @@
+-- presence change versions for delta presence sync between servers
+-- existing rows get version 1 and are sent only on a full sync
+ALTER TABLE `presence` ADD `version` bigint(20) unsigned NOT NULL DEFAULT '1' COMMENT 'Change version',
+  ADD INDEX `version` (`version`, `userid`);
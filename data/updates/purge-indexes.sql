@@ -0,0 +1,5 @@
+-- indexes for batched expiry purge (works on both v1 and v2 stanza tables)
+ALTER TABLE `stanzas_iq` ADD INDEX `timestamp` (`timestamp`);
+ALTER TABLE `stanzas_message` ADD INDEX `timestamp` (`timestamp`);
+ALTER TABLE `stanzas_presence` ADD INDEX `timestamp` (`timestamp`);
+ALTER TABLE `validations` ADD INDEX `timestamp` (`timestamp`);
@@ -0,0 +1,37 @@
+--
+-- Offline stanza storage schema v2: final swap.
+-- Run with all c2s components stopped, after data/updates/stanzas-v2.sql.
+--
+
+-- rows stored during the copy (presence rows are replaced in place)
+INSERT IGNORE INTO `stanzas_iq_v2`
+  SELECT o.`id`, LEFT(o.`sender`, 40), LEFT(o.`recipient`, 40), o.`type`, o.`content`, o.`timestamp`, o.`expire_timestamp`
+  FROM `stanzas_iq` o LEFT JOIN `stanzas_iq_v2` n ON n.`id` = o.`id`
+  WHERE n.`id` IS NULL;
+INSERT IGNORE INTO `stanzas_message_v2`
+  SELECT o.`id`, LEFT(o.`sender`, 40), LEFT(o.`recipient`, 40), o.`type`, o.`content`, o.`timestamp`, o.`expire_timestamp`
+  FROM `stanzas_message` o LEFT JOIN `stanzas_message_v2` n ON n.`id` = o.`id`
+  WHERE n.`id` IS NULL;
+REPLACE INTO `stanzas_presence_v2`
+  SELECT o.`id`, LEFT(o.`sender`, 40), LEFT(o.`recipient`, 40), o.`type`, o.`content`, o.`timestamp`, o.`expire_timestamp`
+  FROM `stanzas_presence` o LEFT JOIN `stanzas_presence_v2` n ON n.`id` = o.`id`
+  WHERE n.`id` IS NULL OR n.`timestamp` <> o.`timestamp`;
+
+-- rows deleted during the copy
+DELETE n FROM `stanzas_iq_v2` n LEFT JOIN `stanzas_iq` o ON o.`id` = n.`id`
+  WHERE o.`id` IS NULL;
+DELETE n FROM `stanzas_message_v2` n LEFT JOIN `stanzas_message` o ON o.`id` = n.`id`
+  WHERE o.`id` IS NULL;
+DELETE n FROM `stanzas_presence_v2` n LEFT JOIN `stanzas_presence` o ON o.`id` = n.`id`
+  WHERE o.`id` IS NULL;
+
+RENAME TABLE
+  `stanzas_iq` TO `stanzas_iq_v1`, `stanzas_iq_v2` TO `stanzas_iq`,
+  `stanzas_message` TO `stanzas_message_v1`, `stanzas_message_v2` TO `stanzas_message`,
+  `stanzas_presence` TO `stanzas_presence_v1`, `stanzas_presence_v2` TO `stanzas_presence`;
+
+--
+-- When c2s is running fine with schema 2:
+--
+-- DROP TABLE `stanzas_iq_v1`, `stanzas_message_v1`, `stanzas_presence_v1`;
+--
@@ -0,0 +1,95 @@
+--
+-- Offline stanza storage schema v2.
+--
+-- Moves stanzas_* tables to InnoDB with a (recipient, timestamp) index and
+-- an expire_timestamp index; sender and recipient hold bare user IDs.
+--
+-- Procedure:
+--  1. run this script while c2s is online: it fills new stanzas_*_v2 tables
+--     in primary key ranges, so writers on the old MyISAM tables are blocked
+--     for one range at a time only
+--  2. stop all c2s components
+--  3. run data/updates/stanzas-v2-swap.sql: it copies the rows stored and
+--     drops the rows deleted during step 1, then swaps the tables
+--  4. set "schema": 2 in the database section of every c2s configuration
+--     and start c2s components
+--
+-- Step 1 can be run again (e.g. right before step 2) to shorten the downtime
+-- of step 3.
+--
+
+CREATE TABLE IF NOT EXISTS `stanzas_iq_v2` (
+  `id` varchar(30) CHARACTER SET ascii COLLATE ascii_bin NOT NULL COMMENT 'Stanza ID',
+  `sender` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'From (user ID)',
+  `recipient` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'To (user ID)',
+  `type` varchar(15) CHARACTER SET ascii DEFAULT NULL COMMENT 'Stanza type',
+  `content` mediumblob NOT NULL COMMENT 'Stanza content',
+  `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
+  `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
+  PRIMARY KEY (`id`),
+  KEY `recipient` (`recipient`,`timestamp`),
+  KEY `expire_timestamp` (`expire_timestamp`),
+  KEY `timestamp` (`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (iq)';
+
+CREATE TABLE IF NOT EXISTS `stanzas_message_v2` (
+  `id` varchar(30) CHARACTER SET ascii COLLATE ascii_bin NOT NULL COMMENT 'Stanza ID',
+  `sender` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'From (user ID)',
+  `recipient` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'To (user ID)',
+  `type` varchar(15) CHARACTER SET ascii DEFAULT NULL COMMENT 'Stanza type',
+  `content` mediumblob NOT NULL COMMENT 'Stanza content',
+  `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
+  `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
+  PRIMARY KEY (`id`),
+  KEY `recipient` (`recipient`,`timestamp`),
+  KEY `expire_timestamp` (`expire_timestamp`),
+  KEY `timestamp` (`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (message)';
+
+CREATE TABLE IF NOT EXISTS `stanzas_presence_v2` (
+  `id` varchar(30) CHARACTER SET ascii COLLATE ascii_bin NOT NULL COMMENT 'Stanza ID',
+  `sender` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'From (user ID)',
+  `recipient` varchar(48) CHARACTER SET ascii NOT NULL COMMENT 'To (user ID)',
+  `type` varchar(15) CHARACTER SET ascii DEFAULT NULL COMMENT 'Stanza type',
+  `content` mediumblob NOT NULL COMMENT 'Stanza content',
+  `timestamp` bigint(20) unsigned NOT NULL COMMENT 'Stanza timestamp',
+  `expire_timestamp` datetime DEFAULT NULL COMMENT 'Stanza expiration timestamp',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `key` (`sender`,`recipient`,`type`),
+  KEY `recipient` (`recipient`,`timestamp`),
+  KEY `expire_timestamp` (`expire_timestamp`),
+  KEY `timestamp` (`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin COMMENT='Pending stanzas (presence)';
+
+-- copies a table in ranges of 5000 ids (one statement each)
+DROP PROCEDURE IF EXISTS `stanzas_v2_copy`;
+DELIMITER //
+CREATE PROCEDURE `stanzas_v2_copy`(IN `src` VARCHAR(64), IN `dst` VARCHAR(64))
+BEGIN
+  SET @last = '';
+  copy: LOOP
+    SET @q = CONCAT('SELECT MAX(`id`) INTO @next FROM (SELECT `id` FROM `', `src`,
+      '` WHERE `id` > ? ORDER BY `id` LIMIT 5000) r');
+    PREPARE s FROM @q;
+    EXECUTE s USING @last;
+    DEALLOCATE PREPARE s;
+    IF @next IS NULL THEN
+      LEAVE copy;
+    END IF;
+
+    SET @q = CONCAT('INSERT IGNORE INTO `', `dst`, '` SELECT `id`, LEFT(`sender`, 40), LEFT(`recipient`, 40), ',
+      '`type`, `content`, `timestamp`, `expire_timestamp` FROM `', `src`, '` WHERE `id` > ? AND `id` <= ? ',
+      'ORDER BY `timestamp` DESC');
+    PREPARE s FROM @q;
+    EXECUTE s USING @last, @next;
+    DEALLOCATE PREPARE s;
+    SET @last = @next;
+  END LOOP;
+END //
+DELIMITER ;
+
+CALL `stanzas_v2_copy`('stanzas_iq', 'stanzas_iq_v2');
+CALL `stanzas_v2_copy`('stanzas_message', 'stanzas_message_v2');
+CALL `stanzas_v2_copy`('stanzas_presence', 'stanzas_presence_v2');
+
+DROP PROCEDURE `stanzas_v2_copy`;
@@ -171,14 +171,14 @@ class Fileserver(resource.Resource, service.Service):
         # initialize storage
         # doing it here because it's needed by the server factory
         storage.init(self.config['database'])
-        self.presencedb = storage.MySQLPresenceStorage()
+        self.presencedb = storage.presence_storage()
 
         # TODO from configuration
         stor_class = self.config['storage']['class']
         klass = getattr(storage, stor_class)
         self.storage = klass(*self.config['storage']['params'])
 
-        self.keyring = keyring.Keyring(storage.MySQLNetworkStorage(), self.config['fingerprint'], self.network, self.servername, disable_cache=True)
+        self.keyring = keyring.Keyring(storage.network_storage(), self.config['fingerprint'], self.network, self.servername, disable_cache=True)
         token_auth = auth.AuthKontalkChecker(self.config['fingerprint'], self.keyring)
 
         # upload endpoint
@@ -23,7 +23,12 @@ import time
 import base64
 import traceback
 
-from twisted.internet import reactor, defer
+try:
+    from collections import OrderedDict
+except:
+    from ordereddict import OrderedDict
+
+from twisted.internet import reactor, defer, task
 from twisted.application import strports, internet
 from twisted.application.internet import StreamServerEndpointService
 from twisted.cred import portal
@@ -130,6 +135,18 @@ class XMPPServerFactory(xish_xmlstream.XmlStreamFactoryMixin, ServerFactory):
 
         return False
 
+    def client_drained(self, _jid):
+        """
+        Returns a L{Deferred} fired when the data sent to the given local
+        L{JID} (all resources if bare) has been written out to the network.
+        """
+        userid, resource = util.jid_to_userid(_jid, True)
+        dlist = []
+        for res, manager in self.streams.get(userid, {}).iteritems():
+            if resource in (None, res):
+                dlist.append(manager.drained())
+        return defer.DeferredList(dlist)
+
     def dispatch(self, stanza):
         """
         Dispatch a stanza to a JID all to all available resources found locally.
@@ -145,6 +162,31 @@ class XMPPServerFactory(xish_xmlstream.XmlStreamFactoryMixin, ServerFactory):
             for resource, manager in self.streams[userid].iteritems():
                 manager.send(stanza)
 
+    def fanout(self, stanza, dests):
+        """
+        Writes a stanza to many local clients, serializing it once for all of
+        them (see L{sm.C2SManager.send_template}).
+        @param dests: list of (to, original-to) of each copy
+        @type dests: C{list} of (L{jid.JID}, C{str})
+        @return: destinations not connected here
+        """
+        template = None
+        missing = []
+        for to, original in dests:
+            try:
+                streams = self.streams[to.user]
+                managers = (streams[to.resource], ) if to.resource is not None else streams.values()
+            except KeyError:
+                missing.append((to, original))
+                continue
+
+            if template is None:
+                template = self.manager.template(stanza, self.network)
+            for manager in managers:
+                manager.send_template(template, original)
+
+        return missing
+
 
 # TODO this class need to be tested extensively
 class XMPPListenAuthenticator(xmlstream.ListenAuthenticator):
@@ -288,8 +330,23 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
     """
     OFFLINE_STORE_DELAY = 10
 
+    """Number of stored stanzas delivered per page on initial presence."""
+    OFFLINE_PAGE_SIZE = 100
+
+    """Number of users per chunk of presence data sent to remote c2s."""
+    PRESENCE_SYNC_PAGE_SIZE = 500
+    """Seconds to wait between chunks of presence data."""
+    PRESENCE_SYNC_DELAY = 0.1
+    """Seconds to wait for a presence sync reply before sending everything."""
+    PRESENCE_SYNC_TIMEOUT = 30
+
+    """Minimum number of recipients on a remote server to send them a multicast envelope."""
+    PRESENCE_MULTICAST_MIN = 2
+
     protocolHandlers = (
         handlers.InitialPresenceHandler,
+        handlers.PresenceSyncHandler,
+        handlers.MulticastHandler,
         handlers.PresenceProbeHandler,
         handlers.LastActivityHandler,
         handlers.MessageHandler,
@@ -318,6 +375,10 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
         self.validationdb = None
         self.keyring = None
         self.sfactory = None
+        # last presence version received from each remote c2s
+        self.presence_versions = {}
+        # remote c2s expanding multicast envelopes
+        self.multicast_hosts = set()
 
         # protocol handlers here!!
         for handler in self.protocolHandlers:
@@ -327,21 +388,22 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
         # initialize storage
         # doing it here because it's needed by the c2s server factory
         storage.init(self.config['database'])
-        self.presencedb = storage.MySQLPresenceStorage()
+        self.presencedb = storage.presence_storage()
 
         try:
             stanza_expire = self.config['stanza_expire']
         except KeyError:
             stanza_expire = 0
-        self.stanzadb = storage.MySQLStanzaStorage(stanza_expire)
+        self.stanzadb = storage.stanza_storage(stanza_expire)
+        self.stanzadb.reject_callback = self.message_offline_rejected
 
         try:
             validation_expire = self.config['registration']['expire']
         except KeyError:
             validation_expire = 0
-        self.validationdb = storage.MySQLUserValidationStorage(validation_expire)
+        self.validationdb = storage.validation_storage(validation_expire)
 
-        self.keyring = keyring.Keyring(storage.MySQLNetworkStorage(), self.config['fingerprint'], self.network, self.servername)
+        self.keyring = keyring.Keyring(storage.network_storage(), self.config['fingerprint'], self.network, self.servername)
         authrealm = auth.SASLRealm("Kontalk")
         authportal = portal.Portal(authrealm, [auth.AuthKontalkChecker(self.config['fingerprint'], self.keyring, self._verify_fingerprint)])
 
@@ -413,11 +475,21 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
             log.info("disabling push notifictions")
 
         # load local presence data
-        d = self.presencedb.get_all()
+        self._load_presence(0)
+
+    def _load_presence(self, after):
+        """
+        Loads local presence data in chunks, ordered by version.
+        @param after: version, or (version, userid) of the last loaded entry
+        """
+        d = self.presencedb.get_changes(after, self.PRESENCE_SYNC_PAGE_SIZE)
         d.addCallback(self._presence_data)
 
     def _presence_data(self, presence):
         log.debug("presence: %r" % (presence, ))
+        if type(presence) == list and len(presence) >= self.PRESENCE_SYNC_PAGE_SIZE:
+            reactor.callLater(0, self._load_presence, (presence[-1]['version'], presence[-1]['userid']))
+
         if type(presence) == list and len(presence) > 0:
 
             for user in presence:
@@ -635,6 +707,88 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
         else:
             self.dispatch(stanza, hold=hold)
 
+    def fanout(self, stanza, subscribers):
+        """
+        Sends a presence stanza to many subscribers, serializing it once.
+        Subscribers are resolved like in L{send} and grouped by server: local
+        clients get the stanza written straight to their streams, remote
+        servers get a copy of the serialized stanza with their own to and
+        original-to (see L{fanout_remote}).
+        """
+        util.resetNamespace(stanza, component.NS_COMPONENT_ACCEPT)
+
+        # force host in sender
+        sender = jid.JID(stanza['from'])
+        if sender.host == self.network:
+            sender.host = util.component_jid(self.servername, util.COMPONENT_C2S)
+            stanza['from'] = sender.full()
+
+        # server: [(to, original-to)]
+        byhost = OrderedDict()
+        for sub in subscribers:
+            original = sub.userhost()
+            if sub.host == self.network:
+                rcpts = self.cache.lookup(sub)
+                if not rcpts:
+                    log.debug("JID %s not found" % (original, ))
+                    continue
+                # all available resources or the bare JID
+                dests = rcpts.jids() or (rcpts.jid, )
+            else:
+                dests = (sub.userhostJID(), )
+            for dest in dests:
+                byhost.setdefault(dest.host, []).append((dest, original))
+
+        local = []
+        template = None
+        for host, dests in byhost.iteritems():
+            if util.hostjid_local(util.COMPONENT_C2S, self, host):
+                local.extend(dests)
+            else:
+                if template is None:
+                    template = xmlstream2.StanzaTemplate(stanza)
+                self.fanout_remote(host, template, [(dest.full(), original) for dest, original in dests])
+
+        # clients not connected here follow the usual path
+        for to, original in self.sfactory.fanout(stanza, local):
+            stanza['to'] = to.full()
+            stanza['original-to'] = original
+            self.dispatch(stanza)
+
+    def fanout_remote(self, host, template, dests):
+        """
+        Sends a serialized stanza to recipients on a remote server: in a
+        single multicast envelope, expanded by the remote c2s (see
+        L{handlers.MulticastHandler}), if there are enough of them and the
+        remote c2s advertised support for it (see L{set_multicast}).
+        @param template: the serialized stanza
+        @type template: L{xmlstream2.StanzaTemplate}
+        @param dests: list of (to, original-to) of each copy
+        """
+        if len(dests) < self.PRESENCE_MULTICAST_MIN or host not in self.multicast_hosts:
+            for to, original in dests:
+                component.Component.send(self, template.render(to, original))
+            return
+
+        addresses = domish.Element((xmlstream2.NS_XMPP_ADDRESS, 'addresses'))
+        for to, original in dests:
+            address = addresses.addElement('address')
+            address['type'] = 'to'
+            address['jid'] = to
+            address['original-to'] = original
+
+        envelope = u"<stanza xmlns='%s' from='%s' to='%s'>" % (component.NS_COMPONENT_ACCEPT,
+            domish.escapeToXml(self.xmlstream.thisEntity.full(), True), domish.escapeToXml(host, True))
+        component.Component.send(self, envelope.encode('utf-8') + addresses.toXml().encode('utf-8') +
+            template.render() + '</stanza>')
+
+    def set_multicast(self, host, supported):
+        """Records if a remote c2s expands multicast envelopes."""
+        if supported:
+            self.multicast_hosts.add(host)
+        else:
+            self.multicast_hosts.discard(host)
+
     def dispatch(self, stanza, hold=False, ignore_consumed=True):
         """
         Dispatches stanzas from router and from local clients.
@@ -688,6 +842,7 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
                 chat_msg = (stanza.getAttribute('type') == 'chat')
                 if to.user is not None:
                     keepId = None
+                    rejected = False
                     receipt = xmlstream2.extract_receipt(stanza, 'request')
                     received = xmlstream2.extract_receipt(stanza, 'received')
                     has_storage = xmlstream2.has_element(stanza, xmlstream2.NS_XMPP_STORAGE, 'storage')
@@ -729,8 +884,9 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
                         Do not store messages from local storage because
                         """
                         if chat_msg and not has_storage and (stanza.body or stanza.e2e or received):
-                            self.message_offline_store(stanza, delayed=False, reuseId=keepId)
-                        if self.push_manager and chat_msg and (stanza.body or stanza.e2e) and (not receipt or receipt.name == 'request'):
+                            # recipient over quota: the sender gets an error instead of receipts
+                            rejected = self.message_offline_store(stanza, delayed=False, reuseId=keepId) is None
+                        if self.push_manager and chat_msg and not rejected and (stanza.body or stanza.e2e) and (not receipt or receipt.name == 'request'):
                             self.push_manager.notify(to)
 
                     # if message is a received receipt, we can delete the original message
@@ -764,7 +920,7 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
                     except:
                         from_remote = False
 
-                    if chat_msg and (not from_storage or from_remote):
+                    if chat_msg and not rejected and (not from_storage or from_remote):
 
                         # send ack only for chat messages (if requested)
                         # do not send if coming from remote storage
@@ -875,10 +1031,39 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
             return defer.fail(Exception())
 
     def deliver_offline_storage(self, user):
-        d = self.stanzadb.get_by_recipient(user)
-        d.addCallback(self._local_presence_output, user)
+        """
+        Delivers offline storage to a local user, one page at a time.
+        The next page is requested only after the previous one has been
+        written out to the client (see L{C2SManager.drained}); delivery stops
+        if the user disconnects in the meantime.
+        """
+        return self._deliver_offline_page(user, None)
+
+    def _deliver_offline_page(self, user, after):
+        d = self.stanzadb.get_by_recipient(user, after, self.OFFLINE_PAGE_SIZE)
+        d.addCallback(self._deliver_offline_next, user)
+        return d
+
+    def _deliver_offline_next(self, data, user):
+        self._local_presence_output(data, user)
+
+        # in-memory pending stanzas have no cursor
+        cursors = [msg['cursor'] for msg in data if 'cursor' in msg]
+        if len(cursors) < self.OFFLINE_PAGE_SIZE:
+            return
+
+        # wait for the client to read the previous page
+        d = self.sfactory.client_drained(user)
+        d.addCallback(lambda _: task.deferLater(reactor, 0, self._deliver_offline_resume, user, cursors[-1]))
         return d
 
+    def _deliver_offline_resume(self, user, after):
+        if not self.sfactory.client_connected(user):
+            log.debug("%s disconnected, offline delivery interrupted" % (user.full(), ))
+            return
+
+        return self._deliver_offline_page(user, after)
+
     def _local_presence_output(self, data, user):
         log.debug("data: %r" % (data, ))
         # this will be used to set a safe recipient
@@ -1083,5 +1268,16 @@ class C2SComponent(xmlstream2.SocketComponent, resolver.ResolverMixIn):
         defined time, message will be stored.
         @param reuseId: string to reuse an existing stanza id if present;
         None to generate a random id.
+        @return: the stanza id, or None if the recipient is over the offline
+        quota (an error is sent back to the sender)
         """
-        return self.stanzadb.store(stanza, self.network, delayed, reuseId)
+        stanzaId = self.stanzadb.store(stanza, self.network, delayed, reuseId)
+        if stanzaId is None:
+            self.message_offline_rejected(stanza)
+        return stanzaId
+
+    def message_offline_rejected(self, stanza):
+        """Bounces a stanza refused by offline storage (recipient over quota)."""
+        log.debug("offline storage rejected stanza for %s" % (stanza['to'], ))
+        e = error.StanzaError('resource-constraint', 'wait')
+        self.dispatch(e.toResponse(stanza))
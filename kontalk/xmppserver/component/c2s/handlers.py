@@ -23,6 +23,7 @@ import time
 import base64
 import traceback
 
+from twisted.internet import reactor
 from twisted.words.protocols.jabber import xmlstream, jid
 from twisted.words.protocols.jabber.xmlstream import XMPPHandler
 from twisted.words.xish import domish
@@ -43,86 +44,163 @@ class InitialPresenceHandler(XMPPHandler):
 
     def send_presence(self, to):
         """
-        Sends all local presence data (available and unavailable) to the given
-        entity.
+        Sends local presence data (available and unavailable) to the given
+        remote c2s. The remote c2s is asked for the last presence version it
+        received from us, so that only changes after it are sent; if it doesn't
+        support presence sync, all presence data is sent. The reply also
+        tells if the remote c2s expands multicast envelopes.
         """
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
+        iq['from'] = self.xmlstream.thisEntity.full()
+        iq['to'] = to
+        iq.addElement((xmlstream2.NS_PRESENCE_SYNC, 'sync'))
+
+        def _result(stanza):
+            stanza.consumed = True
+            if not timeout.active():
+                return
+            timeout.cancel()
 
-        def _db(presence, to):
-            from copy import deepcopy
-            log.debug("presence: %r" % (presence, ))
-            if type(presence) == list and len(presence) > 0:
-
-                for user in presence:
-                    response_from = util.userid_to_jid(user['userid'], self.parent.xmlstream.thisEntity.host).full()
-
-                    num_avail = 0
-                    try:
-                        streams = self.parent.sfactory.streams[user['userid']]
-                        for x in streams.itervalues():
-                            presence = x._presence
-                            if presence and not presence.hasAttribute('type'):
-                                response = domish.Element((None, 'presence'))
-                                response['to'] = to
-                                response['from'] = presence['from']
-
-                                # copy stuff
-                                for child in ('status', 'show', 'priority'):
-                                    e = getattr(presence, child)
-                                    if e:
-                                        response.addChild(deepcopy(e))
-
-                                self.send(response)
-
-                                num_avail += 1
-                    except KeyError:
-                        pass
-
-                    # no available resources - send unavailable presence
-                    if not num_avail:
-                        response = domish.Element((None, 'presence'))
-                        response['to'] = to
-                        response['from'] = response_from
-
-                        if user['status'] is not None:
-                            response.addElement((None, 'status'), content=user['status'])
-                        if user['show'] is not None:
-                            response.addElement((None, 'show'), content=user['show'])
-
-                        response['type'] = 'unavailable'
-                        delay = domish.Element(('urn:xmpp:delay', 'delay'))
-                        delay['stamp'] = user['timestamp'].strftime(xmlstream2.XMPP_STAMP_FORMAT)
-                        response.addChild(delay)
+            since = None
+            multicast = False
+            if stanza['type'] == 'result' and stanza.sync:
+                try:
+                    since = long(stanza.sync['version'])
+                except (KeyError, ValueError):
+                    pass
+                for feature in stanza.sync.elements(None, 'feature'):
+                    if feature.getAttribute('var') == xmlstream2.NS_XMPP_ADDRESS:
+                        multicast = True
+            self.parent.set_multicast(to, multicast)
+            self.sync_presence(to, since)
+
+        def _timeout():
+            self.xmlstream.removeObserver(query, _result)
+            log.debug("no presence sync reply from %s" % (to, ))
+            self.parent.set_multicast(to, False)
+            self.sync_presence(to, None)
+
+        query = "/iq[@id='%s']" % (iq['id'], )
+        self.xmlstream.addOnetimeObserver(query, _result, 500)
+        timeout = reactor.callLater(self.parent.PRESENCE_SYNC_TIMEOUT, _timeout)
+        self.send(iq)
+
+    def sync_presence(self, to, since):
+        """
+        Streams presence data changed after version since to the given remote
+        c2s, in chunks. If since is None, all presence data is sent and the
+        remote c2s isn't told the version it reached.
+        """
+        db = self.parent.presencedb
+        pageSize = self.parent.PRESENCE_SYNC_PAGE_SIZE
+
+        def start(snapshot):
+            after = since
+            if after is None or after > snapshot:
+                # unknown peer or newer than our data (e.g. restored database)
+                after = 0
+            log.debug("sending presence changes (%d..%d) to %s" % (after, snapshot, to))
+            page(after, snapshot)
+
+        def page(after, snapshot):
+            d = db.get_changes(after, pageSize, snapshot)
+            d.addCallback(next_page, snapshot)
+
+        def next_page(presence, snapshot):
+            for user in presence:
+                self.send_user_presence(user, to)
+
+            if len(presence) >= pageSize:
+                # give other streams some room before the next chunk
+                reactor.callLater(self.parent.PRESENCE_SYNC_DELAY, page, (presence[-1]['version'], presence[-1]['userid']), snapshot)
+            elif since is not None:
+                done(snapshot)
+
+        def done(snapshot):
+            iq = domish.Element((None, 'iq'))
+            iq['type'] = 'set'
+            iq['id'] = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
+            iq['from'] = self.xmlstream.thisEntity.full()
+            iq['to'] = to
+            sync = iq.addElement((xmlstream2.NS_PRESENCE_SYNC, 'sync'))
+            sync['version'] = str(snapshot)
+            self.xmlstream.addOnetimeObserver("/iq[@id='%s']" % (iq['id'], ), self.parent.consume, 500)
+            self.send(iq)
+
+        d = db.sync_version()
+        d.addCallback(start)
+
+    def send_user_presence(self, user, to):
+        """Sends presence data and vCard of a local user to the given entity."""
+        response_from = util.userid_to_jid(user['userid'], self.parent.xmlstream.thisEntity.host).full()
+
+        num_avail = 0
+        try:
+            streams = self.parent.sfactory.streams[user['userid']]
+            for x in streams.itervalues():
+                presence = x._presence
+                if presence and not presence.hasAttribute('type'):
+                    response = domish.Element((None, 'presence'))
+                    response['to'] = to
+                    response['from'] = presence['from']
+
+                    # copy stuff
+                    for child in ('status', 'show', 'priority'):
+                        e = getattr(presence, child)
+                        if e:
+                            response.addElement((None, child), content=unicode(e))
 
-                        self.send(response)
+                    self.send(response)
 
-                    if self.parent.logTraffic:
-                        log.debug("presence sent: %s" % (response.toXml().encode('utf-8'), ))
-                    else:
-                        log.debug("presence sent: %s" % (response['from'], ))
-
-                    # send vcard
-                    iq_vcard = domish.Element((None, 'iq'))
-                    iq_vcard['type'] = 'set'
-                    iq_vcard['from'] = response_from
-                    iq_vcard['to'] = to
-
-                    # add vcard
-                    vcard = iq_vcard.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
-                    if user['fingerprint']:
-                        pub_key = self.parent.keyring.get_key(user['userid'], user['fingerprint'])
-                        if pub_key:
-                            vcard_key = vcard.addElement((None, 'key'))
-                            vcard_data = vcard_key.addElement((None, 'uri'))
-                            vcard_data.addContent("data:application/pgp-keys;base64," + base64.b64encode(pub_key))
-
-                    self.send(iq_vcard)
-                    if self.parent.logTraffic:
-                        log.debug("vCard sent: %s" % (iq_vcard.toXml().encode('utf-8'), ))
-                    else:
-                        log.debug("vCard sent: %s" % (iq_vcard['from'], ))
+                    num_avail += 1
+        except KeyError:
+            pass
 
-        d = self.parent.presencedb.get_all()
-        d.addCallback(_db, to)
+        # no available resources - send unavailable presence
+        if not num_avail:
+            response = domish.Element((None, 'presence'))
+            response['to'] = to
+            response['from'] = response_from
+
+            if user['status'] is not None:
+                response.addElement((None, 'status'), content=user['status'])
+            if user['show'] is not None:
+                response.addElement((None, 'show'), content=user['show'])
+
+            response['type'] = 'unavailable'
+            delay = domish.Element(('urn:xmpp:delay', 'delay'))
+            delay['stamp'] = user['timestamp'].strftime(xmlstream2.XMPP_STAMP_FORMAT)
+            response.addChild(delay)
+
+            self.send(response)
+
+        if self.parent.logTraffic:
+            log.debug("presence sent: %s" % (response.toXml().encode('utf-8'), ))
+        else:
+            log.debug("presence sent: %s" % (response['from'], ))
+
+        # send vcard
+        iq_vcard = domish.Element((None, 'iq'))
+        iq_vcard['type'] = 'set'
+        iq_vcard['from'] = response_from
+        iq_vcard['to'] = to
+
+        # add vcard
+        vcard = iq_vcard.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
+        if user['fingerprint']:
+            pub_key = self.parent.keyring.get_key(user['userid'], user['fingerprint'])
+            if pub_key:
+                vcard_key = vcard.addElement((None, 'key'))
+                vcard_data = vcard_key.addElement((None, 'uri'))
+                vcard_data.addContent("data:application/pgp-keys;base64," + base64.b64encode(pub_key))
+
+        self.send(iq_vcard)
+        if self.parent.logTraffic:
+            log.debug("vCard sent: %s" % (iq_vcard.toXml().encode('utf-8'), ))
+        else:
+            log.debug("vCard sent: %s" % (iq_vcard['from'], ))
 
     def presence(self, stanza):
         """
@@ -138,7 +216,7 @@ class InitialPresenceHandler(XMPPHandler):
             unused, host = util.jid_component(stanza['from'], util.COMPONENT_C2S)
 
             if host != self.parent.servername and host in self.parent.keyring.hostlist():
-                log.debug("remote c2s appeared, sending all local presence and vCards to %s" % (stanza['from'], ))
+                log.debug("remote c2s appeared, sending local presence and vCards to %s" % (stanza['from'], ))
                 self.send_presence(stanza['from'])
 
         except:
@@ -197,8 +275,122 @@ class InitialPresenceHandler(XMPPHandler):
                     log.debug("offline message delivery failed (%s)" % (msg['id'], ))
                     traceback.print_exc()
 
-        d = self.parent.stanzadb.get_by_recipient(sender)
-        d.addCallback(output, sender)
+        def page(after):
+            pageSize = self.parent.OFFLINE_PAGE_SIZE
+            d = self.parent.stanzadb.get_by_recipient(sender, after, pageSize)
+            d.addCallback(next_page, pageSize)
+
+        def next_page(data, pageSize):
+            output(data, sender)
+            cursors = [msg['cursor'] for msg in data if 'cursor' in msg]
+            if len(cursors) >= pageSize:
+                # let the reactor run before fetching the next page
+                reactor.callLater(0, page, cursors[-1])
+
+        page(None)
+
+
+class PresenceSyncHandler(XMPPHandler):
+    """
+    Answers presence sync requests from remote c2s, keeping track of the last
+    presence version received from each of them.
+    @type parent: L{C2SManager}
+    """
+
+    def connectionInitialized(self):
+        self.xmlstream.addObserver("/iq[@type='get']/sync[@xmlns='%s']" % (xmlstream2.NS_PRESENCE_SYNC, ), self.query, 100)
+        self.xmlstream.addObserver("/iq[@type='set']/sync[@xmlns='%s']" % (xmlstream2.NS_PRESENCE_SYNC, ), self.update, 100)
+
+    def _host(self, stanza):
+        """Returns the remote c2s server name of the sender, or None."""
+        try:
+            unused, host = util.jid_component(stanza['from'], util.COMPONENT_C2S)
+            if host != self.parent.servername and host in self.parent.keyring.hostlist():
+                return host
+        except:
+            pass
+
+    def query(self, stanza):
+        """Replies with the last presence version received from the sender."""
+        stanza.consumed = True
+        host = self._host(stanza)
+        if host:
+            response = xmlstream.toResponse(stanza, 'result')
+            sync = response.addElement((xmlstream2.NS_PRESENCE_SYNC, 'sync'))
+            sync['version'] = str(self.parent.presence_versions.get(host, 0))
+            # we expand multicast envelopes (see MulticastHandler)
+            sync.addElement((None, 'feature'))['var'] = xmlstream2.NS_XMPP_ADDRESS
+        else:
+            response = xmlstream.toResponse(stanza, 'error')
+        self.send(response)
+
+    def update(self, stanza):
+        """Stores the presence version reached by a completed sync."""
+        stanza.consumed = True
+        host = self._host(stanza)
+        try:
+            version = long(stanza.sync['version'])
+        except (KeyError, ValueError):
+            host = None
+
+        if host:
+            log.debug("presence from %s synced to version %d" % (host, version))
+            self.parent.presence_versions[host] = version
+            response = xmlstream.toResponse(stanza, 'result')
+        else:
+            response = xmlstream.toResponse(stanza, 'error')
+        self.send(response)
+
+
+class MulticastHandler(XMPPHandler):
+    """
+    Expands multicast envelopes from remote c2s: a stanza for many local
+    recipients, listed in an XEP-0033 addresses element.
+    @type parent: L{C2SManager}
+    """
+
+    def connectionInitialized(self):
+        self.xmlstream.addObserver("/stanza/addresses[@xmlns='%s']" % (xmlstream2.NS_XMPP_ADDRESS, ), self.expand, 100)
+
+    def expand(self, envelope):
+        envelope.consumed = True
+        try:
+            unused, host = util.jid_component(envelope['from'], util.COMPONENT_C2S)
+            if host == self.parent.servername or host not in self.parent.keyring.hostlist():
+                raise ValueError(host)
+        except:
+            log.debug("ignoring multicast envelope from %s" % (envelope.getAttribute('from'), ))
+            return
+
+        stanza = None
+        for child in envelope.elements():
+            if child.name != 'addresses':
+                stanza = child
+                break
+        if stanza is None:
+            return
+
+        # the copies don't go through the presence cache observers
+        if stanza.name == 'presence' and util.jid_user(stanza['from']):
+            ptype = stanza.getAttribute('type')
+            if ptype is None:
+                self.parent.cache.user_available(stanza)
+            elif ptype == 'unavailable':
+                self.parent.cache.user_unavailable(stanza)
+
+        for address in envelope.addresses.elements(xmlstream2.NS_XMPP_ADDRESS, 'address'):
+            if address.getAttribute('type') != 'to' or not address.hasAttribute('jid'):
+                continue
+            to = jid.JID(address['jid'])
+            # local recipients only
+            if not util.jid_local(util.COMPONENT_C2S, self.parent, to):
+                continue
+            stanza['to'] = address['jid']
+            if address.hasAttribute('original-to'):
+                stanza['original-to'] = address['original-to']
+            elif stanza.hasAttribute('original-to'):
+                del stanza['original-to']
+            self.parent.dispatch(stanza)
 
 
 class PresenceProbeHandler(XMPPHandler):
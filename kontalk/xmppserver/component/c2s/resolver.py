@@ -21,29 +21,36 @@
 
 import time
 import base64
-from datetime import datetime
-from copy import deepcopy
 
 from twisted.python import failure
-from twisted.internet import defer, reactor, task, threads
+from twisted.internet import defer, task, threads
 from twisted.words.protocols.jabber.xmlstream import XMPPHandler
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber import jid, error, xmlstream
 
 from wokkel import component
 
-from kontalk.xmppserver import log, storage, util, xmlstream2, version, keyring
+from kontalk.xmppserver import log, storage, util, xmlstream2, version, keyring, timer
 
 
 
 class PresenceStub(object):
-    """VERY UNOPTIMIZED CLASS"""
+    """
+    Cached presence of a user.
+    Only the presence fields are kept: show, status, priority and delay
+    (as the XMPP stamp string, which sorts chronologically) of the last
+    presence, and the same fields for each available resource. Presence
+    stanzas are built on demand and can be modified by the caller.
+    """
+
+    __slots__ = ('jid', 'type', 'show', 'status', 'priority', 'delay', '_avail')
 
     def __init__(self, _jid):
         """Creates a presence stub for a bare JID."""
         if _jid.resource:
             raise ValueError('not a bare JID.')
-        self._avail = {}
+        # (resource, host, show, status, priority, delay) for each available resource
+        self._avail = []
         self.jid = _jid
         self.type = None
         self.show = None
@@ -55,28 +62,13 @@ class PresenceStub(object):
         if name == 'type':
             self.type = value
         elif name == 'show':
-            if value in ['away', 'xa', 'chat', 'dnd']:
-                self.show = value
-            else:
-                self.show = None
+            self.show = _parse_show(value)
         elif name == 'status':
-            if value:
-                if isinstance(value, unicode):
-                    self.status = value
-                else:
-                    self.status = value.decode('utf-8')
-            else:
-                self.status = None
+            self.status = _parse_status(value)
         elif name == 'priority':
-            try:
-                self.priority = int(value)
-            except:
-                self.priority = 0
+            self.priority = _parse_priority(value)
         elif name == 'delay':
-            try:
-                self.delay = datetime.strptime(value, xmlstream2.XMPP_STAMP_FORMAT)
-            except:
-                self.delay = None
+            self.delay = _parse_stamp(value)
         else:
             raise AttributeError(name)
 
@@ -91,18 +83,8 @@ class PresenceStub(object):
 
         delay = stanza.delay
         if delay:
-            delay = datetime.strptime(delay['stamp'], xmlstream2.XMPP_STAMP_FORMAT)
-            if self.delay:
-                diff = delay - self.delay
-                try:
-                    diff_seconds = diff.total_seconds()
-                except AttributeError:
-                    diff_seconds = (diff.microseconds + (diff.seconds + diff.days * 24 * 3600) * 10**6) / 10**6
-            else:
-                # no delay :)
-                diff_seconds = 1
-
-            if diff_seconds >= 0:
+            delay = _parse_stamp(delay.getAttribute('stamp'))
+            if delay is not None and (self.delay is None or delay >= self.delay):
                 ujid = jid.JID(stanza['from'])
                 # update local jid
                 self.jid = ujid.userhostJID()
@@ -130,53 +112,72 @@ class PresenceStub(object):
         # update local jid
         self.jid = ujid.userhostJID()
 
-        # recreate presence stanza for local use
-        presence = domish.Element((None, 'presence'))
-        for attr in ('type', 'from'):
-            if stanza.hasAttribute(attr):
-                presence[attr] = stanza[attr]
-
         if stanza.hasAttribute('type'):
             self.type = stanza['type']
         else:
             self.type = None
 
-        for child in ('status', 'show', 'priority', 'delay'):
+        # fields of this resource: only the ones found in the stanza
+        fields = [None, None, 0, None]
+        for i, child in enumerate(('show', 'status', 'priority', 'delay')):
             e = getattr(stanza, child)
             if e:
-                self.__set__(child, e.__str__())
-                presence.addChild(e)
+                if child == 'delay':
+                    value = e.getAttribute('stamp')
+                else:
+                    value = e.__str__()
+                self.__set__(child, value)
+                fields[i] = getattr(self, child)
 
-        self._avail[ujid.resource] = presence
+        self._remove(ujid.resource)
+        # few hosts in the network: share their strings
+        self._avail.append((ujid.resource, intern(ujid.host.encode('utf-8'))) + tuple(fields))
+
+    def _remove(self, resource):
+        for i, avail in enumerate(self._avail):
+            if avail[0] == resource:
+                return self._avail.pop(i)
 
     def pop(self, resource):
         """Pop the presence for the given resource from this stub."""
-        try:
-            presence = self._avail[resource]
-            del self._avail[resource]
-
+        avail = self._remove(resource)
+        if avail is not None:
             # no more presences - resource is now unavailable
             if len(self._avail) == 0:
                 self.type = 'unavailable'
                 # update delay with now
-                self.delay = datetime.utcnow()
+                self.delay = time.strftime(xmlstream2.XMPP_STAMP_FORMAT, time.gmtime())
 
-            return presence
-        except KeyError:
-            pass
+            return self._resourceElement(avail)
+
+    def _resourceElement(self, avail):
+        presence = domish.Element((None, 'presence'))
+        presence['from'] = self._resourceJID(avail).full()
+        unused, unused, show, status, priority, delay = avail
+        if status:
+            presence.addElement((None, 'status'), content=status)
+        if show:
+            presence.addElement((None, 'show'), content=show)
+        if priority != 0:
+            presence.addElement((None, 'priority'), content=str(priority))
+        if delay:
+            d = presence.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+            d['stamp'] = delay
+        return presence
 
     def presence(self):
+        """Returns new presence stanzas for available resources, or the last presence."""
         if self.available():
-            return self._avail.values()
+            return [self._resourceElement(avail) for avail in self._avail]
         else:
             return (self.toElement(), )
 
     def jids(self):
         """Returns a list of available resources from this JID."""
-        users = []
-        for avail in self._avail.itervalues():
-            users.append(jid.JID(avail['from']))
-        return users
+        return [self._resourceJID(avail) for avail in self._avail]
+
+    def _resourceJID(self, avail):
+        return jid.JID(tuple=(self.jid.user, avail[1], avail[0]))
 
     def available(self):
         """Returns true if available presence count is greater than 0."""
@@ -237,11 +238,39 @@ class PresenceStub(object):
             p.addElement((None, 'status'), content=self.status)
         if self.delay:
             d = p.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
-            d['stamp'] = self.delay.strftime(xmlstream2.XMPP_STAMP_FORMAT)
+            d['stamp'] = self.delay
 
         return p
 
 
+def _parse_show(value):
+    if value in ('away', 'xa', 'chat', 'dnd'):
+        return intern(value)
+    return None
+
+def _parse_status(value):
+    if value:
+        if isinstance(value, unicode):
+            return value
+        return value.decode('utf-8')
+    return None
+
+def _parse_priority(value):
+    try:
+        return int(value)
+    except:
+        return 0
+
+def _parse_stamp(value):
+    """Validates a delay stamp: stamps are kept as strings."""
+    if value and len(value) == 20 and value[4] == '-' and value[10] == 'T' and value[19] == 'Z':
+        return str(value)
+    try:
+        return time.strftime(xmlstream2.XMPP_STAMP_FORMAT, time.strptime(value, xmlstream2.XMPP_STAMP_FORMAT))
+    except:
+        return None
+
+
 class JIDCache(XMPPHandler):
     """
     Cache maintaining JID distributed in this Kontalk network.
@@ -300,6 +329,8 @@ class JIDCache(XMPPHandler):
             unused, host = util.jid_component(stanza['from'], util.COMPONENT_C2S)
             if host in self.parent.keyring.hostlist():
                 log.debug("server %s is disconnecting, taking over presence data" % (host, ))
+                # it will advertise multicast support again when it's back
+                self.parent.set_multicast(stanza['from'], False)
                 ordered_presence = []
                 for stub in self.presence_cache.itervalues():
                     if stub.jid.host == stanza['from']:
@@ -438,8 +469,7 @@ class JIDCache(XMPPHandler):
         if stub:
             data = stub.presence()
             i = len(data)
-            for x in data:
-                presence = deepcopy(x)
+            for presence in data:
                 presence.consumed = True
                 presence['to'] = sender.full()
 
@@ -607,7 +637,7 @@ class JIDCache(XMPPHandler):
             buf = []
 
             # timeout of request
-            timeout = reactor.callLater(self.MAX_LOOKUP_TIMEOUT*wait_factor*len(idList), _abort, stanzaId=stanzaId, callback=d, buf=buf)
+            timeout = timer.wheel.callLater(self.MAX_LOOKUP_TIMEOUT*wait_factor*len(idList), _abort, stanzaId=stanzaId, callback=d, buf=buf)
 
             # add stanza group observer
             self.xmlstream.addObserver("/presence/group[@id='%s']" % (stanzaId, ), _presence, 150, callback=d, timeout=timeout, buf=buf)
@@ -808,6 +838,97 @@ class PresenceHandler(XMPPHandler):
         self.parent.broadcastSubscribers(stanza)
 
 
+class SubscriptionGraph(object):
+    """
+    Presence subscriptions, indexed both ways: the subscribers of each
+    watched user and the users watched by each subscriber, so cancelling
+    all subscriptions of a user costs as much as the subscriptions it has.
+    JIDs are interned: each one is kept once in memory however many
+    subscriptions it is part of, and dropped with its last subscription.
+    """
+
+    __slots__ = ('_subscribers', '_watched', '_jids')
+
+    def __init__(self):
+        # watched: set of subscribers
+        self._subscribers = {}
+        # subscriber: set of watched
+        self._watched = {}
+        # interned JIDs: [JID, number of subscriptions]
+        self._jids = {}
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def __contains__(self, watched):
+        return watched in self._subscribers
+
+    def subscribers(self, watched):
+        """Returns the subscribers of a user (do not modify)."""
+        return self._subscribers.get(watched, ())
+
+    def watched(self, subscriber):
+        """Returns the users watched by a subscriber (do not modify)."""
+        return self._watched.get(subscriber, ())
+
+    def add(self, watched, subscriber):
+        """
+        Subscribes a user to another one.
+        @return: False if the subscription was already there
+        """
+        subs = self._subscribers.get(watched)
+        if subs and subscriber in subs:
+            return False
+        watched = self._intern(watched)
+        subscriber = self._intern(subscriber)
+        self._subscribers.setdefault(watched, set()).add(subscriber)
+        self._watched.setdefault(subscriber, set()).add(watched)
+        return True
+
+    def remove(self, watched, subscriber):
+        """
+        Removes a subscription.
+        @return: False if there was no such subscription
+        """
+        subs = self._subscribers.get(watched)
+        if not subs or subscriber not in subs:
+            return False
+        self._unlink(self._subscribers, watched, subscriber)
+        self._unlink(self._watched, subscriber, watched)
+        self._release(watched)
+        self._release(subscriber)
+        return True
+
+    def remove_subscriber(self, subscriber):
+        """Removes all subscriptions of a subscriber."""
+        for watched in self._watched.pop(subscriber, ()):
+            self._unlink(self._subscribers, watched, subscriber)
+            self._release(watched)
+            self._release(subscriber)
+
+    def _unlink(self, index, key, value):
+        values = index[key]
+        values.discard(value)
+        if not values:
+            del index[key]
+
+    def _intern(self, _jid):
+        """Returns the interned copy of a JID, counting a new subscription."""
+        entry = self._jids.get(_jid)
+        if entry is None:
+            # callers may modify their JID later
+            entry = self._jids[_jid] = [jid.JID(tuple=(_jid.user, _jid.host, _jid.resource)), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release(self, _jid):
+        """Counts a removed subscription, dropping the JID with the last one."""
+        entry = self._jids[_jid]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._jids[_jid]
+
+
 class ResolverMixIn():
 
     _protocolHandlers = (
@@ -833,7 +954,7 @@ class ResolverMixIn():
         self.privacy = None
 
         # active subscriptions
-        self.subscriptions = {}
+        self.subscriptions = SubscriptionGraph()
         # whitelists
         self.whitelists = {}
         # blacklists
@@ -918,10 +1039,7 @@ class ResolverMixIn():
 
     def cancelSubscriptions(self, user):
         """Cancel all subscriptions requested by the given user."""
-        for rlist in self.subscriptions.itervalues():
-            for sub in list(rlist):
-                if sub == user:
-                    rlist.remove(sub)
+        self.subscriptions.remove_subscriber(user)
 
     def subscribe(self, jid_from, jid_to, gid=None, send_subscribed=True):
         if jid_to.host == self.network and not self.cache.lookup(jid_to):
@@ -967,11 +1085,7 @@ class ResolverMixIn():
         """Subscribe a given user to events from another one."""
 
         if not response_only:
-            try:
-                if subscriber not in self.subscriptions[to]:
-                    self.subscriptions[to].append(subscriber)
-            except:
-                self.subscriptions[to] = [subscriber]
+            self.subscriptions.add(to, subscriber)
 
         if send_subscribed:
             # send subscription accepted immediately
@@ -1006,14 +1120,7 @@ class ResolverMixIn():
 
     def unsubscribe(self, to, subscriber):
         """Unsubscribe a given user from events from another one."""
-        try:
-            self.subscriptions[to].remove(subscriber)
-
-            # clean up
-            if len(self.subscriptions[to]) == 0:
-                del self.subscriptions[to]
-        except:
-            pass
+        self.subscriptions.remove(to, subscriber)
 
     def broadcastSubscribers(self, stanza):
         """Broadcast stanza to JID subscribers."""
@@ -1043,22 +1150,31 @@ class ResolverMixIn():
         if bareWatched in self.subscriptions:
             #stanza['from'] = watched.full()
 
+            allowed = []
             removed = []
-            for sub in self.subscriptions[bareWatched]:
-                if self.is_presence_allowed(sub, watched) == 1:
-                    log.debug("notifying subscriber %s" % (sub, ))
-                    stanza['to'] = sub.userhost()
-                    # direct delivery to workaround presence loops
-                    stanza.addElement((xmlstream2.NS_XMPP_DIRECT, 'direct'))
-                    stanza.consumed = True
-                    self.send(stanza)
+            for sub, result in self.is_presence_allowed_batch(self.subscriptions.subscribers(bareWatched), watched):
+                if result == 1:
+                    allowed.append(sub)
                 else:
                     log.debug("%s is not allowed to see presence" % (sub, ))
                     removed.append(sub)
 
             # remove unauthorized users
             for e in removed:
-                self.subscriptions[bareWatched].remove(e)
+                self.subscriptions.remove(bareWatched, e)
+
+            if allowed:
+                # direct delivery to workaround presence loops
+                stanza.addElement((xmlstream2.NS_XMPP_DIRECT, 'direct'))
+                stanza.consumed = True
+                self.fanout(stanza, allowed)
+
+    def fanout(self, stanza, subscribers):
+        """Sends a presence stanza to the given subscribers."""
+        for sub in subscribers:
+            log.debug("notifying subscriber %s" % (sub, ))
+            stanza['to'] = sub.userhost()
+            self.send(stanza)
 
     def _broadcast_privacy_list_change(self, dest, src, node):
         # broadcast to all resolvers
@@ -1146,6 +1262,38 @@ class ResolverMixIn():
         except KeyError:
             return None
 
+    def is_presence_allowed_batch(self, requesters, jid_to):
+        """
+        Same as L{is_presence_allowed} for many requesters of the same user,
+        looking up the user and its privacy lists once.
+        @return: list of (requester, result) tuples
+        """
+        if not self.cache.lookup(jid_to):
+            return [(jid_from, -2) for jid_from in requesters]
+
+        translated_to = self.translateJID(jid_to, False)
+        bl = self.blacklists.get(jid_to.user, ())
+        wl = self.whitelists.get(jid_to.user, ())
+
+        out = []
+        for jid_from in requesters:
+            if not jid_from.user:
+                # servers are allowed to subscribe to user presence
+                result = 1
+            else:
+                translated = self.translateJID(jid_from, False)
+                userhost = translated.userhost()
+                if translated == translated_to:
+                    result = 1
+                elif userhost in bl:
+                    result = -1
+                elif userhost in wl:
+                    result = 1
+                else:
+                    result = 0
+            out.append((jid_from, result))
+        return out
+
     def is_presence_allowed(self, jid_from, jid_to):
         """
         Checks if requester (from) is allowed to see a user's (to) presence.
@@ -363,6 +363,11 @@ class NetService(object):
         self._outgoingStreams[otherHost] = xs
         xs.addObserver(xmlstream.STREAM_END_EVENT,
                        lambda _: self.outgoingDisconnected(xs))
+
+        # disabled while connecting
+        if otherHost not in self.keyring.hostlist():
+            self.disconnectServer(otherHost)
+            return
         xs.addObserver('/*', self.onElement, 0, xs)
         xs.addObserver("/presence[not(@type)]", self.onPresenceAvailable, 100, xs)
         xs.addObserver("/presence[@type='unavailable']", self.onPresenceUnavailable, 100, xs)
@@ -383,6 +388,13 @@ class NetService(object):
         self.router.serverDisconnected(otherHost)
 
 
+    def disconnectServer(self, otherHost):
+        """Closes the stream with a server, e.g. when it is disabled."""
+        xs = self._outgoingStreams.get(otherHost)
+        if xs is not None:
+            log.info("disconnecting from %s" % (otherHost, ))
+            xs.sendStreamError(error.StreamError('not-authorized'))
+
     def initiateOutgoingStream(self, otherHost):
         """
         Initiate an outgoing XMPP server-to-server connection.
@@ -415,6 +427,9 @@ class NetService(object):
 
     def validateConnection(self, xs):
         otherHost = xs.otherEntity.host
+        if otherHost not in self.keyring.hostlist():
+            xs.sendStreamError(error.StreamError('not-authorized'))
+            return False
         if otherHost in self._outgoingStreams:
             xs.sendStreamError(error.StreamError('conflict'))
             return False
@@ -541,7 +556,8 @@ class NetComponent(xmlstream2.SocketComponent):
         cred = auth.OpenPGPKontalkCredentials(cert, key, str(self.config['pgp_keyring']))
         cred.verify_peer = True
 
-        ring = keyring.Keyring(storage.MySQLNetworkStorage(), self.config['fingerprint'], self.network, self.servername, disable_cache=True)
+        ring = keyring.Keyring(storage.network_storage(), self.config['fingerprint'], self.network, self.servername, disable_cache=True)
+        ring.add_listener(self._servers_changed)
         self.service = NetService(self.config, self, ring, cred)
         self.service.logTraffic = self.logTraffic
         self.sfactory = XMPPNetServerFactory(self.service)
@@ -576,6 +592,21 @@ class NetComponent(xmlstream2.SocketComponent):
         self.xmlstream.addObserver("/message", self.dispatch)
         self.xmlstream.addObserver("/stanza", self.dispatch)
 
+    def _servers_changed(self, added, removed):
+        """Disconnects disabled servers and connects to newly enabled ones."""
+        enabled = self.service.keyring.hostlist()
+        for host in removed.itervalues():
+            if host not in enabled:
+                self.service.disconnectServer(host)
+
+        # not connected to router yet: servers will be connected on login
+        if not self._initialized:
+            return
+
+        for host in added.itervalues():
+            if host != self.servername:
+                self.service.initiateOutgoingStream(host)
+
     def consume(self, stanza):
         stanza.consumed = True
         if self.logTraffic:
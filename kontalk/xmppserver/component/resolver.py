@@ -32,7 +32,7 @@ from twisted.words.protocols.jabber import jid, error, xmlstream
 
 from wokkel import component
 
-from kontalk.xmppserver import log, storage, util, xmlstream2, version, keyring
+from kontalk.xmppserver import log, storage, util, xmlstream2, version, keyring, timer
 
 
 class IQHandler(XMPPHandler):
@@ -130,7 +130,7 @@ class IQHandler(XMPPHandler):
                 callback = defer.Deferred()
                 callback.addCallback(found_latest, stanza)
                 # timeout of request
-                timeout = reactor.callLater(self.parent.cache.MAX_LOOKUP_TIMEOUT, _abort, stanzaId=lastIq['id'], data=data, callback=callback)
+                timeout = timer.wheel.callLater(self.parent.cache.MAX_LOOKUP_TIMEOUT, _abort, stanzaId=lastIq['id'], data=data, callback=callback)
                 # request observer
                 self.xmlstream.addObserver("/iq[@id='%s']" % lastIq['id'], find_latest, 100, data=data, callback=callback, timeout=timeout)
 
@@ -192,8 +192,8 @@ class Resolver(xmlstream2.SocketComponent):
         self.start_time = time.time()
 
         storage.init(config['database'])
-        self.keyring = keyring.Keyring(storage.MySQLNetworkStorage(), config['fingerprint'], self.network, self.servername, True)
-        self.presencedb = storage.MySQLPresenceStorage()
+        self.keyring = keyring.Keyring(storage.network_storage(), config['fingerprint'], self.network, self.servername, True)
+        self.presencedb = storage.presence_storage()
 
         self.subscriptions = {}
         self.whitelists = {}
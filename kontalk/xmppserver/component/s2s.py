@@ -197,7 +197,7 @@ class S2SComponent(xmlstream2.SocketComponent):
 
     def setup(self):
         storage.init(self.config['database'])
-        self.keyring = keyring.Keyring(storage.MySQLNetworkStorage(), self.config['fingerprint'], self.servername)
+        self.keyring = keyring.Keyring(storage.network_storage(), self.config['fingerprint'], self.servername)
 
         self.service = S2SService(self.config, self)
         self.service.logTraffic = self.logTraffic
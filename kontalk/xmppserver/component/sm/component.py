@@ -18,8 +18,12 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from copy import deepcopy
 
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 from twisted.words.protocols.jabber import error, jid, component, xmlstream
+from zope.interface import implements
 
 from gnutls.constants import OPENPGP_FMT_RAW, OPENPGP_FMT_BASE64
 
@@ -31,10 +35,13 @@ class C2SManager(xmlstream2.StreamManager):
     """
     Handles communication with a client. Note that this is the L{StreamManager}
     towards the client, not the router!!
+    It is also registered as a producer on the client transport, to know
+    when its write buffer is full (see L{drained}).
 
     @param router: the connection with the router
     @type router: L{xmlstream.StreamManager}
     """
+    implements(IPushProducer)
 
     namespace = 'jabber:client'
 
@@ -58,6 +65,8 @@ class C2SManager(xmlstream2.StreamManager):
         self.servername = servername
         self._presence = None
         self.compatibility_mode = False
+        self._paused = False
+        self._drain_waiters = []
         xmlstream2.StreamManager.__init__(self, xs)
 
         """
@@ -109,6 +118,7 @@ class C2SManager(xmlstream2.StreamManager):
         xs.removeObserver("/iq", self._unauthorized)
         xs.removeObserver("/presence", self._unauthorized)
         xs.removeObserver("/message", self._unauthorized)
+        xs.transport.registerProducer(self, True)
         self.factory.connectionInitialized(xs)
 
         # stanza server processing rules - before they are sent to handlers
@@ -119,6 +129,30 @@ class C2SManager(xmlstream2.StreamManager):
         # forward everything that is not handled
         xs.addObserver('/*', self.forward)
 
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def stopProducing(self):
+        # connection lost: waiters will find the client gone
+        self.resumeProducing()
+
+    def drained(self):
+        """
+        Returns a L{Deferred} fired when the transport write buffer is
+        below its limit again (immediately if it already is).
+        """
+        if not self._paused:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        return d
+
     def handle(self, stanza):
         # enforce sender
         stanza['from'] = self.resolveJID(self.xmlstream.otherEntity).full()
@@ -227,25 +261,57 @@ class C2SManager(xmlstream2.StreamManager):
             # initial presence found
             # negative resource
             # => DROP STANZA
-            try:
-                if not origTo.resource and int(str(self._presence.priority)) < 0:
-                    return None
-            except:
-                pass
+            if not origTo.resource and self._negative_priority():
+                return None
 
         # FIXME using deepcopy is not safe
-        from copy import deepcopy
         stanza = deepcopy(stanza)
 
-        util.resetNamespace(stanza, component.NS_COMPONENT_ACCEPT, self.namespace)
+        self.translate(stanza, self.network)
+
+        # force destination address
+        if self.xmlstream.otherEntity:
+            stanza['to'] = self.xmlstream.otherEntity.full()
+
+        if not stanza.hasAttribute('id'):
+            stanza['id'] = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
+        xmlstream2.StreamManager.send(self, stanza, force)
+
+    def send_template(self, template, original):
+        """
+        Sends a copy of a stanza serialized by L{template}, with the same
+        rules of L{send}.
+        @param original: the original recipient (original-to)
+        """
+        if self.router.logTraffic:
+            log.debug("sending stanza template to client %s (original was %s)" % (self.xmlstream.otherEntity, original))
+
+        # bare JID and negative priority => DROP STANZA
+        if '/' not in original and self._negative_priority():
+            return
+
+        to = self.xmlstream.otherEntity.full() if self.xmlstream.otherEntity else None
+        xmlstream2.StreamManager.send(self, template.render(to, util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)))
+
+    def _negative_priority(self):
+        """Returns true if the client initial presence has a negative priority."""
+        try:
+            return int(str(self._presence.priority)) < 0
+        except:
+            return False
+
+    @classmethod
+    def translate(cls, stanza, network):
+        """Translates a stanza coming from the router for clients, in place."""
+        util.resetNamespace(stanza, component.NS_COMPONENT_ACCEPT, cls.namespace)
 
         # translate sender to network JID
         sender = stanza.getAttribute('from')
-        if sender and sender != self.network:
+        if sender and sender != network:
             sender = jid.JID(stanza['from'])
-            sender.host = self.network
+            sender.host = network
             stanza['from'] = sender.full()
-        # TODO should we force self.network if no sender?
+        # TODO should we force network if no sender?
 
         # remove reserved elements
         if stanza.direct and stanza.direct.uri == xmlstream2.NS_XMPP_DIRECT:
@@ -265,13 +331,19 @@ class C2SManager(xmlstream2.StreamManager):
                 stanza.children.remove(c)
                 break
 
-        # force destination address
-        if self.xmlstream.otherEntity:
-            stanza['to'] = self.xmlstream.otherEntity.full()
-
-        if not stanza.hasAttribute('id'):
-            stanza['id'] = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
-        xmlstream2.StreamManager.send(self, stanza, force)
+    @classmethod
+    def template(cls, stanza, network):
+        """
+        Serializes a stanza coming from the router once for many clients
+        (see L{send_template}): only to and a missing id change between copies.
+        @rtype: L{xmlstream2.StanzaTemplate}
+        """
+        stanza = deepcopy(stanza)
+        for attr in ('to', 'original-to'):
+            if stanza.hasAttribute(attr):
+                del stanza[attr]
+        cls.translate(stanza, network)
+        return xmlstream2.StanzaTemplate(stanza, ('to', ) if stanza.hasAttribute('id') else ('to', 'id'), cls.namespace)
 
     def forward(self, stanza):
         """
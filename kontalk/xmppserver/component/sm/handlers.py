@@ -20,16 +20,14 @@
 
 
 import base64
-from copy import deepcopy
 
-from twisted.internet import reactor
 from twisted.words.protocols.jabber import error, jid, xmlstream
 from twisted.words.protocols.jabber.xmlstream import XMPPHandler
 from twisted.words.xish import domish
 
 from wokkel import xmppim
 
-from kontalk.xmppserver import log, xmlstream2, version, util, push, upload, tls, keyring
+from kontalk.xmppserver import log, xmlstream2, version, util, push, upload, tls, keyring, timer
 
 
 class PresenceHandler(XMPPHandler):
@@ -184,7 +182,7 @@ class PingHandler(XMPPHandler):
         """
         self.xmlstream.addObserver("/iq[@type='get']/ping[@xmlns='%s']" % (xmlstream2.NS_XMPP_PING, ), self.ping, 600)
         # first ping request
-        self.pinger = reactor.callLater(self.PING_DELAY, self._ping)
+        self.pinger = timer.wheel.callLater(self.PING_DELAY, self._ping)
 
     def connectionLost(self, reason):
         XMPPHandler.connectionLost(self, reason)
@@ -207,7 +205,7 @@ class PingHandler(XMPPHandler):
         self.send(ping)
         # setup ping timeout
         self.pinger = None
-        self.ping_timeout = reactor.callLater(self.PING_TIMEOUT, self._timeout)
+        self.ping_timeout = timer.wheel.callLater(self.PING_TIMEOUT, self._timeout)
         # observe pong
         self.xmlstream.addObserver("/iq[@type='result'][@id='%s']" % (ping['id'], ), self.pong, 600)
 
@@ -238,7 +236,7 @@ class PingHandler(XMPPHandler):
         # consume stanza
         stanza.consumed = True
         # restart pinger
-        self.pinger = reactor.callLater(self.PING_DELAY, self._ping)
+        self.pinger = timer.wheel.callLater(self.PING_DELAY, self._ping)
 
     def features(self):
         return (xmlstream2.NS_XMPP_PING, )
@@ -515,7 +513,6 @@ class RosterHandler(XMPPHandler):
             i = sum([len(x) for x in probes])
             for presence_list in probes:
                 for presence in presence_list:
-                    presence = deepcopy(presence)
                     presence['to'] = stanza['from']
                     group = presence.addElement((xmlstream2.NS_XMPP_STANZA_GROUP, 'group'))
                     group['id'] = gid
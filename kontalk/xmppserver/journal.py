@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Append-only journal for delayed offline storage."""
+"""
+  Kontalk XMPP server
+  Copyright (C) 2014 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+
+try:
+    from collections import OrderedDict
+except:
+    from ordereddict import OrderedDict
+
+from twisted.internet import reactor
+
+from mailbox import pack_record, unpack_record, iter_records
+import util, log
+
+
+class Journal(object):
+    """
+    Stanzas waiting for delayed storage.
+    Records use the mailbox format (see L{pack_record}), with the network in
+    place of the sender; a record with no content removes a stanza. Writes
+    are synced to disk in batches. The file is truncated when no stanza is
+    left and rewritten when removed records take most of it.
+    Live records are kept in memory; file I/O runs in a writer thread, in
+    the same order it is requested.
+    """
+
+    """Maximum seconds between a write and its sync to disk."""
+    SYNC_DELAY = 0.1
+    """Journal size above which removed records are dropped."""
+    COMPACT_SIZE = 4 << 20
+
+    def __init__(self, filename):
+        self.filename = filename
+        # stanza id: record
+        self.live = OrderedDict()
+        self.size = 0
+        self._sync = None
+        # used by the writer thread only, once started
+        self._file = None
+        self._closed = False
+        self._load()
+        # drop removed and truncated records left from the last run
+        self.size = self._do_rewrite(self.live.values())
+        self._writer = util.SerialThread('journal')
+
+    def _load(self):
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return
+        try:
+            buf = f.read()
+        finally:
+            f.close()
+
+        for offset, rec in iter_records(buf):
+            stanzaId, content = rec[0], rec[4]
+            self.live.pop(stanzaId, None)
+            if content:
+                self.live[stanzaId] = buf[offset:rec[-1]]
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, stanzaId):
+        return stanzaId in self.live
+
+    def entries(self):
+        """Yields (stanzaId, network, timestamp, expire, content) of live stanzas."""
+        for record in self.live.values():
+            yield unpack_record(record, 0)[:5]
+
+    def append(self, stanzaId, network, expire, content):
+        """
+        Records a stanza, replacing any previous one with the same id.
+        @return: the record, see L{remove}
+        """
+        record = pack_record(stanzaId, network, int(time.time()*1e3), expire, content)
+        self._write(record)
+        self.live.pop(stanzaId, None)
+        self.live[stanzaId] = record
+        return record
+
+    def remove(self, stanzaId, record=None):
+        """
+        Records the removal of a stanza.
+        @param record: if given, the stanza is removed only if it wasn't
+        recorded again since L{append} returned this record
+        """
+        if self._closed:
+            # the stanza will be stored again on next startup
+            return False
+
+        current = self.live.get(stanzaId)
+        if current is None or (record is not None and current is not record):
+            return False
+
+        del self.live[stanzaId]
+        if not self.live:
+            self._truncate()
+        elif self.size > self.COMPACT_SIZE and sum(len(r) for r in self.live.itervalues()) < self.size / 2:
+            self._rewrite()
+        else:
+            self._write(pack_record(stanzaId, '', 0, 0, ''))
+        return True
+
+    def _run(self, func, *args):
+        return self._writer.run(func, *args).addErrback(self._failed)
+
+    def _failed(self, failure):
+        log.error("journal %s: %s" % (self.filename, failure.getErrorMessage()))
+
+    def _schedule_sync(self):
+        if self._sync is None:
+            self._sync = reactor.callLater(self.SYNC_DELAY, self.sync)
+
+    def _write(self, record):
+        self.size += len(record)
+        self._run(self._do_write, record)
+        self._schedule_sync()
+
+    def _do_write(self, record):
+        self._file.write(record)
+
+    def sync(self):
+        """
+        Writes buffered records to disk.
+        @return: a L{Deferred} fired when done
+        """
+        if self._sync is not None:
+            if self._sync.active():
+                self._sync.cancel()
+            self._sync = None
+        return self._run(self._do_sync)
+
+    def _do_sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _truncate(self):
+        self.size = 0
+        self._run(self._do_truncate)
+        self._schedule_sync()
+
+    def _do_truncate(self):
+        self._file.flush()
+        self._file.truncate(0)
+
+    def _rewrite(self):
+        """Rewrites the journal with live records only."""
+        if self._sync is not None and self._sync.active():
+            self._sync.cancel()
+        self._sync = None
+
+        records = self.live.values()
+        self.size = sum(len(r) for r in records)
+        self._run(self._do_rewrite, records)
+
+    def _do_rewrite(self, records):
+        tmpname = self.filename + '.tmp'
+        f = open(tmpname, 'wb')
+        for record in records:
+            f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpname, self.filename)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.filename, 'ab')
+        return os.path.getsize(self.filename)
+
+    def close(self):
+        """
+        Syncs and closes the journal.
+        @return: a L{Deferred} fired when done
+        """
+        self._closed = True
+        self.sync()
+        d = self._run(self._do_close)
+        d.addCallback(lambda _: self._writer.stop())
+        return d
+
+    def _do_close(self):
+        self._file.close()
+        self._file = None
@@ -21,6 +21,7 @@
 import base64
 import gpgme, gpgme.editutil
 
+from twisted.internet.task import LoopingCall
 from twisted.words.protocols.jabber import jid
 
 from gnutls.crypto import OpenPGPCertificate
@@ -118,6 +119,9 @@ class Keyring:
         'messages' : (0, 100)
     }
 
+    '''Seconds between server list reloads.'''
+    REFRESH_INTERVAL = 60
+
     def __init__(self, db, fingerprint, network, servername, disable_signers=False, disable_cache=False):
         self._db = db
         self.fingerprint = str(fingerprint).upper()
@@ -125,6 +129,7 @@ class Keyring:
         self.servername = servername
         self._list = {}
         self._enabled = {}
+        self._listeners = []
 
         # cache of locally discovered fingerprints (userid: fingerprint)
         # TODO find a more efficient way
@@ -141,18 +146,57 @@ class Keyring:
         if not disable_signers:
             self.ctx.signers = [self.ctx.get_key(self.fingerprint, True)]
 
-        self._reload()
+        # components need the server list from the start: the first load
+        # blocks (the reactor is not running yet), reloads are asynchronous
+        try:
+            self._update(db.load_list())
+        except Exception, e:
+            log.warn("unable to load server list: %s" % (e, ))
+        self._refresher = LoopingCall(self._refresh)
+        self._refresher.start(self.REFRESH_INTERVAL, now=False)
 
     def itervalues(self):
         '''Wrapper for itervalues() of internal server list.'''
         return self._list.itervalues()
 
+    def add_listener(self, listener):
+        '''
+        Registers a callable to be notified of changes to the enabled servers.
+        It will be called with two dicts (fingerprint: host) of servers enabled
+        and disabled since the previous reload.
+        '''
+        self._listeners.append(listener)
+
+    def _refresh(self):
+        def _failed(failure):
+            log.warn("unable to reload server list: %s" % (failure.getErrorMessage(), ))
+        # never stop the refresh loop
+        return self._reload().addErrback(_failed)
+
     def _reload(self):
-        slist = self._db.get_list()
+        d = self._db.get_list()
+        d.addCallback(self._update)
+        return d
+
+    def _update(self, slist):
+        servers = {}
+        enabled = {}
         for fpr, data in slist.iteritems():
-            self._list[fpr] = data['host']
+            servers[fpr] = data['host']
             if data['enabled']:
-                self._enabled[fpr] = data['host']
+                enabled[fpr] = data['host']
+
+        added = dict((fpr, host) for fpr, host in enabled.iteritems() if self._enabled.get(fpr) != host)
+        removed = dict((fpr, host) for fpr, host in self._enabled.iteritems() if enabled.get(fpr) != host)
+
+        self._list = servers
+        self._enabled = enabled
+
+        if added or removed:
+            log.info("server list changed (enabled: %s, disabled: %s)" %
+                (', '.join(added.values()) or '-', ', '.join(removed.values()) or '-'))
+            for listener in self._listeners:
+                listener(added, removed)
 
     def host(self, fingerprint):
         return self._list[fingerprint]
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""Append-only mailbox files for offline storage."""
+"""
+  Kontalk XMPP server
+  Copyright (C) 2014 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import mmap
+import struct
+import shutil
+
+from twisted.internet import defer
+
+
+"""
+Record header: payload length, timestamp (milliseconds), expire timestamp
+(seconds, 0 for none), id length, sender length.
+The payload is id + sender + content.
+"""
+RECORD_HEADER = struct.Struct('>IQQBB')
+
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9]+$')
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def pack_record(stanzaId, sender, timestamp, expire, content):
+    """Serializes a record: header followed by payload."""
+    stanzaId, sender, content = _bytes(stanzaId), _bytes(sender), _bytes(content)
+    return RECORD_HEADER.pack(len(stanzaId) + len(sender) + len(content),
+        timestamp, expire or 0, len(stanzaId), len(sender)) + stanzaId + sender + content
+
+
+def record_size(stanzaId, sender, content):
+    """Returns the size of a record without building it (see L{pack_record})."""
+    return RECORD_HEADER.size + len(_bytes(stanzaId)) + len(_bytes(sender)) + len(_bytes(content))
+
+
+def unpack_record(buf, offset):
+    """
+    Reads the record at the given offset.
+    @return: (stanzaId, sender, timestamp, expire, content, next offset) or
+    C{None} if the record is truncated (e.g. interrupted write)
+    """
+    end = offset + RECORD_HEADER.size
+    if end > len(buf):
+        return None
+    length, timestamp, expire, idlen, senderlen = RECORD_HEADER.unpack(buf[offset:end])
+    if end + length > len(buf):
+        return None
+    stanzaId = buf[end:end+idlen]
+    sender = buf[end+idlen:end+idlen+senderlen]
+    content = buf[end+idlen+senderlen:end+length]
+    return stanzaId, sender, timestamp, expire, content, end + length
+
+
+def iter_records(buf):
+    """Yields (offset, record) for every complete record in a buffer."""
+    offset = 0
+    while True:
+        rec = unpack_record(buf, offset)
+        if rec is None:
+            break
+        yield offset, rec
+        offset = rec[-1]
+
+
+def _map(filename):
+    """Returns a read-only memory map of a file, C{None} if empty."""
+    f = open(filename, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def mailbox_name(userid):
+    """Returns the directory name for a recipient mailbox."""
+    if _SAFE_NAME.match(userid):
+        return userid
+    # anything else is hex-encoded
+    return '_' + userid.encode('utf-8').encode('hex')
+
+
+def mailbox_userid(name):
+    """Returns the recipient of a mailbox directory (see L{mailbox_name})."""
+    if name.startswith('_'):
+        return name[1:].decode('hex').decode('utf-8')
+    return name
+
+
+def mailbox_dir(root, userid):
+    """Returns the directory for a recipient mailbox."""
+    name = mailbox_name(userid)
+    return os.path.join(root, name[-2:], name)
+
+
+class Mailbox(object):
+    """
+    Offline stanzas of a single recipient.
+    Records are appended to numbered segment files; deletes append the
+    position of the deleted record to a tombstone file. When an id is stored
+    again, the last record wins.
+    Record positions are kept in memory and updated right away; file I/O
+    runs in the writer thread, if given (see L{util.SerialThread}), in the
+    same order, so a read always finds the records appended before it.
+    """
+
+    """Segment size above which a new segment is started."""
+    SEGMENT_SIZE = 1 << 20
+
+    def __init__(self, path, writer=None):
+        self.path = path
+        self.segments = []
+        # stanza id: (segment, offset, length, timestamp, sender)
+        self.live = {}
+        self.size = 0
+        self.dead = 0
+        # size of the last segment
+        self._tail = 0
+        self._writer = writer
+
+    def _segment_file(self, segment):
+        return os.path.join(self.path, '%08d.seg' % (segment, ))
+
+    def _tombstone_file(self):
+        return os.path.join(self.path, 'tombstones')
+
+    def _io(self, func, *args):
+        """Runs file I/O in the writer thread. @return: L{Deferred}"""
+        if self._writer is None:
+            return defer.execute(func, *args)
+        return self._writer.run(func, *args)
+
+    def load(self):
+        """Reads the mailbox from disk (blocking)."""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+
+        self.segments = sorted([int(name[:-4]) for name in names if name.endswith('.seg')])
+
+        tombstones = set()
+        if 'tombstones' in names:
+            f = open(self._tombstone_file(), 'r')
+            for line in f:
+                try:
+                    segment, offset = line.split()
+                    tombstones.add((int(segment), int(offset)))
+                except ValueError:
+                    # truncated line
+                    pass
+            f.close()
+
+        for segment in self.segments:
+            buf = _map(self._segment_file(segment))
+            if buf is None:
+                continue
+            try:
+                for offset, rec in iter_records(buf):
+                    length = rec[-1] - offset
+                    self.size += length
+                    if (segment, offset) in tombstones:
+                        self.dead += length
+                    else:
+                        self._replace(rec[0], (segment, offset, length, rec[2], rec[1]))
+            finally:
+                buf.close()
+
+        if self.segments:
+            self._tail = os.path.getsize(self._segment_file(self.segments[-1]))
+
+    def _replace(self, stanzaId, entry):
+        old = self.live.get(stanzaId)
+        if old:
+            self.dead += old[2]
+        self.live[stanzaId] = entry
+
+    def _place(self, length):
+        """Returns (segment, offset) for a new record at the end of the mailbox."""
+        if not self.segments:
+            self.segments.append(0)
+            self._tail = 0
+        if self._tail > 0 and self._tail + length > self.SEGMENT_SIZE:
+            self.segments.append(self.segments[-1] + 1)
+            self._tail = 0
+
+        offset = self._tail
+        self._tail += length
+        self.size += length
+        return self.segments[-1], offset
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, stanzaId):
+        return stanzaId in self.live
+
+    def append(self, stanzaId, sender, timestamp, expire, content):
+        """
+        Appends a stanza to the last segment.
+        @return: a L{Deferred} fired when the record is written
+        """
+        record = pack_record(stanzaId, sender, timestamp, expire, content)
+        segment, offset = self._place(len(record))
+        self._replace(stanzaId, (segment, offset, len(record), timestamp, sender))
+        return self._io(self._write_record, segment, record)
+
+    def _write_record(self, segment, record):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        f = open(self._segment_file(segment), 'ab')
+        f.write(record)
+        f.close()
+
+    def remove(self, stanzaId, sender=None):
+        """
+        Marks a stanza as deleted.
+        @param sender: if given, the stanza is deleted only if sent by this user
+        @return: a L{Deferred} fired when the tombstone is written, C{None} if
+        the stanza was not found
+        """
+        entry = self.live.get(stanzaId)
+        if entry is None or (sender and entry[4] != sender):
+            return None
+
+        del self.live[stanzaId]
+        self.dead += entry[2]
+        return self._io(self._write_tombstone, entry[0], entry[1])
+
+    def _write_tombstone(self, segment, offset):
+        f = open(self._tombstone_file(), 'a')
+        f.write('%d %d\n' % (segment, offset))
+        f.close()
+
+    def read(self, after=None, limit=None):
+        """
+        Reads stanzas ordered by (timestamp, id).
+        @param after: (timestamp, id) of the last stanza of the previous page
+        @return: a L{Deferred} fired with a list of
+        (stanzaId, timestamp, expire, content)
+        """
+        entries = sorted((entry[3], stanzaId, entry) for stanzaId, entry in self.live.iteritems())
+        if after is not None:
+            entries = [e for e in entries if (e[0], e[1]) > tuple(after)]
+        if limit:
+            entries = entries[:limit]
+        return self._io(self._read_entries, entries)
+
+    def _read_entries(self, entries):
+        out = []
+        maps = {}
+        try:
+            for timestamp, stanzaId, entry in entries:
+                segment = entry[0]
+                if segment not in maps:
+                    maps[segment] = _map(self._segment_file(segment))
+                rec = unpack_record(maps[segment], entry[1])
+                out.append((stanzaId, timestamp, rec[3], rec[4]))
+        finally:
+            for buf in maps.itervalues():
+                if buf is not None:
+                    buf.close()
+        return out
+
+    def needs_compaction(self):
+        return not self.live or self.dead > self.size / 2
+
+    def compact(self):
+        """
+        Rewrites live records into new segments and drops the old ones. An
+        empty mailbox is removed from disk altogether.
+        @return: a L{Deferred} fired when the files are rewritten
+        """
+        if not self.live:
+            self.segments = []
+            self.size = self.dead = self._tail = 0
+            return self._io(shutil.rmtree, self.path, True)
+
+        entries = sorted((entry[3], stanzaId, entry) for stanzaId, entry in self.live.iteritems())
+        old = self.segments
+
+        # new segments are numbered after the old ones: if we crash before
+        # removing the old ones, the new records win when loading
+        self.segments = [old[-1] + 1]
+        self.live = {}
+        self.size = self.dead = self._tail = 0
+        moves = []
+        for timestamp, stanzaId, entry in entries:
+            segment, offset = self._place(entry[2])
+            self.live[stanzaId] = (segment, offset) + entry[2:]
+            moves.append((entry[0], entry[1], entry[2], segment))
+        return self._io(self._copy_records, old, moves)
+
+    def _copy_records(self, old, moves):
+        maps = {}
+        files = {}
+        try:
+            for segment, offset, length, target in moves:
+                if segment not in maps:
+                    maps[segment] = _map(self._segment_file(segment))
+                if target not in files:
+                    files[target] = open(self._segment_file(target), 'ab')
+                files[target].write(maps[segment][offset:offset+length])
+        finally:
+            for buf in maps.itervalues():
+                if buf is not None:
+                    buf.close()
+            for f in files.itervalues():
+                f.close()
+
+        for segment in old:
+            os.remove(self._segment_file(segment))
+        try:
+            os.remove(self._tombstone_file())
+        except OSError:
+            pass
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Moves offline stanzas after adding offline storage shards."""
+"""
+  Kontalk XMPP server
+  Copyright (C) 2014 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Usage: python -m kontalk.xmppserver.rebalance -c c2s.conf -f OLD_SHARDS
+
+Shards are listed in the "shards" key of the database configuration; new
+shards must be appended to the list (and created with data/schema.sql)
+before running this tool. Recipients keep their shard or move to one of the
+new shards: their stanzas are copied to the new shard and then deleted from
+the old one, one recipient at a time.
+Restart c2s with the new configuration before running the tool: stanzas of
+moved recipients not yet copied will be delivered on a later login.
+"""
+
+import sys
+import demjson
+
+from twisted.python import usage
+
+from kontalk.xmppserver import util
+
+TABLES = ('presence', 'message', 'iq')
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["config", "c", "c2s.conf", "Configuration file."],
+        ["from", "f", None, "Number of shards before adding the new ones.", int],
+    ]
+
+
+def connect(config):
+    module = __import__(config['dbmodule'])
+    return module.connect(host=config['host'], port=config['port'],
+        user=config['user'], passwd=config['password'], db=config['dbname'])
+
+
+def move(source, dest, table, recipient):
+    """Moves stanzas of a recipient to another shard. Returns the number of moved stanzas."""
+    src = source.cursor()
+    src.execute('SELECT id, sender, recipient, type, content, timestamp, expire_timestamp FROM stanzas_%s WHERE recipient = ?' % (table, ), (recipient, ))
+    rows = src.fetchall()
+    if rows:
+        dst = dest.cursor()
+        for row in rows:
+            dst.execute('INSERT IGNORE INTO stanzas_%s (id, sender, recipient, type, content, timestamp, expire_timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)' % (table, ), row)
+        dest.commit()
+        src.execute('DELETE FROM stanzas_%s WHERE id IN (%s)' % (table, ', '.join(['?'] * len(rows))),
+            [row[0] for row in rows])
+        source.commit()
+    return len(rows)
+
+
+def rebalance(config, old_count):
+    shard_cfgs = []
+    for shard in config['shards']:
+        cfg = dict(config)
+        cfg.update(shard)
+        shard_cfgs.append(cfg)
+    count = len(shard_cfgs)
+    if old_count >= count:
+        raise ValueError("no new shards (%d configured)" % (count, ))
+
+    conns = [connect(cfg) for cfg in shard_cfgs]
+    for index in range(old_count):
+        for table in TABLES:
+            c = conns[index].cursor()
+            c.execute('SELECT DISTINCT recipient FROM stanzas_%s' % (table, ))
+            for (recipient, ) in c.fetchall():
+                dest = util.userid_bucket(recipient, count)
+                if dest != index:
+                    moved = move(conns[index], conns[dest], table, recipient)
+                    print "%s: moved %d stanzas (%s) from shard %d to %d" % (recipient, moved, table, index, dest)
+
+    for conn in conns:
+        conn.close()
+
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print "%s\n%s" % (e, options)
+        return 1
+    if options['from'] is None:
+        print "missing --from\n%s" % (options, )
+        return 1
+
+    fp = open(options['config'], 'r')
+    config = demjson.decode(fp.read(), allow_comments=True)
+    fp.close()
+
+    rebalance(config['database'], options['from'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -19,7 +19,7 @@
 """
 
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.internet.task import LoopingCall
 from twisted.enterprise import adbapi
 from twisted.words.protocols.jabber import jid
@@ -27,7 +27,7 @@ from twisted.words.protocols.jabber import jid
 from wokkel import generic
 
 from copy import deepcopy
-import os, base64, time, datetime
+import os, base64, time, datetime, zlib, random
 
 try:
     from collections import OrderedDict
@@ -35,16 +35,482 @@ except:
     from ordereddict import OrderedDict
 
 from kontalk.xmppserver.component.sm import component as sm
-import util, xmlstream2, log
+import util, xmlstream2, log, mailbox, journal, timer
 
 dbpool = None
+dbconfig = None
+# read replicas (None if not configured)
+replicas = None
+# offline storage shards (None if not configured)
+shards = None
+
+
+class QuotaExceededError(Exception):
+    """A stanza was not stored because its recipient is over the offline quota."""
+    pass
+
 
 def init(config):
-    global dbpool
-    dbpool = adbapi.ConnectionPool(config['dbmodule'], host=config['host'], port=config['port'],
+    global dbpool, dbconfig, replicas, shards
+    dbconfig = config
+    replicas = None
+    shards = None
+    if config['dbmodule'] == 'sqlite3':
+        import sqlite3
+        # one connection: SQLite allows a single writer anyway
+        dbpool = adbapi.ConnectionPool('sqlite3', config['dbname'], check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES, cp_min=1, cp_max=1, cp_openfun=_sqlite_open)
+    else:
+        dbpool = _mysql_pool(config)
+        if config.get('replicas'):
+            pools = [_mysql_pool(_merge(config, replica)) for replica in config['replicas']]
+            replicas = ReplicaSet(pools, config.get('replica_pin_time', ReplicaSet.PIN_TIME),
+                config.get('replica_max_lag', ReplicaSet.MAX_LAG))
+        if config.get('shards'):
+            shards = [_mysql_pool(_merge(config, shard)) for shard in config['shards']]
+
+
+def _mysql_pool(config):
+    return adbapi.ConnectionPool(config['dbmodule'], host=config['host'], port=config['port'],
         user=config['user'], passwd=config['password'], db=config['dbname'], autoreconnect=True)
 
 
+def _merge(config, override):
+    """Connection parameters of another server: missing ones are the same as the primary."""
+    out = dict(config)
+    out.update(override)
+    return out
+
+
+def shard_pool(userid):
+    """Returns the connection pool of the offline storage shard of a user."""
+    if shards is None:
+        return dbpool
+    return shards[util.userid_bucket(userid, len(shards))]
+
+
+def shard_pools():
+    """Returns the connection pools of all offline storage shards."""
+    if shards is None:
+        return [dbpool]
+    return shards
+
+
+def _gather(dlist):
+    """Waits for the work of one or more shards."""
+    if len(dlist) == 1:
+        return dlist[0]
+    return defer.gatherResults(dlist, True)
+
+
+def readpool(userid=None):
+    """
+    Returns the connection pool for a read-only query: a read replica if
+    available, unless data of the given user was written recently.
+    """
+    if replicas is None:
+        return dbpool
+    return replicas.pool(userid)
+
+
+def written(*userids):
+    """Pins reads of data of the given users to the primary for a while."""
+    if replicas is not None:
+        replicas.written(*userids)
+
+
+class ReplicaSet(object):
+    """
+    Read replicas of the primary database.
+    Replication lag is checked periodically: replicas lagging behind more
+    than max_lag seconds (or not replicating at all) are not used. Reads of
+    a user's data go to the primary for pin_time seconds (or the current
+    lag, if longer) after the user's data was written.
+    """
+
+    """Default seconds reads are pinned to the primary after a write."""
+    PIN_TIME = 5
+    """Default maximum replication lag in seconds."""
+    MAX_LAG = 30
+    """Seconds between replication lag checks."""
+    CHECK_INTERVAL = 10
+
+    def __init__(self, pools, pin_time=PIN_TIME, max_lag=MAX_LAG):
+        self.pools = pools
+        self.pin_time = pin_time
+        self.max_lag = max_lag
+        # pool: replication lag in seconds (None if unknown)
+        self.lag = dict((pool, None) for pool in pools)
+        self.available = []
+        # userid: time until reads go to the primary
+        self._pinned = {}
+        self._checker = LoopingCall(self.check)
+        self._checker.start(self.CHECK_INTERVAL)
+
+    def pool(self, userid=None):
+        if userid is not None:
+            userid = userid[:util.USERID_LENGTH]
+            if self._pinned.get(userid, 0) > time.time():
+                return dbpool
+        if not self.available:
+            return dbpool
+        return random.choice(self.available)
+
+    def written(self, *userids):
+        lag = max([lag for lag in self.lag.itervalues() if lag is not None] or [0])
+        until = time.time() + max(self.pin_time, lag + 1)
+        for userid in userids:
+            self._pinned[userid[:util.USERID_LENGTH]] = until
+
+    def check(self):
+        """Measures replication lag of every replica."""
+        def _lag(tx):
+            tx.execute('SHOW SLAVE STATUS')
+            row = tx.fetchone()
+            if row:
+                columns = [c[0] for c in tx.description]
+                return row[columns.index('Seconds_Behind_Master')]
+
+        def _checked(lag, pool):
+            self.lag[pool] = lag
+        def _failed(failure, pool):
+            log.warn("unable to check replica lag: %s" % (failure.getErrorMessage(), ))
+            self.lag[pool] = None
+
+        def _done(unused):
+            available = [pool for pool in self.pools if self.lag[pool] is not None and self.lag[pool] <= self.max_lag]
+            if len(available) != len(self.available):
+                log.info("%d of %d read replicas available" % (len(available), len(self.pools)))
+            self.available = available
+
+            # forget expired pins
+            now = time.time()
+            for userid, until in self._pinned.items():
+                if until <= now:
+                    del self._pinned[userid]
+
+        dlist = []
+        for pool in self.pools:
+            d = pool.runInteraction(_lag)
+            d.addCallbacks(_checked, _failed, callbackArgs=(pool, ), errbackArgs=(pool, ))
+            dlist.append(d)
+        return defer.gatherResults(dlist).addCallback(_done)
+
+
+def _sqlite():
+    return dbconfig is not None and dbconfig['dbmodule'] == 'sqlite3'
+
+
+def stanza_storage(expire_time=0):
+    """Returns the stanza storage for the configured database."""
+    if dbconfig.get('stanza_engine') == 'mailbox':
+        db = MailboxStanzaStorage(dbconfig['mailbox_path'], expire_time)
+    elif _sqlite():
+        db = SQLiteStanzaStorage(expire_time)
+    elif dbconfig.get('schema', 1) >= 2:
+        db = MySQLStanzaStorageV2(expire_time)
+    else:
+        db = MySQLStanzaStorage(expire_time)
+    db.compress = dbconfig.get('stanza_compression', False)
+    db.quota_stanzas = dbconfig.get('stanza_quota_count', 0)
+    db.quota_bytes = dbconfig.get('stanza_quota_bytes', 0)
+    db.quota_policy = dbconfig.get('stanza_quota_policy', 'evict')
+    if db.quota_policy not in ('evict', 'reject'):
+        raise ValueError("invalid stanza quota policy: %s" % (db.quota_policy, ))
+    if dbconfig.get('stanza_journal'):
+        db.open_journal(dbconfig['stanza_journal'])
+    return db
+
+
+def presence_storage():
+    """Returns the presence storage for the configured database."""
+    if _sqlite():
+        return SQLitePresenceStorage()
+    return MySQLPresenceStorage()
+
+
+def network_storage():
+    """Returns the network storage for the configured database."""
+    if _sqlite():
+        return SQLiteNetworkStorage()
+    return MySQLNetworkStorage()
+
+
+def validation_storage(expire_time=0):
+    """Returns the user validation storage for the configured database."""
+    if _sqlite():
+        return SQLiteUserValidationStorage(expire_time)
+    return MySQLUserValidationStorage(expire_time)
+
+
+# marker of zlib compressed stanza content (stored XML always starts with '<')
+COMPRESSED_MARKER = '\x01'
+# stanzas shorter than this are not worth compressing
+COMPRESS_MIN_SIZE = 256
+
+def compress_content(data):
+    """
+    Compresses serialized stanza data for storage.
+    @return: compressed data with a format marker, or data itself if it
+    wouldn't get any smaller
+    """
+    if len(data) >= COMPRESS_MIN_SIZE:
+        packed = COMPRESSED_MARKER + zlib.compress(data)
+        if len(packed) < len(data):
+            return packed
+    return data
+
+
+def decompress_content(data):
+    """Returns serialized stanza data from stored content, compressed or not."""
+    if data[:1] == COMPRESSED_MARKER:
+        return zlib.decompress(data[1:])
+    return data
+
+
+# maximum number of rows deleted by a single purge statement
+PURGE_BATCH_SIZE = 1000
+# pause in seconds between purge statements
+PURGE_BATCH_DELAY = 0.1
+
+def purge(table, column, cutoff, pool=None):
+    """
+    Deletes rows whose column value is lower than cutoff, at most
+    PURGE_BATCH_SIZE rows per statement with a pause between statements so
+    table locks are held briefly. The column should be indexed.
+    @param pool: connection pool to use (default: primary)
+    @return: a L{Deferred} firing with the number of deleted rows
+    """
+    global dbpool
+    if pool is None:
+        pool = dbpool
+    if _sqlite():
+        # DELETE ... LIMIT is not available in default SQLite builds
+        query = 'DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE %s < ? LIMIT %d)' % \
+            (table, table, column, PURGE_BATCH_SIZE)
+    else:
+        query = 'DELETE FROM %s WHERE %s < ? LIMIT %d' % (table, column, PURGE_BATCH_SIZE)
+
+    def _delete(tx):
+        tx.execute(query, (cutoff, ))
+        return tx.rowcount
+
+    def _next(count, total):
+        total += count
+        if count < PURGE_BATCH_SIZE:
+            if total > 0:
+                log.info("purged %d rows from %s in %.3f seconds" % (total, table, time.time() - start))
+            result.callback(total)
+        else:
+            d = task.deferLater(reactor, PURGE_BATCH_DELAY, pool.runInteraction, _delete)
+            d.addCallbacks(_next, result.errback, callbackArgs=(total, ))
+
+    result = defer.Deferred()
+    start = time.time()
+    d = pool.runInteraction(_delete)
+    d.addCallbacks(_next, result.errback, callbackArgs=(0, ))
+    return result
+
+
+def _purge_failed(failure):
+    # don't let the failure stop the expire loop
+    log.warn("purge failed: %s" % (failure.getErrorMessage(), ))
+
+
+class BatchItemsFailed(Exception):
+    """
+    Raised by a L{BatchQueue} flush function when only some items could not
+    be written: only those items fail.
+    @ivar failures: item id: exception
+    """
+
+    def __init__(self, failures):
+        Exception.__init__(self, "%d items failed" % (len(failures), ))
+        self.failures = failures
+
+
+class BatchQueue(object):
+    """
+    Coalesces queued items into batches.
+    Items are grouped by key and handed over to a flush function when a group
+    reaches a maximum size or when a maximum delay has elapsed since its first
+    item was queued, whichever comes first. Queueing an item with the same id
+    of an already queued one will replace it.
+
+    The flush function is called with the key and the list of items and must
+    return a L{Deferred} (or a plain value). It can fail with
+    L{BatchItemsFailed} if only some items could not be written.
+    """
+
+    def __init__(self, flush, max_size=50, max_delay=0.2):
+        self._flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # key: (OrderedDict(itemId: [item, waiting deferreds]), delayed call)
+        self._batches = {}
+
+    def __len__(self):
+        return sum(len(items) for items, unused in self._batches.itervalues())
+
+    def put(self, key, itemId, item):
+        """
+        Queues an item.
+        @return: a L{Deferred} fired with the flush result of the batch the
+        item ended up in
+        """
+        try:
+            items, unused = self._batches[key]
+        except KeyError:
+            items = OrderedDict()
+            self._batches[key] = (items, reactor.callLater(self.max_delay, self.flush, key))
+
+        d = defer.Deferred()
+        if itemId in items:
+            items[itemId][0] = item
+            items[itemId][1].append(d)
+        else:
+            items[itemId] = [item, [d]]
+
+        if len(items) >= self.max_size:
+            self.flush(key)
+        return d
+
+    def items(self, key):
+        """Returns the items queued in a batch."""
+        try:
+            return [item for item, unused in self._batches[key][0].itervalues()]
+        except KeyError:
+            return []
+
+    def get(self, key, itemId):
+        """Returns a queued item or None if not found."""
+        try:
+            return self._batches[key][0][itemId][0]
+        except KeyError:
+            return None
+
+    def cancel(self, key, itemId):
+        """
+        Removes a queued item before it gets flushed.
+        @return: True if the item was found and removed
+        """
+        try:
+            items, timer = self._batches[key]
+            unused, waiting = items.pop(itemId)
+        except KeyError:
+            return False
+
+        if len(items) == 0:
+            del self._batches[key]
+            if timer.active():
+                timer.cancel()
+
+        for d in waiting:
+            d.callback(None)
+        return True
+
+    def flush(self, key=None):
+        """
+        Flushes a batch immediately (or all of them if key is None).
+        @return: a L{Deferred} fired when the flush has completed
+        """
+        if key is None:
+            return defer.gatherResults([self.flush(k) for k in self._batches.keys()])
+
+        try:
+            items, timer = self._batches.pop(key)
+        except KeyError:
+            return defer.succeed(None)
+
+        if timer.active():
+            timer.cancel()
+
+        entries = items.items()
+        batch = [item for unused, (item, dlist) in entries]
+
+        def _done(result):
+            for unused, (item, dlist) in entries:
+                for d in dlist:
+                    d.callback(result)
+        def _failed(failure):
+            if failure.check(BatchItemsFailed):
+                failures = failure.value.failures
+                log.warn("batch flush failed for %d of %d items (%s)" % (len(failures), len(entries), key))
+            else:
+                failures = None
+                log.warn("batch flush failed (%s): %s" % (key, failure.getErrorMessage()))
+            for itemId, (item, dlist) in entries:
+                for d in dlist:
+                    if failures is None:
+                        d.errback(failure)
+                    elif itemId in failures:
+                        d.errback(failures[itemId])
+                    else:
+                        d.callback(None)
+
+        d = defer.maybeDeferred(self._flush, key, batch)
+        d.addCallbacks(_done, _failed)
+        return d
+
+
+class LRUCache(object):
+    """
+    Bounded cache with least-recently-used eviction and entry expiration.
+    Counts hits and misses. The generation number is increased by every
+    invalidation, so readers can tell if the value they are about to cache
+    was invalidated while they were loading it.
+    """
+
+    def __init__(self, max_size=1000, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key: (value, expiration time)
+        self._entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Looks up a key.
+        @return: (found, value)
+        """
+        try:
+            value, expire = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        if expire < time.time():
+            self.misses += 1
+            return False, None
+
+        # most recently used go last
+        self._entries[key] = (value, expire)
+        self.hits += 1
+        return True, value
+
+    def put(self, key, value, generation=None):
+        """
+        Caches a value.
+        @param generation: if given, the value is cached only if nothing was
+        invalidated since then
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time() + self.ttl)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+
 """ interfaces """
 
 
@@ -69,7 +535,11 @@ class StanzaStorage:
         pass
 
     def store(self, stanza, network, delayed=False, reuseId=False):
-        """Store a stanza."""
+        """
+        Store a stanza.
+        @return: the stanza id, or C{None} if the recipient is over the
+        offline quota and the stanza was rejected
+        """
         pass
 
     def get_by_id(self, stanzaId):
@@ -80,8 +550,13 @@ class StanzaStorage:
         """Retrieve stanzas by sender."""
         pass
 
-    def get_by_recipient(self, recipient):
-        """Retrieve stanzas by recipient."""
+    def get_by_recipient(self, recipient, after=None, limit=None):
+        """
+        Retrieve stanzas by recipient, oldest first.
+        @param after: cursor of the last stanza of the previous page, as found
+        in its C{cursor} key; C{None} to start from the beginning
+        @param limit: maximum number of stored stanzas to return, C{None} for all
+        """
         pass
 
     def delete(self, stanzaId, stanzaName, sender=None, recipient=None):
@@ -100,6 +575,24 @@ class PresenceStorage:
         """Retrieve info about all users."""
         pass
 
+    def get_changes(self, since, limit, until=None):
+        """
+        Retrieve info about users whose presence changed after the given
+        version, ordered by version and userid.
+        @param since: a version, or the (version, userid) of the last entry
+        of the previous page
+        @param until: highest version to include (defaults to the last one
+        safely committed)
+        """
+        pass
+
+    def sync_version(self):
+        """
+        Write any pending changes and return the presence version covering all
+        of them (see L{get_changes}).
+        """
+        pass
+
     def presence(self, stanza):
         """Persist a presence."""
         pass
@@ -121,7 +614,18 @@ class NetworkStorage:
     """Network info storage."""
 
     def get_list(self):
-        """Retrieve the list of servers in this network."""
+        """
+        Retrieve the list of servers in this network.
+        @return: a L{Deferred} fired with {fingerprint: {host, enabled}}
+        """
+        pass
+
+    def load_list(self):
+        """
+        Same as L{get_list}, but blocking: to be used only on startup, before
+        the reactor is running.
+        @return: {fingerprint: {host, enabled}}
+        """
         pass
 
 
@@ -180,44 +684,102 @@ class FileStorage:
 """ implementations """
 
 
-class MySQLStanzaStorage(StanzaStorage):
+class DelayedStanzaStorage(StanzaStorage):
+    """
+    Base class for stanza storages supporting delayed store.
+    Subclasses do the actual write in L{_do_store}.
+    """
 
     OFFLINE_STORE_DELAY = 10
-    tables = ('presence', 'message', 'iq')
+
+    """True to store stanza content compressed."""
+    compress = False
+
+    """Journal of stanzas waiting for delayed store (optional)."""
+    journal = None
+
+    """
+    Called with a stanza refused by a delayed store because its recipient
+    is over quota (optional).
+    """
+    reject_callback = None
+
+    """Maximum number of stored stanzas for each recipient, 0 for no limit."""
+    quota_stanzas = 0
+    """Maximum bytes of stored stanzas for each recipient, 0 for no limit."""
+    quota_bytes = 0
+    """
+    What to do with recipients over quota: 'evict' drops their oldest
+    stanzas, 'reject' refuses new ones.
+    """
+    quota_policy = 'evict'
+    """Fraction of the quota recipients are brought back to by eviction."""
+    QUOTA_LOW_WATERMARK = 0.9
+    """Seconds a recipient found over quota is considered so without checking again."""
+    QUOTA_CHECK_INTERVAL = 60
 
     def __init__(self, expire_time=0):
-        StanzaStorage.__init__(self, expire_time)
         """
         This dictionary keeps track of messages currently pending for offline
-        storage. Keys are message IDs, values are (L{IDelayedCall}, stanza)
-        which can be canceled when a message is going to be deleted (also
-        avoiding to do the actual database delete).
+        storage. Keys are message IDs, values are (L{IDelayedCall}, recipient,
+        serialized stanza, (network, expire)); the call can be canceled when a
+        message is going to be deleted (also avoiding to do the actual
+        database delete).
         """
         self._pending_offline = {}
+        # recipient: ordered pending message IDs
+        self._pending_recipients = {}
+        # recipient: time it was last found over quota
+        self._capped = {}
+        self.quota_stats = {'checks': 0, 'capped': 0, 'evicted': 0, 'rejected': 0}
         self._exiting = False
+        StanzaStorage.__init__(self, expire_time)
         # shutdown event trigger for delayed storage
         reactor.addSystemEventTrigger('during', 'shutdown', self._shutdown)
 
+    def open_journal(self, filename):
+        """
+        Records stanzas waiting for delayed store in a journal file. Stanzas
+        left in the journal by a previous run are stored immediately.
+        """
+        self.journal = journal.Journal(filename)
+        if len(self.journal) > 0:
+            log.info("storing %d stanzas from journal %s" % (len(self.journal), filename))
+        for stanzaId, network, unused, expire, content in self.journal.entries():
+            self._store(generic.parseXml(content), network, stanzaId, expire or None)
+
     def _shutdown(self):
         self._exiting = True
+        if self.journal is not None:
+            # pending stanzas will be stored on next startup
+            for pend in self._pending_offline.itervalues():
+                if pend[0].active():
+                    pend[0].cancel()
+
+            # queued stores remove their records from the journal when written
+            def _close(result):
+                return self.journal.close().addCallback(lambda _: result)
+            return self._flush_queues().addBoth(_close)
+
         dlist = []
-        for cb, stanza, args in self._pending_offline.itervalues():
-            if cb.active():
-                cb.cancel()
-                d = self._store(stanza, *args)
-                dlist.append(d)
+        for stanzaId, pend in self._pending_offline.items():
+            if pend[0].active():
+                pend[0].cancel()
+                dlist.append(self._store_pending(stanzaId))
+        dlist.append(self._flush_queues())
         return defer.gatherResults(dlist)
 
-    def expired(self):
-        for t in ('stanzas_iq', 'stanzas_message', 'stanzas_presence'):
-            dbpool.runOperation('DELETE FROM %s WHERE (UNIX_TIMESTAMP()*1000) > (timestamp + %d)' %
-                (t, self.expire_time*1000, ))
+    def _flush_queues(self):
+        """Writes stanzas waiting in batch queues, if any."""
+        return defer.succeed(None)
 
     def store(self, stanza, network, delayed=False, reuseId=None, expire=None):
         receipt = xmlstream2.extract_receipt(stanza, 'request')
         if not receipt:
             if reuseId is not None:
                 _id = reuseId
+            elif stanza.name == 'presence':
+                _id = self._presence_id(stanza)
             else:
                 _id = util.rand_str(30, util.CHARSBOX_AZN_LOWERCASE)
         else:
@@ -226,25 +788,50 @@ class MySQLStanzaStorage(StanzaStorage):
         # cancel any previous delayed call
         self._cancel_pending(_id)
 
-        # WARNING using deepcopy is not safe
-
         if delayed:
+            # keep the serialized stanza: it will be parsed again when needed
+            content = stanza.toXml().encode('utf-8')
+            recipient = util.jid_user(stanza['to'])
             # delay our call
-            self._pending_offline[_id] = (reactor.callLater(self.OFFLINE_STORE_DELAY, self._store,
-                stanza=deepcopy(stanza), network=network, _id=_id, expire=expire),
-                    stanza, (network, _id, expire))
+            self._pending_offline[_id] = (timer.wheel.callLater(self.OFFLINE_STORE_DELAY, self._store_pending, _id),
+                recipient, content, (network, expire))
+            self._pending_recipients.setdefault(recipient, OrderedDict())[_id] = True
+            if self.journal is not None:
+                self.journal.append(_id, network, expire, content)
             return _id
         else:
+            # WARNING using deepcopy is not safe
             return self._store(deepcopy(stanza), network, _id, expire)
 
-    def _store(self, stanza, network, _id, expire):
-        # remove ourselves from pending
-        if not self._exiting:
-            try:
-                del self._pending_offline[_id]
-            except:
-                pass
+    def _presence_id(self, stanza):
+        """
+        Returns the id for a presence stanza: the same for any presence from
+        a user to another, so a new subscription request replaces the
+        previous one instead of being stored next to it.
+        """
+        key = '%s|%s' % (util.jid_user(stanza['from']), util.jid_user(stanza['to']))
+        return util.sha1(key)[:30]
+
+    def _pop_pending(self, stanzaId):
+        """Removes a stanza from the pending ones, returning its entry."""
+        pend = self._pending_offline.pop(stanzaId)
+        ids = self._pending_recipients[pend[1]]
+        del ids[stanzaId]
+        if not ids:
+            del self._pending_recipients[pend[1]]
+        return pend
+
+    def _store_pending(self, stanzaId):
+        """Delayed call: stores a pending stanza."""
+        unused, recipient, content, args = self._pop_pending(stanzaId)
+        network, expire = args
+        stored = self._store(generic.parseXml(content), network, stanzaId, expire)
+        if stored is None and self.reject_callback is not None:
+            # the stanza was modified for storage
+            self.reject_callback(generic.parseXml(content))
+        return stored
 
+    def _store(self, stanza, network, _id, expire):
         # if no receipt request is found, generate a unique id for the message
         receipt = xmlstream2.extract_receipt(stanza, 'request')
         if not receipt:
@@ -271,8 +858,16 @@ class MySQLStanzaStorage(StanzaStorage):
         log.debug("storing offline message for %s" % (stanza['to'], ))
         try:
             d = self._do_store(stanza, expire)
+            if self.journal is not None and _id in self.journal:
+                self._journal_stored(d, _id)
             if self._exiting:
                 return d
+            if isinstance(d, defer.Deferred):
+                d.addErrback(self._store_failed, stanza)
+        except QuotaExceededError:
+            if self.journal is not None:
+                self.journal.remove(_id)
+            return None
         except:
             # TODO log this
             import traceback
@@ -280,40 +875,396 @@ class MySQLStanzaStorage(StanzaStorage):
 
         return stanza['id']
 
+    def _store_failed(self, failure, stanza):
+        # journaled stanzas are stored again on next startup
+        log.warn("unable to store offline stanza %s: %s" % (stanza['id'], failure.getErrorMessage()))
+
     def _do_store(self, stanza, expire=None):
-        global dbpool
+        """
+        Writes a stanza to storage.
+        @raise QuotaExceededError: if the stanza was rejected
+        """
+        pass
+
+    def _over_quota(self, count, size):
+        return (self.quota_stanzas and count > self.quota_stanzas) or \
+            (self.quota_bytes and size > self.quota_bytes)
+
+    def _quota_evictions(self, entries):
+        """
+        Chooses the stanzas to evict from a recipient over quota: the oldest
+        ones, until the rest fits in the low watermark of the quota.
+        @param entries: (stanza, size) tuples, oldest first
+        @return: the entries to evict
+        """
+        max_count = int(self.quota_stanzas * self.QUOTA_LOW_WATERMARK)
+        max_size = int(self.quota_bytes * self.QUOTA_LOW_WATERMARK)
+        kept, kept_size = 0, 0
+        for entry in reversed(entries):
+            if (self.quota_stanzas and kept + 1 > max_count) or \
+                    (self.quota_bytes and kept_size + entry[1] > max_size):
+                break
+            kept += 1
+            kept_size += entry[1]
+        return entries[:len(entries) - kept]
+
+    def _quota_exceeded(self, userid, count, size):
+        """Records a recipient found over quota."""
+        if userid not in self._capped:
+            log.info("offline quota exceeded for %s (%d stanzas, %d bytes)" % (userid, count, size))
+        self._capped[userid] = time.time()
+        self.quota_stats['capped'] += 1
+
+    def _quota_evicted(self, userid, count):
+        self.quota_stats['evicted'] += count
+        log.debug("evicted %d offline stanzas for %s" % (count, userid))
+
+    def _quota_rejects(self, userid):
+        """Returns true if a store for a recipient must be rejected."""
+        if self.quota_policy != 'reject' or userid not in self._capped:
+            return False
+        if self._capped[userid] + self.QUOTA_CHECK_INTERVAL < time.time():
+            # check again
+            del self._capped[userid]
+            return False
+        self.quota_stats['rejected'] += 1
+        log.debug("rejecting offline stanza for %s: over quota" % (userid, ))
+        return True
+
+    def quota_status(self):
+        """
+        Returns the quota counters: times recipients were checked and found
+        over quota, evicted and rejected stanzas, and the number of recipients
+        found over quota recently.
+        """
+        expire = time.time() - self.QUOTA_CHECK_INTERVAL
+        for userid, since in self._capped.items():
+            if since < expire:
+                del self._capped[userid]
+        status = dict(self.quota_stats)
+        status['capped_users'] = len(self._capped)
+        return status
+
+    def _journal_stored(self, d, stanzaId):
+        """Removes a stanza from the journal once written to storage."""
+        record = self.journal.live[stanzaId]
+        def _done(result):
+            self.journal.remove(stanzaId, record)
+            return result
+        if isinstance(d, defer.Deferred):
+            d.addCallback(_done)
+        else:
+            _done(None)
+
+    def _cancel_pending(self, stanzaId):
+        if stanzaId in self._pending_offline:
+            if self._pending_offline[stanzaId][0].active():
+                self._pending_offline[stanzaId][0].cancel()
+                self._pop_pending(stanzaId)
+                if self.journal is not None:
+                    self.journal.remove(stanzaId)
+                return True
+        return False
+
+    def _stored_stanza(self, stanzaId, timestamp, content, expire):
+        """
+        Builds a result entry from a stored stanza (content is UTF-8 XML,
+        possibly compressed).
+        """
+        d = {
+             'id': stanzaId,
+             'cursor': (timestamp, stanzaId),
+             'timestamp': datetime.datetime.utcfromtimestamp(timestamp / 1e3),
+             'expire': datetime.datetime.utcfromtimestamp(expire) if expire else None
+        }
+        d['stanza'] = generic.parseXml(decompress_content(content))
+
+        """
+        Add a <storage/> element to the stanza; this way components have
+        a way to know if stanza is coming from storage.
+        """
+        stor = d['stanza'].addElement((xmlstream2.NS_XMPP_STORAGE, 'storage'))
+        stor['id'] = stanzaId
+        return d
+
+    def _stanza_id(self, stanza):
         receipt = xmlstream2.extract_receipt(stanza, 'request')
         if receipt:
             # this is indeed generated by server :)
-            msgId = receipt['id']
+            return receipt['id']
         else:
             # WARNING stanza id must be server generated
-            msgId = stanza['id']
+            return stanza['id']
+
+    def _unique(self, out):
+        """
+        Removes pending stanzas already stored from a result: the stored copy
+        is kept and the pending store is cancelled, so the stanza is
+        delivered and deleted once.
+        """
+        stored = set(msg['id'] for msg in out if 'cursor' in msg)
+        unique = []
+        for msg in out:
+            if 'cursor' not in msg and msg['id'] in stored:
+                self._cancel_pending(msg['id'])
+            else:
+                unique.append(msg)
+        return unique
+
+    def _pending_for(self, recipient):
+        """Returns stanzas for a recipient still waiting for delayed store."""
+        out = []
+        for stanzaId in self._pending_recipients.get(recipient.user, ()):
+            delayed, unused, content, args = self._pending_offline[stanzaId]
+            stanza = generic.parseXml(content)
+            stanza.consumed = False
+            out.append({'id': stanzaId, 'stanza': stanza})
+            # reset delayed timer
+            delayed.reset(self.OFFLINE_STORE_DELAY)
+        return out
+
+
+class MySQLStanzaStorage(DelayedStanzaStorage):
+
+    tables = ('presence', 'message', 'iq')
+
+    """Maximum number of rows in a single multi-row INSERT."""
+    STORE_BATCH_SIZE = 50
+    """Maximum time in seconds a store can wait for its batch to fill up."""
+    STORE_BATCH_DELAY = 0.2
+    """Maximum number of ids in a single bulk DELETE."""
+    DELETE_BATCH_SIZE = 100
+    """Maximum time in seconds a delete can wait for its batch to fill up."""
+    DELETE_BATCH_DELAY = 0.5
+    """Compound operator joining the per-table recipient queries."""
+    RECIPIENT_UNION = 'UNION'
+    """
+    Statements writing stanzas to each table. Presence stanzas replace the
+    previous one with the same id (see L{_presence_id}); other stanzas
+    stored again with the same id are written once.
+    """
+    STORE_OPS = {'presence': 'REPLACE'}
+    STORE_OP = 'INSERT IGNORE'
+    """Size in bytes of the content column."""
+    CONTENT_LENGTH = 'LENGTH(`content`)'
+    """Recipients of stored stanzas remembered to route deletes to one shard."""
+    RECIPIENT_CACHE_SIZE = 100000
+    RECIPIENT_CACHE_TTL = 86400
+
+    def __init__(self, expire_time=0):
+        DelayedStanzaStorage.__init__(self, expire_time)
+        # stores waiting to be written in a multi-row INSERT (key=table)
+        self._stores = BatchQueue(self._flush_stores, self.STORE_BATCH_SIZE, self.STORE_BATCH_DELAY)
+        # deletes waiting to be run as a bulk DELETE (key=(table, sender, recipient))
+        self._deletes = BatchQueue(self._flush_deletes, self.DELETE_BATCH_SIZE, self.DELETE_BATCH_DELAY)
+        """
+        Upper bound of stored stanzas for each recipient, used to answer
+        "nothing pending" without a query. Counts are increased on store and
+        corrected after each full read; they become trustworthy only after
+        being loaded from the database (see L{_load_counts}).
+        """
+        self._counts = {}
+        # same for stanza bytes (stores since startup only)
+        self._sizes = {}
+        self._counts_loaded = False
+        # recipients being checked against the quota
+        self._checking = set()
+        self._load_counts()
+        # stanza id: recipient, for deletes without recipient (sharding only)
+        self._recipients = LRUCache(self.RECIPIENT_CACHE_SIZE, self.RECIPIENT_CACHE_TTL)
+
+    def _flush_queues(self):
+        return defer.gatherResults([self._stores.flush(), self._deletes.flush()])
+
+    def _load_counts(self):
+        global dbpool
+        def _load(tx):
+            out = []
+            for t in self.tables:
+                tx.execute('SELECT `recipient`, COUNT(*) FROM stanzas_%s GROUP BY `recipient`' % (t, ))
+                out.extend(tx.fetchall())
+            return out
+
+        def _loaded(data):
+            # stores done in the meantime are added up: counts can only be overestimated
+            for userid, count in data:
+                self._count(str(userid), int(count))
+            self._counts_loaded = True
+            log.debug("pending stanzas index loaded (%d recipients)" % (len(self._counts), ))
+
+        def _failed(failure):
+            log.warn("unable to load pending stanzas index: %s" % (failure.getErrorMessage(), ))
+
+        d = defer.gatherResults([pool.runInteraction(_load) for pool in shard_pools()], True)
+        d.addCallback(lambda results: [row for rows in results for row in rows])
+        d.addCallbacks(_loaded, _failed)
+        return d
+
+    def _count(self, userid, delta, size=0):
+        count = self._counts.get(userid, 0) + delta
+        if count > 0:
+            self._counts[userid] = count
+            self._sizes[userid] = max(self._sizes.get(userid, 0) + size, 0)
+        else:
+            self._counts.pop(userid, None)
+            self._sizes.pop(userid, None)
+
+    def expired(self):
+        # same cutoff for all tables, one table after the other
+        cutoff = int((time.time() - self.expire_time) * 1e3)
+        d = defer.succeed(None)
+        for pool in shard_pools():
+            for t in self.tables:
+                d.addCallback(lambda _, t, pool: purge('stanzas_' + t, '`timestamp`', cutoff, pool), t, pool)
+        d.addErrback(_purge_failed)
+        return d
+
+    def _do_store(self, stanza, expire=None):
+        msgId = self._stanza_id(stanza)
+        sender, recipient = self._userids(stanza)
+        if self._quota_rejects(recipient):
+            raise QuotaExceededError(recipient)
+
+        content = self._content(stanza)
         args = (
             msgId,
-            util.jid_to_userid(jid.JID(stanza['from'])),
-            util.jid_to_userid(jid.JID(stanza['to'])),
+            sender,
+            recipient,
             stanza.getAttribute('type'),
-            stanza.toXml().encode('utf-8').decode('utf-8'),
+            content,
             int(time.time()*1e3),
             expire
         )
-        # for presence we want to overwrite old requests
-        if stanza.name == 'presence':
-            # WARNING this won't work because primary key is stanza id which is always different
-            op = 'REPLACE'
-        else:
-            op = 'INSERT'
-        return dbpool.runOperation('%s INTO stanzas_%s (id, sender, recipient, type, content, timestamp, expire_timestamp) VALUES(?, ?, ?, ?, ?, ?, ?)'
-                                   % (op, stanza.name, ), args)
+        self._count(recipient, 1, self._content_size(content))
+        if shards is not None:
+            self._recipients.put(msgId, recipient)
+        d = self._stores.put(stanza.name, msgId, args)
+        if self._over_quota(self._counts.get(recipient, 0), self._sizes.get(recipient, 0)):
+            self._check_quota(recipient)
+        return d
+
+    def _check_quota(self, userid):
+        """
+        Counts the stanzas actually stored for a recipient whose counters
+        went over quota and enforces the quota policy.
+        """
+        if userid in self._checking:
+            return
+        self._checking.add(userid)
+        self.quota_stats['checks'] += 1
+
+        def _check(tx):
+            tx.execute(*self._quota_query(userid))
+            return [((str(row[0]), str(row[1])), int(row[3] or 0)) for row in tx.fetchall()]
+
+        def _checked(entries):
+            count, size = len(entries), sum(entry[1] for entry in entries)
+            if self._over_quota(count, size):
+                self._quota_exceeded(userid, count, size)
+                if self.quota_policy == 'evict':
+                    evicted = self._quota_evictions(entries)
+                    for (name, stanzaId), length in evicted:
+                        self._delete(stanzaId, name, None, userid)
+                    count -= len(evicted)
+                    size -= sum(entry[1] for entry in evicted)
+                    self._quota_evicted(userid, len(evicted))
+            # stores done while checking are counted on top of the result
+            self._count(userid, count, size)
+
+        def _failed(failure):
+            self._count(userid, *before)
+            log.warn("unable to check offline quota for %s: %s" % (userid, failure.getErrorMessage()))
+
+        def _done(result):
+            self._checking.discard(userid)
+
+        before = (self._counts.pop(userid, 0), self._sizes.pop(userid, 0))
+        # stanzas waiting in the batch queues must be written/deleted first
+        d = defer.gatherResults([self._stores.flush(), self._deletes.flush()])
+        d.addCallback(lambda _: shard_pool(userid).runInteraction(_check))
+        d.addCallbacks(_checked, _failed)
+        d.addBoth(_done)
+        return d
+
+    def _quota_query(self, userid):
+        """
+        Returns query and arguments for table, id, timestamp and size of the
+        stanzas of a recipient, oldest first.
+        """
+        q = "SELECT '%s', `id`, `timestamp`, %s FROM stanzas_%s WHERE `recipient` = ?"
+        qlist = [q % (t, self.CONTENT_LENGTH, t) for t in self.tables]
+        return ' UNION ALL '.join(qlist) + ' ORDER BY `timestamp`, `id`', [userid] * len(self.tables)
+
+    def _content(self, stanza):
+        """Returns the value for the content column."""
+        data = stanza.toXml().encode('utf-8')
+        if self.compress:
+            packed = compress_content(data)
+            if packed is not data:
+                return packed
+        return data.decode('utf-8')
+
+    def _content_size(self, content):
+        """Returns the size in bytes of a content column value (quota is on bytes)."""
+        if isinstance(content, unicode):
+            return len(content.encode('utf-8'))
+        return len(content)
+
+    def _userids(self, stanza):
+        """Returns the values for the sender and recipient columns."""
+        return util.jid_to_userid(jid.JID(stanza['from'])), util.jid_to_userid(jid.JID(stanza['to']))
+
+    def _flush_stores(self, name, rows):
+        """Writes a batch of stanzas to a table with a single multi-row INSERT."""
+        global dbpool
+        op = self.STORE_OPS.get(name, self.STORE_OP)
+        query = '%s INTO stanzas_%s (id, sender, recipient, type, content, timestamp, expire_timestamp) VALUES ' % (op, name, )
+        values = '(?, ?, ?, ?, ?, ?, ?)'
 
-    def _cancel_pending(self, stanzaId):
-        if stanzaId in self._pending_offline:
-            if self._pending_offline[stanzaId][0].active():
-                self._pending_offline[stanzaId][0].cancel()
-                del self._pending_offline[stanzaId]
-                return True
-        return False
+        def _insert(tx, rows, error):
+            """Returns id: exception of the rows that could not be written."""
+            failures = {}
+            try:
+                tx.execute(query + ', '.join([values] * len(rows)), [v for row in rows for v in row])
+            except error, e:
+                if len(rows) == 1:
+                    failures[rows[0][0]] = e
+                    return failures
+                # one bad row fails the whole statement, retry rows one by one;
+                # rows already written (e.g. on MyISAM) are written again
+                # harmlessly, store ops ignore or replace duplicate ids
+                log.debug("multi-row insert failed, storing %d stanzas one at a time" % (len(rows), ))
+                for row in rows:
+                    try:
+                        tx.execute(query + values, row)
+                    except error, e:
+                        log.warn("unable to store offline stanza %s: %s" % (row[0], e))
+                        failures[row[0]] = e
+            return failures
+
+        def _written(result):
+            written(*set(row[2] for row in rows))
+            return result
+
+        def _check(results):
+            failures = {}
+            for (success, result), shard_rows in zip(results, byshard.itervalues()):
+                if success:
+                    failures.update(result)
+                else:
+                    # the whole shard failed
+                    failures.update((row[0], result.value) for row in shard_rows)
+            if failures:
+                raise BatchItemsFailed(failures)
+
+        # one statement for each shard
+        byshard = OrderedDict()
+        for row in rows:
+            byshard.setdefault(shard_pool(row[2]), []).append(row)
+        dlist = [pool.runInteraction(_insert, shard_rows, pool.dbapi.Error) for pool, shard_rows in byshard.iteritems()]
+        d = defer.DeferredList(dlist, consumeErrors=True)
+        d.addCallback(_check)
+        return d.addBoth(_written)
 
     def get_by_id(self, stanzaId):
         global dbpool
@@ -330,102 +1281,503 @@ class MySQLStanzaStorage(StanzaStorage):
         #return dbpool.runQuery('SELECT id, recipient, content, timestamp FROM stanzas WHERE sender = ?', sender)
         raise NotImplementedError()
 
-    def get_by_recipient(self, recipient):
+    def get_by_recipient(self, recipient, after=None, limit=None):
         global dbpool
         def _translate(tx, recipient, out):
-            qlist = ['SELECT `id`, `timestamp`, `content`, `expire_timestamp` FROM stanzas_%s WHERE `recipient` = ?' % (t, )
-                     for t in self.tables]
-            qargs = [recipient.user for t in self.tables]
+            q, qargs = self._recipient_query(recipient.user, after, limit)
 
-            tx.execute('SELECT * FROM (' + ' UNION '.join(qlist) + ') a ORDER BY `timestamp`', qargs)
+            tx.execute(q, qargs)
             data = tx.fetchall()
             for row in data:
-                stanzaId = str(row[0])
-                d = {
-                     'id': stanzaId,
-                     'timestamp': datetime.datetime.utcfromtimestamp(row[1] / 1e3),
-                     'expire': datetime.datetime.utcfromtimestamp(row[3]) if row[3] else None
-                }
-                d['stanza'] = generic.parseXml(row[2].decode('utf-8').encode('utf-8'))
-
-                """
-                Add a <storage/> element to the stanza; this way components have
-                a way to know if stanza is coming from storage.
-                """
-                stor = d['stanza'].addElement((xmlstream2.NS_XMPP_STORAGE, 'storage'))
-                stor['id'] = stanzaId
-
-                out.append(d)
+                content = row[2]
+                if isinstance(content, unicode):
+                    content = content.encode('utf-8')
+                else:
+                    content = str(content)
+                read[1] += len(content)
+                out.append(self._stored_stanza(str(row[0]), row[1], content, row[3]))
+            return out
+
+        def _remember(out):
+            # remember recipients of stanzas about to be deleted
+            for msg in out:
+                if 'cursor' in msg:
+                    self._recipients.put(msg['id'], recipient.user)
             return out
 
-        # include any pending message?
+        # include any pending message? (first page only)
         out = []
-        for stanzaId, pend in self._pending_offline.iteritems():
-            delayed, stanza, unused = pend
-            if util.jid_user(stanza['to']) == recipient.user:
-                stanza.consumed = False
-                out.append({'id': stanzaId, 'stanza': stanza})
-                # reset delayed timer
-                delayed.reset(self.OFFLINE_STORE_DELAY)
+        if after is None:
+            out = self._pending_for(recipient)
+
+        if after is None and not out and self._counts_loaded and recipient.user not in self._counts:
+            # nothing stored for this user
+            return defer.succeed(out)
+
+        def _counted(out):
+            # a full read tells exactly how many stanzas are stored
+            stored = len([msg for msg in out if 'cursor' in msg])
+            if stored:
+                # stanzas are going to be deleted by the recipient
+                written(recipient.user)
+                self._capped.pop(recipient.user, None)
+            # replicas may lag: only a full read from the primary is exact
+            if primary[0] and (not limit or stored < limit):
+                self._count(recipient.user, stored, read[1])
+            else:
+                self._count(recipient.user, *before)
+            return out
+
+        def _failed(failure):
+            self._count(recipient.user, *before)
+            return failure
+
+        def _read(unused):
+            # chosen after the flush: writes pin the recipient to the primary
+            if shards is None:
+                pool = readpool(recipient.user)
+            else:
+                pool = shard_pool(recipient.user)
+            primary.append(pool is dbpool or shards is not None)
+            return pool.runInteraction(_translate, recipient, out)
+
+        # stanzas and bytes read
+        read = [0, 0]
+        # whether the read went to the primary
+        primary = []
+
+        # stanzas waiting in the batch queues must be written/deleted first
+        d = defer.gatherResults([self._stores.flush(), self._deletes.flush()])
+        d.addCallback(_read)
+        d.addCallback(self._unique)
+
+        if shards is not None:
+            d.addCallback(_remember)
+        if after is None:
+            # stores done while reading will be counted again on top of the result
+            before = (self._counts.pop(recipient.user, 0), self._sizes.pop(recipient.user, 0))
+            d.addCallbacks(_counted, _failed)
+        return d
+
+    def _recipient_query(self, userid, after=None, limit=None):
+        """
+        Returns query and arguments for a page of stanzas of a recipient,
+        ordered by (timestamp, id).
+        """
+        q = 'SELECT `id`, `timestamp`, `content`, `expire_timestamp` FROM stanzas_%s WHERE `recipient` = ?'
+        args = [userid]
+        if after is not None:
+            # keyset pagination: (timestamp, id) > after
+            q += ' AND `timestamp` >= ? AND (`timestamp` > ? OR `id` > ?)'
+            args += [after[0], after[0], after[1]]
+
+        order = ' ORDER BY `timestamp`, `id`'
+        if limit:
+            order += ' LIMIT %d' % (limit, )
+            # each table contributes at most limit rows
+            qlist = ['SELECT * FROM (' + (q % (t, )) + order + ') page_%s' % (t, ) for t in self.tables]
+        else:
+            qlist = [q % (t, ) for t in self.tables]
 
-        return dbpool.runInteraction(_translate, recipient, out)
+        return (' %s ' % (self.RECIPIENT_UNION, )).join(qlist) + order, args * len(self.tables)
 
     def delete(self, stanzaId, stanzaName, sender=None, recipient=None):
         # check if message is pending to offline
         if self._cancel_pending(stanzaId):
             return True
 
+        # check if message is still waiting for its batch to be written
+        row = self._stores.get(stanzaName, stanzaId)
+        if row and (not sender or row[1].startswith(sender)) and \
+                (not recipient or row[2].startswith(recipient)):
+            self._count(row[2], -1, -self._content_size(row[4]))
+            return self._stores.cancel(stanzaName, stanzaId)
+
         return self._delete(stanzaId, stanzaName, sender, recipient)
 
     def _delete(self, stanzaId, stanzaName, sender=None, recipient=None):
-        global dbpool
         #import traceback
         #log.debug("deleting stanza %s -- traceback:\n%s" % (stanzaId, ''.join(traceback.format_stack())))
-        q = 'DELETE FROM stanzas_%s WHERE id = ?' % (stanzaName, )
-        args = [stanzaId]
+        # deletes sharing table and guards end up in the same batch
+        return self._deletes.put((stanzaName, sender, recipient), stanzaId, stanzaId)
+
+    def _flush_deletes(self, key, ids):
+        """
+        Deletes a batch of stanzas from a table with a single DELETE for each
+        shard. Stanzas with unknown recipient are deleted from all shards.
+        """
+        stanzaName, sender, recipient = key
+        guards, guard_args = self._delete_guards(sender, recipient)
+        if recipient:
+            written(recipient)
+
+        byshard = OrderedDict()
+        if recipient or shards is None:
+            byshard[shard_pool(recipient or '')] = list(ids)
+        else:
+            unknown = []
+            for stanzaId in ids:
+                found, userid = self._recipients.get(stanzaId)
+                if found:
+                    byshard.setdefault(shard_pool(userid), []).append(stanzaId)
+                else:
+                    unknown.append(stanzaId)
+            if unknown:
+                for pool in shard_pools():
+                    byshard.setdefault(pool, []).extend(unknown)
+
+        dlist = []
+        for pool, shard_ids in byshard.iteritems():
+            q = 'DELETE FROM stanzas_%s WHERE id IN (%s)' % (stanzaName, ', '.join(['?'] * len(shard_ids)))
+            dlist.append(pool.runOperation(q + guards, shard_ids + guard_args))
+        return _gather(dlist)
+
+    def _delete_guards(self, sender, recipient):
+        """Returns the conditions (and arguments) for optional delete guards."""
+        q, args = '', []
         if sender:
             q += ' AND sender LIKE ?'
             args.append(sender + '%')
         if recipient:
             q += ' AND recipient LIKE ?'
             args.append(recipient + '%')
+        return q, args
+
+
+class MySQLStanzaStorageV2(MySQLStanzaStorage):
+    """
+    Stanza storage for the v2 offline schema (InnoDB, see
+    data/schema-stanzas-v2.sql and data/updates/stanzas-v2.sql).
+    Sender and recipient columns hold bare user ids, so delete guards are
+    exact matches and every per-table query can use the (recipient, timestamp)
+    index.
+    """
+
+    """Ids are unique across tables: skip duplicate elimination."""
+    RECIPIENT_UNION = 'UNION ALL'
+
+    def _userids(self, stanza):
+        return util.jid_user(stanza['from']), util.jid_user(stanza['to'])
+
+    def _delete_guards(self, sender, recipient):
+        q, args = '', []
+        if sender:
+            q += ' AND sender = ?'
+            args.append(sender)
+        if recipient:
+            q += ' AND recipient = ?'
+            args.append(recipient)
+        return q, args
+
+
+class MailboxStanzaStorage(DelayedStanzaStorage):
+    """
+    Stanza storage on append-only mailbox files, one directory per recipient
+    (see L{mailbox.Mailbox}).
+    Stores and deletes are small appends; reads use memory mapped segments.
+    File I/O runs in a writer thread, mailbox indexes are kept in the
+    reactor thread. Mailboxes with many deleted records are compacted
+    periodically, one at a time.
+    """
+
+    """Interval in seconds between compaction runs."""
+    COMPACT_INTERVAL = 60
+
+    def __init__(self, path, expire_time=0):
+        self.path = path
+        # recipient: Mailbox
+        self._boxes = {}
+        # stanza id: recipient
+        self._index = {}
+        # recipients with deleted records
+        self._dirty = set()
+        self._compacting = None
+        self._writer = util.SerialThread('mailbox')
+        self._load()
+        DelayedStanzaStorage.__init__(self, expire_time)
+        self._compactor = LoopingCall(self.compact)
+        self._compactor.start(self.COMPACT_INTERVAL, now=False)
+
+    def _load(self):
+        try:
+            prefixes = os.listdir(self.path)
+        except OSError:
+            os.makedirs(self.path)
+            return
+
+        for prefix in prefixes:
+            for name in os.listdir(os.path.join(self.path, prefix)):
+                userid = mailbox.mailbox_userid(name)
+                box = mailbox.Mailbox(os.path.join(self.path, prefix, name), self._writer)
+                box.load()
+                self._boxes[userid] = box
+                for stanzaId in box.live:
+                    self._index[stanzaId] = userid
+                if box.dead:
+                    self._dirty.add(userid)
+
+        log.debug("loaded %d mailboxes (%d stanzas)" % (len(self._boxes), len(self._index)))
+
+    def _do_store(self, stanza, expire=None):
+        msgId = self._stanza_id(stanza)
+        sender = util.jid_user(stanza['from'])
+        recipient = util.jid_user(stanza['to'])
+
+        # same id stored again for someone else
+        previous = self._index.get(msgId)
+        if previous and previous != recipient:
+            self._remove(msgId, previous)
+
+        content = stanza.toXml().encode('utf-8')
+        if self.compress:
+            content = compress_content(content)
+
+        box = self._boxes.get(recipient)
+        if box is not None and self.quota_policy == 'reject':
+            # live records are counted exactly: check with the new one
+            count, size = len(box), box.size - box.dead + mailbox.record_size(msgId, sender, content)
+            if msgId in box:
+                size -= box.live[msgId][2]
+            else:
+                count += 1
+            if self._over_quota(count, size):
+                self._quota_exceeded(recipient, len(box), box.size - box.dead)
+                self.quota_stats['rejected'] += 1
+                raise QuotaExceededError(recipient)
+
+        if box is None:
+            # anything left on disk is being removed by compaction
+            box = self._boxes[recipient] = mailbox.Mailbox(mailbox.mailbox_dir(self.path, recipient), self._writer)
+        d = box.append(msgId, sender, int(time.time()*1e3), expire, content)
+        self._index[msgId] = recipient
+
+        if self.quota_policy == 'evict' and self._over_quota(len(box), box.size - box.dead):
+            self._quota_exceeded(recipient, len(box), box.size - box.dead)
+            entries = sorted((entry[3], stanzaId, entry[2]) for stanzaId, entry in box.live.iteritems())
+            evicted = self._quota_evictions([(e[1], e[2]) for e in entries])
+            for stanzaId, length in evicted:
+                self._remove(stanzaId, recipient)
+            self._quota_evicted(recipient, len(evicted))
+        return d.addCallback(lambda _: msgId)
+
+    def _remove(self, stanzaId, recipient, sender=None):
+        d = self._boxes[recipient].remove(stanzaId, sender)
+        if d is None:
+            return False
+
+        d.addErrback(self._io_failed, recipient)
+        del self._index[stanzaId]
+        self._dirty.add(recipient)
+        return True
+
+    def _io_failed(self, failure, userid):
+        log.warn("mailbox %s: %s" % (userid, failure.getErrorMessage()))
+
+    def _flush_queues(self):
+        # wait for the writes requested so far
+        return self._writer.run(lambda: None)
+
+    def get_by_recipient(self, recipient, after=None, limit=None):
+        # include any pending message? (first page only)
+        out = []
+        if after is None:
+            out = self._pending_for(recipient)
+
+        box = self._boxes.get(recipient.user)
+        if not box:
+            return defer.succeed(self._unique(out))
+
+        def _read(records):
+            for stanzaId, timestamp, expire, content in records:
+                out.append(self._stored_stanza(stanzaId, timestamp, content, expire))
+            return self._unique(out)
+        return box.read(after, limit).addCallback(_read)
+
+    def delete(self, stanzaId, stanzaName, sender=None, recipient=None):
+        # check if message is pending to offline
+        if self._cancel_pending(stanzaId):
+            return True
+
+        userid = self._index.get(stanzaId)
+        if userid is None or (recipient and userid != recipient):
+            return False
+        return self._remove(stanzaId, userid, sender)
+
+    def expired(self):
+        limit = int((time.time() - self.expire_time) * 1e3)
+        count = 0
+        for userid, box in self._boxes.items():
+            for stanzaId, entry in box.live.items():
+                if entry[3] < limit:
+                    count += self._remove(stanzaId, userid)
+        if count:
+            log.debug("purged %d expired stanzas" % (count, ))
+
+    def compact(self):
+        """Compacts mailboxes with deleted records."""
+        if self._compacting is None and self._dirty:
+            self._compacting = task.cooperate(self._compact_boxes()).whenDone()
+            self._compacting.addBoth(self._compacted)
+        return self._compacting
+
+    def _compacted(self, result):
+        self._compacting = None
+        return result
+
+    def _compact_boxes(self):
+        # one mailbox per cooperator iteration
+        while self._dirty:
+            userid = self._dirty.pop()
+            box = self._boxes.get(userid)
+            if box is not None and box.needs_compaction():
+                d = box.compact()
+                if not box.live:
+                    del self._boxes[userid]
+                yield d.addErrback(self._io_failed, userid)
 
-        return dbpool.runOperation(q, args)
 
 class MySQLNetworkStorage(NetworkStorage):
 
-    def get_list(self):
-        # WARNING accessing Twisted internals and *blocking*
-        global dbpool
-        conn = dbpool.connectionFactory(dbpool)
-        tx = dbpool.transactionFactory(dbpool, conn)
+    def _fetch_list(self, tx):
         tx.execute('SELECT fingerprint, host, enabled FROM servers ORDER BY fingerprint')
-        data = tx.fetchall()
         out = OrderedDict()
-        for row in data:
+        for row in tx.fetchall():
             # { fingerprint: {host, enabled} }
             out[str(row[0]).upper()] = { 'host' : str(row[1]), 'enabled' : int(row[2]) }
         return out
 
+    def get_list(self):
+        return readpool().runInteraction(self._fetch_list)
+
+    def load_list(self):
+        global dbpool
+        # connection for the calling thread, dropped when done
+        conn = dbpool.connect()
+        try:
+            return self._fetch_list(conn.cursor())
+        finally:
+            dbpool.disconnect(conn)
+
 class MySQLPresenceStorage(PresenceStorage):
+    """
+    Presence storage with write-behind: presence and last seen updates are
+    kept in memory (latest values for each user) and written in batches.
+    Reads include pending writes.
+    Every write gives the row a new version (microseconds since the epoch,
+    strictly increasing), so peers can ask for changes since a known version.
+    """
+
+    """Maximum number of users written in a single batch."""
+    WRITE_BATCH_SIZE = 100
+    """Maximum time in seconds a presence update is held in memory."""
+    WRITE_BATCH_DELAY = 0.5
+    """Maximum number of users in the read cache."""
+    CACHE_SIZE = 10000
+    """Seconds a cached presence is considered valid."""
+    CACHE_TTL = 10
+
+    def __init__(self):
+        # pending writes by userid (single batch key)
+        self._writes = BatchQueue(self._flush_writes, self.WRITE_BATCH_SIZE, self.WRITE_BATCH_DELAY)
+        # results of get(), invalidated by local writes
+        self.cache = LRUCache(self.CACHE_SIZE, self.CACHE_TTL)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._writes.flush)
+        # last assigned version and versions being written
+        self._version = 0
+        self._inflight = set()
+        # waiting for the last stored version (None when loaded)
+        self._version_waiters = []
+        d = dbpool.runQuery('SELECT MAX(version) FROM presence')
+        d.addCallback(self._last_version)
+        d.addErrback(lambda failure: log.warn("unable to read presence version: %s" % (failure.getErrorMessage(), )))
+        d.addCallback(self._version_loaded)
+
+    def _last_version(self, rows):
+        if rows and rows[0][0]:
+            self._version = max(self._version, rows[0][0])
+
+    def _version_loaded(self, unused):
+        waiters, self._version_waiters = self._version_waiters, None
+        for d in waiters:
+            d.callback(None)
+
+    def _wait_version(self):
+        """Returns a L{Deferred} fired once the last stored version is known."""
+        if self._version_waiters is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._version_waiters.append(d)
+        return d
+
+    def _next_version(self, count=1):
+        """Allocates count consecutive versions, returning the first one."""
+        first = max(self._version + 1, int(time.time() * 1000000))
+        self._version = first + count - 1
+        return first
+
+    def _versioned(self, d, version):
+        """Tracks a write of the given version until it completes."""
+        def _done(result):
+            self._inflight.discard(version)
+            return result
+        self._inflight.add(version)
+        return d.addBoth(_done)
+
+    def committed_version(self):
+        """Returns the highest version with no writes still in progress below it."""
+        if self._inflight:
+            return min(self._inflight) - 1
+        return self._version
+
+    def _decode(self, data):
+        return {
+            'userid': data[0],
+            'timestamp': data[1],
+            'status': base64.b64decode(data[2]).decode('utf-8') if data[2] is not None else '',
+            'show': data[3],
+            'priority': data[4],
+            'fingerprint': data[5],
+            'version': data[6]
+        }
+
+    def _pending(self, data, pending):
+        """Applies a pending write to a presence entry (None if not stored yet)."""
+        if data is None:
+            if 'status' not in pending:
+                # touch only updates existing entries
+                return None
+            data = {'userid': pending['userid'], 'fingerprint': None}
+
+        data['timestamp'] = pending['timestamp']
+        if 'status' in pending:
+            data['status'] = base64.b64decode(pending['status']).decode('utf-8') if pending['status'] is not None else ''
+            data['show'] = pending['show']
+            data['priority'] = pending['priority']
+        return data
 
     def get(self, userid):
         def _fetchone(tx, query, args):
             tx.execute(query, args)
             data = tx.fetchone()
             if data:
-                return {
-                    'userid': data[0],
-                    'timestamp': data[1],
-                    'status': base64.b64decode(data[2]).decode('utf-8') if data[2] is not None else '',
-                    'show': data[3],
-                    'priority': data[4],
-                    'fingerprint': data[5]
-                }
-
-        query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint` FROM presence WHERE userid = ? AND `timestamp` IS NOT NULL'
-        args = (userid[:util.USERID_LENGTH], )
-        return dbpool.runInteraction(_fetchone, query, args)
+                return self._decode(data)
+
+        def _overlay(data, userid, generation):
+            pending = self._writes.get('presence', userid)
+            if pending:
+                data = self._pending(data, pending)
+            self.cache.put(userid, data, generation)
+            return dict(data) if data else data
+
+        userid = userid[:util.USERID_LENGTH]
+        found, data = self.cache.get(userid)
+        if found:
+            return defer.succeed(dict(data) if data else data)
+
+        query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint`, `version` FROM presence WHERE userid = ? AND `timestamp` IS NOT NULL'
+        d = readpool(userid).runInteraction(_fetchone, query, (userid, ))
+        d.addCallback(_overlay, userid, self.cache.generation)
+        return d
 
     def get_all(self):
         def _fetchall(tx, query):
@@ -433,21 +1785,56 @@ class MySQLPresenceStorage(PresenceStorage):
             out = []
             rows = tx.fetchall()
             for data in rows:
-                out.append({
-                    'userid': data[0],
-                    'timestamp': data[1],
-                    'status': base64.b64decode(data[2]).decode('utf-8') if data[2] is not None else '',
-                    'show': data[3],
-                    'priority': data[4],
-                    'fingerprint': data[5],
-                })
+                out.append(self._decode(data))
             return out
 
-        query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint` FROM presence WHERE `timestamp` IS NOT NULL'
-        return dbpool.runInteraction(_fetchall, query)
+        def _overlay(out):
+            pending = dict((values['userid'], values) for values in self._writes.items('presence'))
+            for data in out:
+                values = pending.pop(data['userid'], None)
+                if values:
+                    self._pending(data, values)
+            # new users
+            for values in pending.itervalues():
+                data = self._pending(None, values)
+                if data:
+                    out.append(data)
+            return out
+
+        query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint`, `version` FROM presence WHERE `timestamp` IS NOT NULL'
+        d = readpool().runInteraction(_fetchall, query)
+        d.addCallback(_overlay)
+        return d
+
+    def get_changes(self, since, limit, until=None):
+        def _fetchall(tx, query, args):
+            tx.execute(query, args)
+            return [self._decode(data) for data in tx.fetchall()]
+
+        def _query(unused, since, until):
+            # many rows can share a version (e.g. migrated ones)
+            if isinstance(since, tuple):
+                where = '(`version` > ? OR (`version` = ? AND `userid` > ?))'
+                args = (since[0], since[0], since[1])
+            else:
+                where = '`version` > ?'
+                args = (since, )
+            if until is None:
+                until = self.committed_version()
+
+            query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint`, `version` FROM presence ' \
+                'WHERE ' + where + ' AND `version` <= ? AND `timestamp` IS NOT NULL ORDER BY `version`, `userid` LIMIT ?'
+            return dbpool.runInteraction(_fetchall, query, args + (until, limit))
+
+        return self._wait_version().addCallback(_query, since, until)
+
+    def sync_version(self):
+        d = defer.DeferredList([self._writes.flush(), self._wait_version()], consumeErrors=True)
+        # the version is returned even if some write failed
+        d.addBoth(lambda unused: self.committed_version())
+        return d
 
     def presence(self, stanza):
-        global dbpool
         userid = util.jid_user(stanza['from'])
 
         def encode_not_empty(val):
@@ -462,22 +1849,76 @@ class MySQLPresenceStorage(PresenceStorage):
         except:
             priority = 0
 
-        status = encode_not_empty(stanza.status)
-        show = encode_not_empty(stanza.show)
-        values = (userid, status, show, priority, status, show, priority)
-        return dbpool.runOperation('INSERT INTO presence (`userid`, `timestamp`, `status`, `show`, `priority`) VALUES(?, UTC_TIMESTAMP(), ?, ?, ?) ON DUPLICATE KEY UPDATE `timestamp` = UTC_TIMESTAMP(), `status` = ?, `show` = ?, `priority` = ?', values)
+        return self._write(userid, {
+            'timestamp': datetime.datetime.utcnow(),
+            'status': encode_not_empty(stanza.status),
+            'show': encode_not_empty(stanza.show),
+            'priority': priority,
+        })
 
     def touch(self, userid):
+        return self._write(userid, {'timestamp': datetime.datetime.utcnow()})
+
+    def _write(self, userid, values):
+        """Queues a write for a user, merged into any pending one (last write wins)."""
+        self.cache.invalidate(userid)
+        pending = self._writes.get('presence', userid)
+        if pending:
+            pending = dict(pending)
+            pending.update(values)
+            values = pending
+        else:
+            values['userid'] = userid
+        return self._writes.put('presence', userid, values)
+
+    def _flush_writes(self, key, rows):
         global dbpool
-        return dbpool.runOperation('UPDATE presence SET `timestamp` = UTC_TIMESTAMP() WHERE userid = ?', (userid, ))
+        def _write(tx, rows):
+            upserts = [values for values in rows if 'status' in values]
+            if upserts:
+                self._upsert(tx, upserts)
+            for values in rows:
+                if 'status' not in values:
+                    tx.execute('UPDATE presence SET `timestamp` = ?, `version` = ? WHERE userid = ?',
+                        (values['timestamp'], values['version'], values['userid']))
+
+        first = self._next_version(len(rows))
+        rows = [dict(values, version=first + i) for i, values in enumerate(rows)]
+        d = self._versioned(dbpool.runInteraction(_write, rows), first)
+        # reads done while writing saw neither the pending write nor the new row
+        return self._invalidate(d, *[values['userid'] for values in rows])
+
+    def _upsert(self, tx, rows):
+        """Writes full presence entries with a single multi-row upsert."""
+        tx.execute('INSERT INTO presence (`userid`, `timestamp`, `status`, `show`, `priority`, `version`) VALUES ' +
+            ', '.join(['(?, ?, ?, ?, ?, ?)'] * len(rows)) +
+            ' ON DUPLICATE KEY UPDATE `timestamp` = VALUES(`timestamp`), `status` = VALUES(`status`), `show` = VALUES(`show`), `priority` = VALUES(`priority`), `version` = VALUES(`version`)',
+            [v for values in rows for v in (values['userid'], values['timestamp'], values['status'], values['show'], values['priority'], values['version'])])
 
     def public_key(self, userid, fingerprint):
         global dbpool
-        return dbpool.runOperation('INSERT INTO presence (userid, fingerprint) VALUES(?, ?) ON DUPLICATE KEY UPDATE fingerprint = ?', (userid, fingerprint, fingerprint))
+        version = self._next_version()
+        d = dbpool.runOperation('INSERT INTO presence (userid, fingerprint, version) VALUES(?, ?, ?) ON DUPLICATE KEY UPDATE fingerprint = ?, version = ?',
+            (userid, fingerprint, version, fingerprint, version))
+        return self._invalidate(self._versioned(d, version), userid)
 
     def delete(self, userid):
         global dbpool
-        return dbpool.runOperation('DELETE FROM presence WHERE userid = ?', (userid, ))
+        self._writes.cancel('presence', userid)
+        return self._invalidate(dbpool.runOperation('DELETE FROM presence WHERE userid = ?', (userid, )), userid)
+
+    def _invalidate(self, d, *userids):
+        """
+        Invalidates cached entries now and again when the write is done; the
+        users are read from the primary database for a while.
+        """
+        def _done(result):
+            for userid in userids:
+                self.cache.invalidate(userid)
+            written(*userids)
+            return result
+        _done(None)
+        return d.addBoth(_done)
 
 
 class MySQLUserValidationStorage(UserValidationStorage):
@@ -486,7 +1927,9 @@ class MySQLUserValidationStorage(UserValidationStorage):
     TEXT_INVALID_CODE = 'Invalid validation code.'
 
     def expired(self):
-        return dbpool.runOperation('DELETE FROM validations WHERE UNIX_TIMESTAMP() > (UNIX_TIMESTAMP(timestamp) + %d)' % (self.expire_time, ))
+        # codes are registered with sysdate(), i.e. local time
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.expire_time)
+        return purge('validations', '`timestamp`', cutoff).addErrback(_purge_failed)
 
     def register(self, key, code=None):
         global dbpool
@@ -576,3 +2019,118 @@ class DiskFileStorage(FileStorage):
         f.close()
 
         return filename
+
+
+""" SQLite backend """
+
+
+# SQLite schema, created on first connection
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+  userid CHAR(40) NOT NULL PRIMARY KEY,
+  timestamp TIMESTAMP DEFAULT NULL,
+  status VARCHAR(500) DEFAULT NULL,
+  show VARCHAR(30) DEFAULT NULL,
+  priority SMALLINT NOT NULL DEFAULT 0,
+  fingerprint CHAR(40) DEFAULT NULL,
+  version BIGINT NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS presence_version ON presence (version, userid);
+
+CREATE TABLE IF NOT EXISTS servers (
+  fingerprint CHAR(40) NOT NULL PRIMARY KEY,
+  host VARCHAR(100) NOT NULL,
+  enabled BOOLEAN NOT NULL DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS validations (
+  userid CHAR(40) NOT NULL PRIMARY KEY,
+  code CHAR(6) NOT NULL UNIQUE,
+  timestamp TIMESTAMP DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS validations_timestamp ON validations (timestamp);
+""" + ''.join(["""
+CREATE TABLE IF NOT EXISTS stanzas_%(name)s (
+  id VARCHAR(30) NOT NULL PRIMARY KEY,
+  sender VARCHAR(48) NOT NULL,
+  recipient VARCHAR(48) NOT NULL,
+  type VARCHAR(15) DEFAULT NULL,
+  content TEXT NOT NULL,
+  timestamp BIGINT NOT NULL,
+  expire_timestamp TIMESTAMP DEFAULT NULL%(unique)s
+);
+CREATE INDEX IF NOT EXISTS stanzas_%(name)s_recipient ON stanzas_%(name)s (recipient, timestamp);
+CREATE INDEX IF NOT EXISTS stanzas_%(name)s_expire ON stanzas_%(name)s (expire_timestamp);
+CREATE INDEX IF NOT EXISTS stanzas_%(name)s_timestamp ON stanzas_%(name)s (timestamp);
+""" % {'name': name, 'unique': unique} for name, unique in (
+    ('iq', ''),
+    ('message', ''),
+    ('presence', ',\n  UNIQUE (sender, recipient, type)'),
+)])
+
+
+def _sqlite_open(conn):
+    # WAL: readers don't block the writer and commits are cheaper
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.executescript(SQLITE_SCHEMA)
+
+
+class SQLiteStanzaStorage(MySQLStanzaStorageV2):
+    """
+    Stanza storage on SQLite.
+    Uses the v2 layout (bare user ids); batched stores are written in a
+    single transaction like the MySQL storage.
+    """
+
+    STORE_OP = 'INSERT OR IGNORE'
+    # LENGTH() counts characters of text values
+    CONTENT_LENGTH = 'LENGTH(CAST(`content` AS BLOB))'
+
+    def _content(self, stanza):
+        content = MySQLStanzaStorageV2._content(self, stanza)
+        # compressed data must be bound as a blob
+        if isinstance(content, str):
+            return buffer(content)
+        return content
+
+
+class SQLitePresenceStorage(MySQLPresenceStorage):
+    """Presence storage on SQLite."""
+
+    def _upsert(self, tx, rows):
+        for values in rows:
+            tx.execute('INSERT OR IGNORE INTO presence (`userid`) VALUES(?)', (values['userid'], ))
+            tx.execute('UPDATE presence SET `timestamp` = ?, `status` = ?, `show` = ?, `priority` = ?, `version` = ? WHERE userid = ?',
+                (values['timestamp'], values['status'], values['show'], values['priority'], values['version'], values['userid']))
+
+    def public_key(self, userid, fingerprint):
+        global dbpool
+        version = self._next_version()
+        def _upsert(tx):
+            tx.execute('INSERT OR IGNORE INTO presence (userid) VALUES(?)', (userid, ))
+            tx.execute('UPDATE presence SET fingerprint = ?, version = ? WHERE userid = ?', (fingerprint, version, userid))
+        return self._invalidate(self._versioned(dbpool.runInteraction(_upsert), version), userid)
+
+
+class SQLiteNetworkStorage(MySQLNetworkStorage):
+    """Network storage on SQLite (same queries as MySQL)."""
+    pass
+
+
+class SQLiteUserValidationStorage(MySQLUserValidationStorage):
+    """User validation storage on SQLite."""
+
+    def expired(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.expire_time)
+        return purge('validations', '`timestamp`', cutoff).addErrback(_purge_failed)
+
+    def register(self, key, code=None):
+        global dbpool
+
+        if not code:
+            code = util.rand_str(self.VALIDATION_CODE_LENGTH, util.CHARSBOX_NUMBERS)
+
+        d = dbpool.runOperation('INSERT INTO validations VALUES (?, ?, ?)', (key, code, datetime.datetime.utcnow()))
+        d.addCallback(lambda _: code)
+        return d
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Timer wheel for large numbers of coarse timers."""
+"""
+  Kontalk XMPP server
+  Copyright (C) 2014 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import traceback
+
+from twisted.internet import reactor, error
+
+
+class WheelCall(object):
+    """
+    A call scheduled on a L{TimerWheel}. Same interface as the
+    L{IDelayedCall} used by the rest of the server.
+    """
+
+    def __init__(self, wheel, func, args, kw):
+        self.wheel = wheel
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.time = None
+        self.tick = None
+        self.called = False
+        self.cancelled = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        elif self.called:
+            raise error.AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+
+    def reset(self, secondsFromNow):
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        elif self.called:
+            raise error.AlreadyCalled
+        self.wheel._remove(self)
+        self.wheel._add(self, secondsFromNow)
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel: calls are kept in a ring of buckets, one for each
+    tick of resolution seconds, so scheduling and cancelling a call is O(1).
+    A single reactor call, scheduled only while there is something to fire,
+    runs the due calls of each tick. Calls are fired late by up to one tick,
+    never early.
+    """
+
+    def __init__(self, resolution=0.5, size=512, clock=None):
+        self.clock = clock or reactor
+        self.resolution = resolution
+        self._buckets = [set() for i in xrange(size)]
+        self._count = 0
+        # last tick processed
+        self._tick = self._now_tick()
+        self._ticker = None
+
+    def __len__(self):
+        return self._count
+
+    def _now_tick(self):
+        return int(self.clock.seconds() / self.resolution)
+
+    def callLater(self, delay, func, *args, **kw):
+        """Schedules a call, see L{IReactorTime.callLater}."""
+        call = WheelCall(self, func, args, kw)
+        self._add(call, delay)
+        return call
+
+    def _add(self, call, delay):
+        call.time = self.clock.seconds() + delay
+        # round up, but never to a tick already processed
+        call.tick = max(int(math.ceil(call.time / self.resolution)), self._tick + 1)
+        self._buckets[call.tick % len(self._buckets)].add(call)
+        self._count += 1
+        if self._ticker is None:
+            self._schedule()
+
+    def _remove(self, call):
+        bucket = self._buckets[call.tick % len(self._buckets)]
+        if call not in bucket:
+            # being fired
+            return
+        bucket.remove(call)
+        self._count -= 1
+        if self._count == 0 and self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+
+    def _schedule(self):
+        now = self.clock.seconds()
+        # a long idle time: nothing to process in the past
+        self._tick = max(self._tick, int(now / self.resolution) - 1)
+        delay = (self._tick + 1) * self.resolution - now
+        self._ticker = self.clock.callLater(max(delay, 0), self._advance)
+
+    def _advance(self):
+        self._ticker = None
+        current = self._now_tick()
+        size = len(self._buckets)
+
+        due = []
+        for tick in xrange(self._tick + 1, min(current, self._tick + size) + 1):
+            bucket = self._buckets[tick % size]
+            # calls for the next rounds stay in the bucket
+            expired = [call for call in bucket if call.tick <= current]
+            bucket.difference_update(expired)
+            due.extend(expired)
+        self._tick = current
+        self._count -= len(due)
+
+        for call in sorted(due, key=lambda call: call.time):
+            # cancelled or reset by a previous call
+            if call.cancelled or call.tick > current:
+                continue
+            call.called = True
+            try:
+                call.func(*call.args, **call.kw)
+            except:
+                traceback.print_exc()
+
+        if self._count > 0 and self._ticker is None:
+            self._schedule()
+
+
+# timer wheel shared by the whole process
+wheel = TimerWheel()
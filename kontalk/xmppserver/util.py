@@ -24,7 +24,8 @@ import mimetypes
 
 from zope.interface import implements
 
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, reactor, threads
+from twisted.python import threadpool
 from twisted.web import client
 from twisted.web.http import PotentialDataLoss
 from twisted.web.iweb import IBodyProducer
@@ -106,6 +107,25 @@ def sha1(text):
     return hashed.hexdigest()
 
 
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping, Veach): maps a 64 bit key to one of the
+    given number of buckets. When buckets grow from n to n+1, only 1/(n+1) of
+    the keys move, all of them to the new bucket.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def userid_bucket(userid, buckets):
+    """Returns the bucket of a user (see L{jump_hash})."""
+    return jump_hash(int(sha1(userid[:USERID_LENGTH])[:16], 16), buckets)
+
+
 def _jid_parse(jidstring, index):
     j = jid.parse(jidstring)
     return j[index]
@@ -232,3 +252,29 @@ class StringProducer(object):
 
     def stopProducing(self):
         pass
+
+
+class SerialThread(object):
+    """
+    A dedicated thread running blocking calls (e.g. file I/O) one at a time,
+    in the order they were requested.
+    """
+
+    def __init__(self, name):
+        self._pool = threadpool.ThreadPool(1, 1, name)
+        self._pool.start()
+        self._trigger = reactor.addSystemEventTrigger('after', 'shutdown', self.stop)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls a function in the thread.
+        @return: a L{Deferred} fired with the function result
+        """
+        return threads.deferToThreadPool(reactor, self._pool, func, *args, **kwargs)
+
+    def stop(self):
+        """Stops the thread after the calls already requested."""
+        if self._trigger is not None:
+            reactor.removeSystemEventTrigger(self._trigger)
+            self._trigger = None
+            self._pool.stop()
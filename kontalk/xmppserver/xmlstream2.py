@@ -58,8 +58,11 @@ NS_XMPP_SERVER_RECEIPTS = 'urn:xmpp:server-receipts'
 NS_XMPP_STORAGE = 'urn:xmpp:storage'
 # <presence/> direct delivery: no notification to subscribers
 NS_XMPP_DIRECT = 'urn:xmpp:direct'
+# multicast envelopes (XEP-0033 addresses)
+NS_XMPP_ADDRESS = 'http://jabber.org/protocol/address'
 
 NS_PRESENCE_PUSH = 'http://kontalk.org/extensions/presence#push'
+NS_PRESENCE_SYNC = 'http://kontalk.org/extensions/presence#sync'
 NS_MESSAGE_UPLOAD = 'http://kontalk.org/extensions/message#upload'
 
 XMPP_STAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
@@ -92,6 +95,38 @@ def has_element(stanza, uri, name):
     return None
 
 
+class StanzaTemplate(object):
+    """
+    A stanza serialized once to be sent to many recipients: only the given
+    attributes change between copies.
+    """
+
+    def __init__(self, stanza, attrs=('to', 'original-to'), defaultUri=''):
+        """
+        @param defaultUri: default namespace of the streams the stanza is
+        sent to, not declared in the stanza
+        """
+        self.name = stanza.name
+        self.attrs = attrs
+        saved = {}
+        for attr in attrs:
+            if stanza.hasAttribute(attr):
+                saved[attr] = stanza[attr]
+                del stanza[attr]
+        xml = stanza.toXml(defaultUri=defaultUri).encode('utf-8')
+        stanza.attributes.update(saved)
+
+        # copy attributes go right after the element name
+        split = len(stanza.name) + 1
+        self._head, self._tail = xml[:split], xml[split:]
+
+    def render(self, *values):
+        """Returns a UTF-8 serialized copy with the given attribute values."""
+        attrs = [u" %s='%s'" % (name, domish.escapeToXml(value, True))
+            for name, value in zip(self.attrs, values) if value is not None]
+        return self._head + u''.join(attrs).encode('utf-8') + self._tail
+
+
 class IXMPPUser(Interface):
     """
     An interface for users
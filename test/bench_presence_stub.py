@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark for the resolver presence cache.
+Compares L{PresenceStub} with the previous layout, which kept a rebuilt
+presence element for each available resource and a parsed delay.
+
+Usage: bench_presence_stub.py [users] [resources]
+"""
+
+import sys
+import gc
+import time
+from datetime import datetime
+
+from twisted.words.xish import domish
+
+from kontalk.xmppserver import xmlstream2
+from kontalk.xmppserver.component.c2s.resolver import PresenceStub
+
+
+class DOMPresenceStub(object):
+    """Data kept by the previous PresenceStub for each user."""
+
+    def __init__(self, stanza):
+        self.jid = PresenceStub.fromElement(stanza).jid
+        self.type = None
+        self.show = str(stanza.show) if stanza.show else None
+        self.status = unicode(stanza.status) if stanza.status else None
+        self.priority = int(str(stanza.priority)) if stanza.priority else 0
+        self.delay = datetime.strptime(stanza.delay['stamp'], xmlstream2.XMPP_STAMP_FORMAT)
+        self._avail = {}
+        self.push(stanza)
+
+    def push(self, stanza):
+        presence = domish.Element((None, 'presence'))
+        presence['from'] = stanza['from']
+        for child in ('status', 'show', 'priority', 'delay'):
+            e = getattr(stanza, child)
+            if e:
+                presence.addChild(e)
+        self._avail[stanza['from'].split('/')[1]] = presence
+
+
+def presence(user, resource):
+    stanza = domish.Element((None, 'presence'))
+    stanza['from'] = '%040x@c2s.prime.kontalk.net/%08X' % (user, resource)
+    stanza.addElement((None, 'status'), content=u'Hey there! I am using Kontalk.')
+    stanza.addElement((None, 'show'), content='away')
+    stanza.addElement((None, 'priority'), content='10')
+    delay = stanza.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+    delay['stamp'] = '2014-05-01T12:00:00Z'
+    return stanza
+
+
+def deep_size(obj, seen=None):
+    """Returns the memory used by an object and everything it references."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(x, seen) for x in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, name):
+            size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def run(name, factory, users, resources):
+    gc.collect()
+    start = time.time()
+    cache = {}
+    for user in xrange(users):
+        stub = cache[user] = factory(presence(user, 0))
+        for resource in xrange(1, resources):
+            stub.push(presence(user, resource))
+    elapsed = time.time() - start
+
+    # stanzas built by the factory are shared by all users, count them once
+    size = deep_size(cache, set([id(xmlstream2)]))
+    print '%-16s %10d bytes (%6d bytes/user)  %.3f s' % (name, size, size / users, elapsed)
+
+
+def main(argv):
+    users = int(argv[0]) if len(argv) > 0 else 10000
+    resources = int(argv[1]) if len(argv) > 1 else 2
+    print '%d users, %d resources each' % (users, resources)
+    run('DOM (previous)', DOMPresenceStub, users, resources)
+    run('PresenceStub', PresenceStub.fromElement, users, resources)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
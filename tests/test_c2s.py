@@ -0,0 +1,287 @@
+from copy import deepcopy
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+from wokkel import generic
+
+from kontalk.xmppserver import util, xmlstream2
+from kontalk.xmppserver.component.c2s import handlers
+from kontalk.xmppserver.component.c2s.component import C2SComponent, XMPPServerFactory
+
+
+class FakeStream(object):
+    """Collects sent data."""
+
+    def __init__(self, entity):
+        self.thisEntity = jid.JID(entity)
+        self.otherEntity = None
+        self.sent = []
+
+    def send(self, obj):
+        self.sent.append(obj)
+
+
+class FakeKeyring(object):
+
+    def hostlist(self):
+        return ['alpha.kontalk.net', 'beta.kontalk.net']
+
+
+def c2s(servername):
+    component = C2SComponent({'router': {'jid': 'c2s', 'secret': 'secret'},
+        'host': servername, 'network': 'kontalk.net', 'debug': False})
+    component.xmlstream = FakeStream(util.component_jid(servername, util.COMPONENT_C2S))
+    component._initialized = True
+    component.keyring = FakeKeyring()
+    return component
+
+
+def presence(sender, ptype=None, status=None):
+    stanza = domish.Element((None, 'presence'))
+    stanza['from'] = sender
+    if ptype:
+        stanza['type'] = ptype
+    if status:
+        stanza.addElement('status', content=status)
+    util.resetNamespace(stanza, 'jabber:component:accept')
+    return stanza
+
+
+class TestMulticast(unittest.TestCase):
+
+    SENDER = 'alice@c2s.alpha.kontalk.net/RES'
+    DESTS = [
+        ('bob@c2s.beta.kontalk.net/R1', 'bob@kontalk.net'),
+        ('carol@c2s.beta.kontalk.net/R2', 'carol@kontalk.net'),
+    ]
+
+    def setUp(self):
+        self.alpha, self.beta = c2s('alpha.kontalk.net'), c2s('beta.kontalk.net')
+        self.alpha.set_multicast('c2s.beta.kontalk.net', True)
+        self.delivered = []
+        self.beta.dispatch = lambda stanza: self.delivered.append((stanza['to'], stanza['original-to'],
+            stanza.getAttribute('type'), unicode(stanza.status) if stanza.status else None))
+        for handler in self.beta:
+            if isinstance(handler, handlers.MulticastHandler):
+                self.multicast = handler
+
+    def send(self, stanza, dests):
+        """Sends a stanza from alpha and returns the parsed envelope."""
+        self.alpha.fanout_remote('c2s.beta.kontalk.net', xmlstream2.StanzaTemplate(stanza), dests)
+        self.assertEqual(len(self.alpha.xmlstream.sent), 1)
+        return generic.parseXml(self.alpha.xmlstream.sent.pop())
+
+    def test_expand(self):
+        envelope = self.send(presence(self.SENDER, status=u'caf\xe9'), self.DESTS)
+        self.assertEqual(envelope.name, 'stanza')
+        self.assertEqual(envelope['to'], 'c2s.beta.kontalk.net')
+
+        self.multicast.expand(envelope)
+        self.assertEqual(self.delivered, [(to, original, None, u'caf\xe9') for to, original in self.DESTS])
+        # presence cache is updated once
+        stub = self.beta.cache.presence_cache['alice']
+        self.assertEqual(stub.jids(), [jid.JID(self.SENDER)])
+        self.assertEqual(stub.status, u'caf\xe9')
+
+        del self.delivered[:]
+        self.multicast.expand(self.send(presence(self.SENDER, 'unavailable'), self.DESTS))
+        self.assertEqual([d[2] for d in self.delivered], ['unavailable', 'unavailable'])
+        self.assertFalse(stub.available())
+
+    def test_single(self):
+        # a single recipient gets a plain copy
+        self.alpha.fanout_remote('c2s.beta.kontalk.net', xmlstream2.StanzaTemplate(presence(self.SENDER)), self.DESTS[:1])
+        stanza = generic.parseXml(self.alpha.xmlstream.sent[0])
+        self.assertEqual((stanza.name, stanza['to']), ('presence', self.DESTS[0][0]))
+
+    def test_unsupported(self):
+        # envelope support is advertised in presence sync replies
+        for handler in self.alpha:
+            if isinstance(handler, handlers.PresenceSyncHandler):
+                iq = domish.Element((None, 'iq'))
+                iq['type'] = 'get'
+                iq['id'] = 'abcdef'
+                iq['from'] = 'c2s.beta.kontalk.net'
+                iq['to'] = 'c2s.alpha.kontalk.net'
+                iq.addElement((xmlstream2.NS_PRESENCE_SYNC, 'sync'))
+                handler.query(iq)
+        features = [f['var'] for f in self.alpha.xmlstream.sent.pop().sync.elements(None, 'feature')]
+        self.assertEqual(features, [xmlstream2.NS_XMPP_ADDRESS])
+
+        # servers not advertising it get a copy for each recipient
+        self.alpha.set_multicast('c2s.beta.kontalk.net', False)
+        self.alpha.fanout_remote('c2s.beta.kontalk.net', xmlstream2.StanzaTemplate(presence(self.SENDER)), self.DESTS)
+        sent = [generic.parseXml(data) for data in self.alpha.xmlstream.sent]
+        self.assertEqual([(stanza.name, stanza['to'], stanza['original-to']) for stanza in sent],
+            [('presence', to, original) for to, original in self.DESTS])
+
+    def test_unknown_sender(self):
+        envelope = self.send(presence(self.SENDER), self.DESTS)
+        envelope['from'] = 'c2s.gamma.kontalk.net'
+        self.multicast.expand(envelope)
+        self.assertEqual(self.delivered, [])
+        self.assertNotIn('alice', self.beta.cache.presence_cache)
+
+
+class TestLocalFanout(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = XMPPServerFactory(None, c2s('beta.kontalk.net'), 'kontalk.net', 'beta.kontalk.net')
+        self.factory.logTraffic = False
+        self.streams = [
+            self.connect('bob@kontalk.net/R1'),
+            self.connect('bob@kontalk.net/R2', -1),
+            self.connect('carol@kontalk.net/R1'),
+        ]
+
+    def connect(self, entity, priority=None):
+        xs = self.factory.buildProtocol(None)
+        xs.transport = proto_helpers.StringTransport()
+        xs.otherEntity = jid.JID(entity)
+        xs.manager._initialized = True
+        if priority is not None:
+            xs.manager._presence = presence(entity)
+            xs.manager._presence.addElement('priority', content=str(priority))
+        self.factory.connectionInitialized(xs)
+        return xs
+
+    def sent(self):
+        """Returns and clears the data written to each client."""
+        out = []
+        for xs in self.streams:
+            out.append(xs.transport.value())
+            xs.transport.clear()
+        return out
+
+    def broadcast(self, stanza):
+        """Sends a stanza through the template and the dispatch paths."""
+        dests = [
+            (jid.JID('bob@c2s.beta.kontalk.net'), 'bob@kontalk.net'),
+            (jid.JID('carol@c2s.beta.kontalk.net/R1'), 'carol@kontalk.net'),
+            (jid.JID('dave@c2s.beta.kontalk.net'), 'dave@kontalk.net'),
+        ]
+        missing = self.factory.fanout(stanza, dests)
+        self.assertEqual(missing, dests[2:])
+        template = self.sent()
+
+        # send removes original-to: each resource gets its own copy
+        for to, original in dests[:2]:
+            for resource, manager in self.factory.streams[to.user].iteritems():
+                if to.resource in (None, resource):
+                    copy = deepcopy(stanza)
+                    copy['to'] = to.full()
+                    copy['original-to'] = original
+                    manager.send(copy)
+        return template, self.sent()
+
+    def parse(self, data):
+        """Returns the serialization of a stanza with sorted attributes."""
+        stanza = generic.parseXml(data)
+        return stanza.name, stanza.uri, sorted(stanza.attributes.items()), [child.toXml() for child in stanza.elements()]
+
+    def test_same_output(self):
+        stanza = presence('alice@c2s.alpha.kontalk.net/RES', status=u'caf\xe9')
+        stanza['id'] = 'abcdef'
+        stanza.addElement((xmlstream2.NS_XMPP_DIRECT, 'direct'))
+        template, dispatched = self.broadcast(stanza)
+
+        # bare JID sends are dropped for negative priority
+        self.assertEqual(template[1], '')
+        self.assertEqual(dispatched[1], '')
+        for data, expected in zip(template, dispatched):
+            self.assertEqual(len(data), len(expected))
+            if data:
+                self.assertEqual(self.parse(data), self.parse(expected))
+
+        bob = generic.parseXml(template[0])
+        self.assertEqual(bob['to'], 'bob@kontalk.net/R1')
+        self.assertEqual(bob['from'], 'alice@kontalk.net/RES')
+        self.assertFalse(bob.hasAttribute('original-to'))
+        self.assertIsNone(bob.direct)
+
+    def test_ids(self):
+        # missing ids are generated for each copy
+        template, dispatched = self.broadcast(presence('alice@c2s.alpha.kontalk.net/RES'))
+        ids = [generic.parseXml(data)['id'] for data in (template[0], template[2])]
+        self.assertNotEqual(ids[0], ids[1])
+
+
+class TestOfflineDelivery(unittest.TestCase):
+
+    USER = jid.JID('bob@kontalk.net/R1')
+
+    def setUp(self):
+        self.component = c2s('beta.kontalk.net')
+        self.component.sfactory = XMPPServerFactory(None, self.component, 'kontalk.net', 'beta.kontalk.net')
+        self.component.sfactory.logTraffic = False
+        self.component.stanzadb = self
+        self.component._local_presence_output = self.output
+        self.pages = []
+
+        xs = self.component.sfactory.buildProtocol(None)
+        xs.transport = proto_helpers.StringTransport()
+        xs.otherEntity = self.USER
+        xs.transport.registerProducer(xs.manager, True)
+        self.component.sfactory.connectionInitialized(xs)
+        self.manager = xs.manager
+
+    def get_by_recipient(self, recipient, after, count):
+        self.pages.append(after)
+        if len(self.pages) == 3:
+            count -= 1
+        return defer.succeed([{'id': str(i), 'cursor': len(self.pages) * 1000 + i} for i in range(count)])
+
+    def output(self, data, user):
+        # first page fills the write buffer
+        if len(self.pages) == 1:
+            self.manager.pauseProducing()
+
+    def test_wait_drain(self):
+        done = []
+        d = self.component.deliver_offline_storage(self.USER)
+        d.addCallback(done.append)
+        self.assertEqual(self.pages, [None])
+        self.assertEqual(done, [])
+
+        self.manager.resumeProducing()
+        last = self.component.OFFLINE_PAGE_SIZE - 1
+        return d.addCallback(lambda _: self.assertEqual(self.pages, [None, 1000 + last, 2000 + last]))
+
+    def test_disconnected(self):
+        d = self.component.deliver_offline_storage(self.USER)
+        self.component.sfactory.connectionLost(self.manager.xmlstream, None)
+        self.manager.stopProducing()
+        return d.addCallback(lambda _: self.assertEqual(self.pages, [None]))
+
+
+class TestOfflineRejected(unittest.TestCase):
+
+    def setUp(self):
+        self.component = c2s('beta.kontalk.net')
+        self.component.sfactory = XMPPServerFactory(None, self.component, 'kontalk.net', 'beta.kontalk.net')
+        self.component.sfactory.logTraffic = False
+        self.component.stanzadb = self
+
+    def store(self, stanza, network, delayed=False, reuseId=None):
+        # recipient over quota
+        if delayed:
+            return reuseId or 'abcdef'
+
+    def test_no_receipt(self):
+        stanza = domish.Element((None, 'message'))
+        stanza['from'] = 'alice@c2s.alpha.kontalk.net/RES'
+        stanza['to'] = 'bob@c2s.beta.kontalk.net'
+        stanza['type'] = 'chat'
+        stanza['id'] = 'abcdef'
+        stanza.addElement('body', content='hello')
+        stanza.addElement((xmlstream2.NS_XMPP_SERVER_RECEIPTS, 'request'))['id'] = 'abcdef'
+        self.component.process_message(stanza)
+
+        # the sender gets the error only
+        sent = self.component.xmlstream.sent
+        self.assertEqual(len(sent), 1)
+        self.assertEqual((sent[0].name, sent[0]['type'], sent[0]['to']), ('message', 'error', 'alice@c2s.alpha.kontalk.net/RES'))
+        self.assertEqual(sent[0].error.firstChildElement().name, 'resource-constraint')
@@ -0,0 +1,99 @@
+import unittest
+
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish
+
+from kontalk.xmppserver.component.c2s.resolver import PresenceStub, SubscriptionGraph
+from kontalk.xmppserver import xmlstream2
+
+
+def presence(sender, ptype=None, stamp=None, **children):
+    stanza = domish.Element((None, 'presence'))
+    stanza['from'] = sender
+    if ptype:
+        stanza['type'] = ptype
+    for name, value in children.iteritems():
+        stanza.addElement((None, name), content=value)
+    if stamp:
+        delay = stanza.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+        delay['stamp'] = stamp
+    return stanza
+
+
+class TestPresenceStub(unittest.TestCase):
+
+    def test_resources(self):
+        stub = PresenceStub.fromElement(presence('user@c2s.alpha/RES1', status=u'caf\xe9', priority='5'))
+        stub.push(presence('user@c2s.beta/RES2', show='away'))
+        self.assertTrue(stub.available())
+        self.assertEqual(stub.jids(), [jid.JID('user@c2s.alpha/RES1'), jid.JID('user@c2s.beta/RES2')])
+
+        data = stub.presence()
+        self.assertEqual(data[0]['from'], 'user@c2s.alpha/RES1')
+        self.assertEqual(unicode(data[0].status), u'caf\xe9')
+        self.assertEqual(str(data[0].priority), '5')
+        self.assertEqual(str(data[1].show), 'away')
+        # stanzas are built for the caller
+        data[0]['to'] = 'other@c2s.alpha'
+        self.assertFalse(stub.presence()[0].hasAttribute('to'))
+
+        # same resource again replaces the previous presence
+        stub.push(presence('user@c2s.alpha/RES1'))
+        self.assertEqual(len(stub.presence()), 2)
+
+    def test_unavailable(self):
+        stub = PresenceStub.fromElement(presence('user@c2s.alpha/RES1', status='hello'))
+        stub.pop('RES1')
+        self.assertFalse(stub.available())
+        data = stub.presence()[0]
+        self.assertEqual(data['type'], 'unavailable')
+        self.assertEqual(data['from'], 'user@c2s.alpha')
+        self.assertEqual(str(data.status), 'hello')
+        self.assertTrue(data.delay['stamp'])
+
+        # older data is ignored
+        stub.update(presence('user@c2s.alpha', 'unavailable', '2010-01-01T00:00:00Z', status='old'))
+        self.assertEqual(stub.status, 'hello')
+        stub.update(presence('user@c2s.beta', 'unavailable', '2099-01-01T00:00:00Z', status='new'))
+        self.assertEqual(stub.status, 'new')
+        self.assertEqual(stub.toElement()['from'], 'user@c2s.beta')
+        self.assertEqual(stub.toElement().delay['stamp'], '2099-01-01T00:00:00Z')
+
+
+class TestSubscriptionGraph(unittest.TestCase):
+
+    def test_subscriptions(self):
+        graph = SubscriptionGraph()
+        alice, bob = jid.JID('alice@kontalk.net'), jid.JID('bob@kontalk.net')
+        carol = jid.JID('carol@kontalk.net/RES')
+        self.assertTrue(graph.add(alice, carol))
+        self.assertFalse(graph.add(alice, jid.JID('carol@kontalk.net/RES')))
+        graph.add(bob, carol)
+        graph.add(bob, alice)
+
+        self.assertEqual(graph.subscribers(bob), set([carol, alice]))
+        self.assertEqual(graph.watched(carol), set([alice, bob]))
+        self.assertTrue(graph.remove(bob, alice))
+        self.assertFalse(graph.remove(bob, alice))
+        self.assertEqual(graph.watched(alice), ())
+
+        graph.remove_subscriber(carol)
+        self.assertEqual(len(graph), 0)
+        self.assertNotIn(alice, graph)
+        self.assertEqual(graph.subscribers(bob), ())
+
+    def test_interned(self):
+        graph = SubscriptionGraph()
+        alice, carol = jid.JID('alice@kontalk.net'), jid.JID('carol@kontalk.net/RES')
+        graph.add(alice, carol)
+        graph.add(jid.JID('bob@kontalk.net'), jid.JID('carol@kontalk.net/RES'))
+        # one copy of each JID, not the caller's
+        subs = [list(graph.subscribers(watched))[0] for watched in graph.watched(carol)]
+        self.assertIs(subs[0], subs[1])
+        self.assertIsNot(subs[0], carol)
+
+        # dropped with their last subscription
+        graph.remove(alice, carol)
+        self.assertEqual(len(graph._jids), 2)
+        graph.remove_subscriber(carol)
+        self.assertEqual(graph._jids, {})
@@ -0,0 +1,614 @@
+import os
+import shutil
+import tempfile
+import datetime
+import threading
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish import domish
+
+from kontalk.xmppserver import storage, mailbox, journal
+
+
+SENDER = '4bdd4f929f3a1062253e4e496bafba0bdfb5db75'
+RECIPIENT = 'f48dd853820860816c75d54d0f584dc863327a7c'
+
+
+def message(msgId):
+    stanza = domish.Element((None, 'message'))
+    stanza['from'] = '%s@localhost/ABCDEFGH' % (SENDER, )
+    stanza['to'] = '%s@localhost' % (RECIPIENT, )
+    stanza['type'] = 'chat'
+    stanza['id'] = msgId
+    stanza.addElement('body', content=u'caf\xe9 %s' % (msgId, ))
+    return stanza
+
+
+class TestSQLiteStorage(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        storage.init({'dbmodule': 'sqlite3', 'dbname': self.dbfile})
+        storage.dbpool.start()
+
+    def tearDown(self):
+        storage.dbpool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.dbfile + suffix):
+                os.unlink(self.dbfile + suffix)
+
+    @defer.inlineCallbacks
+    def test_stanza_store(self):
+        db = storage.stanza_storage()
+        self.assertIsInstance(db, storage.SQLiteStanzaStorage)
+        for i in range(5):
+            db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+        db.delete('msg1', 'message', recipient=RECIPIENT)
+        db.delete('msg2', 'message', recipient=SENDER)
+
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['msg0', 'msg2', 'msg3', 'msg4'])
+        self.assertEqual(unicode(data[0]['stanza'].body), u'caf\xe9 msg0')
+
+    @defer.inlineCallbacks
+    def test_replica_reads(self):
+        replicas = StaleReplicas()
+        self.patch(storage, 'replicas', replicas)
+        db = storage.stanza_storage()
+        user = JID(RECIPIENT + '@localhost')
+
+        # the batched store pins the recipient before the pool is chosen
+        db.store(message('msg0'), 'localhost', reuseId='msg0')
+        data = yield db.get_by_recipient(user)
+        self.assertEqual([msg['id'] for msg in data], ['msg0'])
+
+        # a lagging replica read doesn't reset the pending index
+        replicas.pinned.clear()
+        data = yield db.get_by_recipient(user)
+        self.assertEqual(data, [])
+        self.assertEqual(db._counts[RECIPIENT], 1)
+
+    @defer.inlineCallbacks
+    def test_stanza_store_failure(self):
+        db = storage.stanza_storage()
+        good = db._stores.put('message', 'msg0', ('msg0', SENDER, RECIPIENT, 'chat', message('msg0').toXml(), 1, None))
+        # not a valid column value: the batch is retried one row at a time
+        bad = db._stores.put('message', 'msg1', ('msg1', SENDER, RECIPIENT, 'chat', object(), 2, None))
+        yield db._stores.flush()
+
+        yield good
+        yield self.assertFailure(bad, storage.dbpool.dbapi.Error)
+        data = yield storage.dbpool.runQuery('SELECT id FROM stanzas_message')
+        self.assertEqual(data, [('msg0', )])
+
+    @defer.inlineCallbacks
+    def test_stanza_pages(self):
+        db = storage.stanza_storage()
+        for i in range(7):
+            db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+
+        user = JID(RECIPIENT + '@localhost')
+        first = yield db.get_by_recipient(user, limit=4)
+        second = yield db.get_by_recipient(user, first[-1]['cursor'], 4)
+        self.assertEqual([msg['id'] for msg in first + second], ['msg%d' % i for i in range(7)])
+
+    @defer.inlineCallbacks
+    def test_stanza_pending(self):
+        db = storage.stanza_storage()
+        stanza = message('pending')
+        db.store(stanza, 'localhost', delayed=True, reuseId='pending')
+        db.store(message('other'), 'localhost', delayed=True, reuseId='other')
+        db.delete('other', 'message')
+        stanza['id'] = 'changed'
+
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['pending'])
+        self.assertEqual(data[0]['stanza']['id'], 'pending')
+        self.assertEqual(db._pending_recipients.keys(), [RECIPIENT])
+        self.assertEqual(db._pending_for(JID(SENDER + '@localhost')), [])
+
+        # stored when the delay expires
+        db._pending_offline['pending'][0].cancel()
+        db._store_pending('pending')
+        self.assertEqual(db._pending_recipients, {})
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['pending'])
+        self.assertIn('cursor', data[0])
+
+    @defer.inlineCallbacks
+    def test_stanza_compression(self):
+        db = storage.stanza_storage()
+        db.store(message('plain'), 'localhost', reuseId='plain')
+        db.compress = True
+        stanza = message('packed')
+        stanza.addElement('e2e', content='A' * 2000)
+        db.store(stanza, 'localhost', reuseId='packed')
+
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['plain', 'packed'])
+        self.assertEqual(str(data[1]['stanza'].e2e), 'A' * 2000)
+
+        rows = yield storage.dbpool.runQuery("SELECT content FROM stanzas_message WHERE id = 'packed'")
+        content = str(rows[0][0])
+        self.assertEqual(content[0], storage.COMPRESSED_MARKER)
+        self.assertTrue(len(content) < 2000)
+
+    @defer.inlineCallbacks
+    def test_purge(self):
+        db = storage.stanza_storage()
+        for i in range(5):
+            db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+        yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        yield storage.dbpool.runOperation("UPDATE stanzas_message SET timestamp = 1000 WHERE id <> 'msg4'")
+
+        self.patch(storage, 'PURGE_BATCH_SIZE', 3)
+        count = yield storage.purge('stanzas_message', 'timestamp', 2000)
+        self.assertEqual(count, 4)
+
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['msg4'])
+
+    @defer.inlineCallbacks
+    def test_stanza_duplicates(self):
+        db = storage.stanza_storage()
+        user = JID(RECIPIENT + '@localhost')
+        db.store(message('msg0'), 'localhost', reuseId='msg0')
+        yield db._stores.flush()
+        # stored again, then pending again
+        db.store(message('msg0'), 'localhost', reuseId='msg0')
+        yield db._stores.flush()
+        db.store(message('msg0'), 'localhost', delayed=True, reuseId='msg0')
+
+        data = yield db.get_by_recipient(user)
+        self.assertEqual([msg['id'] for msg in data], ['msg0'])
+        self.assertIn('cursor', data[0])
+        self.assertEqual(db._pending_offline, {})
+
+        # a new subscription request replaces the previous one
+        for presence_type in ('subscribe', 'unsubscribe'):
+            presence = domish.Element((None, 'presence'))
+            presence['from'] = '%s@localhost/ABCDEFGH' % (SENDER, )
+            presence['to'] = '%s@localhost' % (RECIPIENT, )
+            presence['type'] = presence_type
+            db.store(presence, 'localhost')
+            yield db._stores.flush()
+        rows = yield storage.dbpool.runQuery('SELECT type FROM stanzas_presence')
+        self.assertEqual(rows, [('unsubscribe', )])
+
+    @defer.inlineCallbacks
+    def test_stanza_quota(self):
+        db = storage.stanza_storage()
+        user = JID(RECIPIENT + '@localhost')
+        for i in range(6):
+            db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+
+        # oldest stanzas are evicted down to the low watermark
+        db.quota_stanzas = 5
+        yield db._check_quota(RECIPIENT)
+        data = yield db.get_by_recipient(user)
+        self.assertEqual([msg['id'] for msg in data], ['msg2', 'msg3', 'msg4', 'msg5'])
+        self.assertEqual(db.quota_status()['evicted'], 2)
+
+        db.quota_stanzas = 3
+        db.quota_policy = 'reject'
+        yield db._check_quota(RECIPIENT)
+        self.assertIsNone(db.store(message('msg6'), 'localhost', reuseId='msg6'))
+        data = yield db.get_by_recipient(user)
+        self.assertEqual(len(data), 4)
+        status = db.quota_status()
+        self.assertEqual((status['checks'], status['rejected']), (2, 1))
+        # reading stanzas lifts the rejection
+        self.assertEqual(status['capped_users'], 0)
+
+    @defer.inlineCallbacks
+    def test_presence(self):
+        db = storage.presence_storage()
+        stanza = domish.Element((None, 'presence'))
+        stanza['from'] = '%s@localhost/ABCDEFGH' % (SENDER, )
+        stanza.addElement('status', content=u'available')
+        yield db.presence(stanza)
+        yield db.public_key(SENDER, 'ABCDEF')
+
+        data = yield db.get(SENDER)
+        self.assertEqual(data['status'], u'available')
+        self.assertEqual(data['fingerprint'], 'ABCDEF')
+        self.assertIsNotNone(data['timestamp'])
+
+        yield db.delete(SENDER)
+        data = yield db.get(SENDER)
+        self.assertIsNone(data)
+
+    @defer.inlineCallbacks
+    def test_presence_write_behind(self):
+        db = storage.presence_storage()
+        stanza = domish.Element((None, 'presence'))
+        stanza['from'] = '%s@localhost/ABCDEFGH' % (SENDER, )
+        stanza.addElement('status', content=u'first')
+        db.presence(stanza)
+        stanza.status.children = [u'second']
+        db.presence(stanza)
+        db.touch(SENDER)
+        # touch on unknown users does nothing
+        db.touch(RECIPIENT)
+
+        # pending writes are visible before being flushed
+        data = yield db.get(SENDER)
+        self.assertEqual(data['status'], u'second')
+        data = yield db.get_all()
+        self.assertEqual([(p['userid'], p['status']) for p in data], [(SENDER, u'second')])
+
+        yield db._writes.flush()
+        rows = yield storage.dbpool.runQuery('SELECT userid FROM presence')
+        self.assertEqual([row[0] for row in rows], [SENDER])
+        data = yield db.get(SENDER)
+        self.assertEqual(data['status'], u'second')
+
+    @defer.inlineCallbacks
+    def test_presence_cache(self):
+        db = storage.presence_storage()
+        stanza = domish.Element((None, 'presence'))
+        stanza['from'] = '%s@localhost/ABCDEFGH' % (SENDER, )
+        yield db.presence(stanza)
+
+        yield db.get(SENDER)
+        data = yield db.get(SENDER)
+        self.assertEqual((db.cache.hits, db.cache.misses), (1, 1))
+        # returned entries are copies
+        data['status'] = u'changed'
+
+        yield db.public_key(SENDER, 'ABCDEF')
+        data = yield db.get(SENDER)
+        self.assertEqual(data['fingerprint'], 'ABCDEF')
+        self.assertEqual(data['status'], u'')
+        self.assertEqual((db.cache.hits, db.cache.misses), (1, 2))
+
+        yield db.delete(SENDER)
+        data = yield db.get(SENDER)
+        self.assertIsNone(data)
+
+    @defer.inlineCallbacks
+    def test_presence_changes(self):
+        db = storage.presence_storage()
+        for userid in (SENDER, RECIPIENT):
+            stanza = domish.Element((None, 'presence'))
+            stanza['from'] = '%s@localhost/ABCDEFGH' % (userid, )
+            db.presence(stanza)
+
+        version = yield db.sync_version()
+        data = yield db.get_changes(0, 10)
+        self.assertEqual([p['userid'] for p in data], [SENDER, RECIPIENT])
+        self.assertEqual(data[-1]['version'], version)
+
+        # only later changes are returned
+        db.touch(SENDER)
+        # fingerprint only, not a presence yet
+        yield db.public_key('0' * 40, 'ABCDEF')
+        data = yield db.get_changes(version, 10)
+        self.assertEqual(data, [])
+        latest = yield db.sync_version()
+        data = yield db.get_changes(version, 10, latest)
+        self.assertEqual([p['userid'] for p in data], [SENDER])
+        self.assertTrue(data[0]['version'] > version)
+
+    @defer.inlineCallbacks
+    def test_presence_pages(self):
+        # migrated rows all share the same version
+        userids = ['%040x' % i for i in range(7)]
+        for userid in userids:
+            yield storage.dbpool.runOperation('INSERT INTO presence (userid, timestamp, version) VALUES (?, ?, 1)',
+                (userid, datetime.datetime.utcnow()))
+
+        # the last version is still being read
+        db = storage.presence_storage()
+        data = yield db.get_changes(0, 3)
+        found = [p['userid'] for p in data]
+        while len(data) >= 3:
+            data = yield db.get_changes((data[-1]['version'], data[-1]['userid']), 3)
+            found.extend(p['userid'] for p in data)
+        self.assertEqual(found, userids)
+
+    @defer.inlineCallbacks
+    def test_network(self):
+        db = storage.network_storage()
+        yield storage.dbpool.runOperation("INSERT INTO servers VALUES ('abcdef', 'beta.kontalk.net', 0)")
+        yield storage.dbpool.runOperation("INSERT INTO servers VALUES ('ABC123', 'prime.kontalk.net', 1)")
+        data = yield db.get_list()
+        self.assertEqual(data.items(), [
+            ('ABC123', {'host': 'prime.kontalk.net', 'enabled': 1}),
+            ('ABCDEF', {'host': 'beta.kontalk.net', 'enabled': 0}),
+        ])
+        # blocking version for startup
+        self.assertEqual(db.load_list(), data)
+
+    @defer.inlineCallbacks
+    def test_journal_replay(self):
+        filename = self.dbfile + '.journal'
+        self.addCleanup(os.unlink, filename)
+        db = storage.stanza_storage()
+        db.open_journal(filename)
+        for i in range(3):
+            db.store(message('msg%d' % i), 'localhost', delayed=True, reuseId='msg%d' % i)
+        # acked before being stored
+        db.delete('msg1', 'message')
+        self.assertEqual(list(db.journal.live), ['msg0', 'msg2'])
+        yield db._shutdown()
+
+        # restart: journaled stanzas are stored and removed from the journal
+        db = storage.stanza_storage()
+        db.open_journal(filename)
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['msg0', 'msg2'])
+        self.assertEqual(len(db.journal), 0)
+        yield db.journal.close()
+
+    @defer.inlineCallbacks
+    def test_journal_shutdown(self):
+        filename = self.dbfile + '.journal'
+        self.addCleanup(os.unlink, filename)
+        db = storage.stanza_storage()
+        db.open_journal(filename)
+        db.store(message('msg0'), 'localhost', delayed=True, reuseId='msg0')
+        # delay elapsed: waiting in the batch queue on shutdown
+        db._pending_offline['msg0'][0].cancel()
+        db._store_pending('msg0')
+        yield db._shutdown()
+        self.assertEqual(len(db.journal), 0)
+        self.assertFalse(db.journal.remove('msg0'))
+
+        db = storage.stanza_storage()
+        db.open_journal(filename)
+        self.assertEqual(len(db.journal), 0)
+        yield db.journal.close()
+        data = yield db.get_by_recipient(JID(RECIPIENT + '@localhost'))
+        self.assertEqual([msg['id'] for msg in data], ['msg0'])
+
+    @defer.inlineCallbacks
+    def test_validation(self):
+        db = storage.validation_storage()
+        code = yield db.register(SENDER)
+        userid = yield db.validate(code)
+        self.assertEqual(userid, SENDER)
+        yield self.assertFailure(db.validate(code), RuntimeError)
+
+
+class TestMailboxStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = storage.MailboxStanzaStorage(self.path)
+
+    def tearDown(self):
+        self.db._compactor.stop()
+        self.db._writer.stop()
+        shutil.rmtree(self.path)
+
+    @defer.inlineCallbacks
+    def test_store_delete(self):
+        for i in range(4):
+            self.db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+        self.assertFalse(self.db.delete('msg1', 'message', sender=RECIPIENT))
+        self.assertTrue(self.db.delete('msg1', 'message', sender=SENDER))
+        self.assertFalse(self.db.delete('msg2', 'message', recipient=SENDER))
+
+        user = JID(RECIPIENT + '@localhost')
+        data = yield self.db.get_by_recipient(user)
+        self.assertEqual([msg['id'] for msg in data], ['msg0', 'msg2', 'msg3'])
+        self.assertEqual(unicode(data[0]['stanza'].body), u'caf\xe9 msg0')
+
+        # reload from disk
+        yield self.db._flush_queues()
+        db = storage.MailboxStanzaStorage(self.path)
+        db._compactor.stop()
+        self.addCleanup(db._writer.stop)
+        data = yield db.get_by_recipient(user, data[0]['cursor'])
+        self.assertEqual([msg['id'] for msg in data], ['msg2', 'msg3'])
+
+    @defer.inlineCallbacks
+    def test_quota(self):
+        self.db.quota_stanzas = 3
+        for i in range(5):
+            self.db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+
+        user = JID(RECIPIENT + '@localhost')
+        data = yield self.db.get_by_recipient(user)
+        self.assertEqual([msg['id'] for msg in data], ['msg2', 'msg3', 'msg4'])
+
+        self.db.quota_policy = 'reject'
+        self.assertIsNone(self.db.store(message('msg5'), 'localhost', reuseId='msg5'))
+        data = yield self.db.get_by_recipient(user)
+        self.assertEqual(len(data), 3)
+        self.assertEqual(self.db.quota_status()['rejected'], 1)
+
+    def test_quota_delayed(self):
+        rejected = []
+        self.db.reject_callback = rejected.append
+        self.db.quota_stanzas = 1
+        self.db.quota_policy = 'reject'
+        self.db.store(message('msg0'), 'localhost', reuseId='msg0')
+        self.db.store(message('msg1'), 'localhost', delayed=True, reuseId='msg1')
+
+        # the sender is told when the delay expires
+        self.db._pending_offline['msg1'][0].cancel()
+        self.assertIsNone(self.db._store_pending('msg1'))
+        self.assertEqual([stanza['id'] for stanza in rejected], ['msg1'])
+        self.assertEqual(rejected[0]['from'], '%s@localhost/ABCDEFGH' % (SENDER, ))
+
+    @defer.inlineCallbacks
+    def test_quota_bytes(self):
+        self.db.quota_bytes = 1000
+        self.db.quota_policy = 'reject'
+        stored = [self.db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i) for i in range(5)]
+        self.assertIn(None, stored)
+
+        # the stanza that would go over quota is rejected, nothing is evicted
+        user = JID(RECIPIENT + '@localhost')
+        data = yield self.db.get_by_recipient(user)
+        self.assertEqual([msg['id'] for msg in data], [stanzaId for stanzaId in stored if stanzaId])
+        box = self.db._boxes[RECIPIENT]
+        self.assertTrue(box.size - box.dead <= 1000)
+        status = self.db.quota_status()
+        self.assertEqual(status['evicted'], 0)
+        self.assertEqual(status['rejected'], stored.count(None))
+
+    @defer.inlineCallbacks
+    def test_compact(self):
+        for i in range(4):
+            self.db.store(message('msg%d' % i), 'localhost', reuseId='msg%d' % i)
+        for i in range(3):
+            self.db.delete('msg%d' % i, 'message')
+        yield self.db.compact()
+
+        box = self.db._boxes[RECIPIENT]
+        self.assertEqual(box.dead, 0)
+        self.assertEqual(box.segments, [1])
+
+        self.db.delete('msg3', 'message')
+        yield self.db.compact()
+        self.assertEqual(self.db._boxes, {})
+        self.assertFalse(os.path.exists(mailbox.mailbox_dir(self.path, RECIPIENT)))
+
+    @defer.inlineCallbacks
+    def test_writer_thread(self):
+        threads = []
+        write = mailbox.Mailbox._write_record
+        def _write(box, segment, record):
+            threads.append(threading.current_thread())
+            return write(box, segment, record)
+        self.patch(mailbox.Mailbox, '_write_record', _write)
+
+        self.db.store(message('msg0'), 'localhost', reuseId='msg0')
+        yield self.db._flush_queues()
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.journal')
+        os.close(fd)
+        self.journal = journal.Journal(self.filename)
+
+    def tearDown(self):
+        return self.journal.close().addCallback(lambda _: os.unlink(self.filename))
+
+    @defer.inlineCallbacks
+    def test_reload(self):
+        record = self.journal.append('a', 'localhost', None, '<message/>')
+        self.journal.append('b', 'localhost', 100, '<message id="b"/>')
+        self.journal.append('a', 'localhost', None, '<message id="a"/>')
+        # recorded again in the meantime
+        self.assertFalse(self.journal.remove('a', record))
+        self.assertTrue(self.journal.remove('b'))
+        yield self.journal.sync()
+
+        # interrupted write
+        f = open(self.filename, 'ab')
+        f.write(mailbox.pack_record('c', 'localhost', 0, 0, '<message/>')[:-3])
+        f.close()
+
+        yield self.journal.close()
+        self.journal = journal.Journal(self.filename)
+        self.assertEqual([(e[0], e[4]) for e in self.journal.entries()], [('a', '<message id="a"/>')])
+
+        self.journal.remove('a')
+        self.assertEqual(self.journal.size, 0)
+        yield self.journal.sync()
+        self.assertEqual(os.path.getsize(self.filename), 0)
+
+    @defer.inlineCallbacks
+    def test_writer_thread(self):
+        threads = []
+        sync = journal.Journal._do_sync
+        def _sync(j):
+            threads.append(threading.current_thread())
+            return sync(j)
+        self.patch(journal.Journal, '_do_sync', _sync)
+
+        self.journal.append('a', 'localhost', None, '<message/>')
+        yield self.journal.sync()
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+
+class StaleReplicas(object):
+    """Read replicas with none of the data."""
+
+    def __init__(self):
+        self.pinned = set()
+
+    def pool(self, userid=None):
+        if userid in self.pinned:
+            return storage.dbpool
+        return self
+
+    def written(self, *userids):
+        self.pinned.update(userids)
+
+    def runInteraction(self, interaction, recipient, out):
+        return defer.succeed(out)
+
+
+class FakeReplica(object):
+
+    def __init__(self, lag):
+        self.lag = lag
+
+    def runInteraction(self, interaction, *args, **kw):
+        if self.lag is None:
+            return defer.fail(RuntimeError('replica down'))
+        return defer.succeed(self.lag)
+
+
+class TestReplicaSet(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(storage, 'dbpool', object())
+        self.fresh, self.late, self.down = FakeReplica(0), FakeReplica(60), FakeReplica(None)
+        replicas = storage.ReplicaSet([self.fresh, self.late, self.down], pin_time=5, max_lag=30)
+        self.addCleanup(replicas._checker.stop)
+        self.patch(storage, 'replicas', replicas)
+
+    def test_routing(self):
+        self.assertEqual(storage.replicas.available, [self.fresh])
+        self.assertIs(storage.readpool(SENDER), self.fresh)
+
+        # reads of written users go to the primary
+        storage.written(SENDER)
+        self.assertIs(storage.readpool(SENDER + 'RESOURCE'), storage.dbpool)
+        self.assertIs(storage.readpool(RECIPIENT), self.fresh)
+
+        storage.replicas._pinned[SENDER] = 0
+        self.assertIs(storage.readpool(SENDER), self.fresh)
+
+    def test_all_lagging(self):
+        self.fresh.lag = 31
+        storage.replicas.check()
+        self.assertIs(storage.readpool(), storage.dbpool)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = storage.LRUCache(max_size=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), (True, 1))
+        cache.put('c', 3)
+        # b was the least recently used
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_generation(self):
+        cache = storage.LRUCache(ttl=-1)
+        generation = cache.generation
+        cache.invalidate('a')
+        cache.put('a', 1, generation)
+        self.assertEqual(len(cache), 0)
+        cache.put('a', 1)
+        # expired
+        self.assertEqual(cache.get('a'), (False, None))
@@ -0,0 +1,68 @@
+from twisted.internet import task, error
+from twisted.trial import unittest
+
+from kontalk.xmppserver import timer
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timer.TimerWheel(resolution=1, size=8, clock=self.clock)
+        self.fired = []
+
+    def test_fire(self):
+        self.wheel.callLater(2.5, self.fired.append, 'a')
+        self.wheel.callLater(1, self.fired.append, 'b')
+        # next round of the wheel
+        self.wheel.callLater(10, self.fired.append, 'c')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b'])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b'])
+        # never early, late by less than one tick
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.clock.pump([1] * 6)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b', 'a', 'c'])
+        # nothing left: no more ticks
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel_reset(self):
+        a = self.wheel.callLater(2, self.fired.append, 'a')
+        b = self.wheel.callLater(3, self.fired.append, 'b')
+        a.cancel()
+        self.assertFalse(a.active())
+        self.assertRaises(error.AlreadyCancelled, a.cancel)
+        b.reset(5)
+        self.clock.pump([1] * 4)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b'])
+        self.assertRaises(error.AlreadyCalled, b.reset, 1)
+
+        c = self.wheel.callLater(1, self.fired.append, 'c')
+        c.cancel()
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel_while_firing(self):
+        calls = []
+        def first():
+            calls[1].cancel()
+            self.fired.append('first')
+        calls.append(self.wheel.callLater(1, first))
+        calls.append(self.wheel.callLater(1.5, self.fired.append, 'second'))
+        self.clock.advance(2)
+        self.assertEqual(self.fired, ['first'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_idle(self):
+        self.clock.advance(100)
+        self.wheel.callLater(1, self.fired.append, 'a')
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
@@ -69,6 +69,22 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(data, 'eb733a00c0c9d336e65691a37ab54293')
         os.unlink(f.name)
 
+    def test_jump_hash(self):
+        for key in xrange(1000):
+            self.assertEqual(util.jump_hash(key, 1), 0)
+            for n in xrange(1, 10):
+                old, new = util.jump_hash(key, n), util.jump_hash(key, n + 1)
+                self.assertTrue(0 <= new <= n)
+                # keys either stay or move to the new bucket
+                self.assertIn(new, (old, n))
+
+    def test_userid_bucket(self):
+        userid = '4bdd4f929f3a1062253e4e496bafba0bdfb5db75ABCDEFGH'
+        bucket = util.userid_bucket(userid, 4)
+        # resource is not part of the hash
+        self.assertEqual(util.userid_bucket(userid[:40], 4), bucket)
+        self.assertEqual(util.userid_bucket(userid[:40] + 'IJKLMNOP', 4), bucket)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,31 @@
+import unittest
+
+from twisted.words.xish import domish
+from wokkel import generic
+
+from kontalk.xmppserver import xmlstream2
+
+
+class TestStanzaTemplate(unittest.TestCase):
+
+    def test_render(self):
+        stanza = domish.Element(('jabber:component:accept', 'presence'))
+        stanza['from'] = 'alice@c2s.alpha/RES'
+        stanza['to'] = 'ignored@c2s.alpha'
+        stanza.addElement('status', content=u'caf\xe9 <3')
+        template = xmlstream2.StanzaTemplate(stanza)
+        # the stanza is left untouched
+        self.assertEqual(stanza['to'], 'ignored@c2s.alpha')
+
+        data = template.render("bob@c2s.beta/R'1", 'bob@kontalk.net')
+        self.assertIsInstance(data, str)
+        copy = generic.parseXml(data)
+        self.assertEqual(copy.name, 'presence')
+        self.assertEqual(copy['from'], 'alice@c2s.alpha/RES')
+        self.assertEqual(copy['to'], "bob@c2s.beta/R'1")
+        self.assertEqual(copy['original-to'], 'bob@kontalk.net')
+        self.assertEqual(unicode(copy.status), u'caf\xe9 <3')
+
+        # missing values are left out
+        copy = generic.parseXml(template.render('carol@c2s.beta', None))
+        self.assertFalse(copy.hasAttribute('original-to'))